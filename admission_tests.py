@@ -0,0 +1,108 @@
+from auth_proxy.admission import INFLIGHT, LATENCY
+from auth_proxy.application import app, create_app
+from auth_proxy.extensions import admission
+from flask import g
+from testing import AppTestCase, StubUpstream
+import os
+import time
+import unittest
+import json
+
+
+class AdmissionTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream(body={'resourceType': 'CapabilityStatement', 'rest': [{}]}).start()
+        self.start_app(API_SERVER=self.stub.url,
+                       ADMISSION=True,
+                       ADMISSION_CAPACITY=2,
+                       ADMISSION_WAIT_BUDGET=0.6,
+                       ADMISSION_PATH=os.path.join(self.directory, "admission"))
+        admission.counters.clear()
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def saturate(self, inflight, latency):
+        # As if another worker had that many requests in flight.
+        with admission.table.locked('worker:1') as record:
+            record[INFLIGHT] = inflight
+            record[LATENCY] = latency
+
+    def test_tracks_requests(self):
+        response = self.app.get('/api/me', headers=self.headers)
+        assert response.status_code == 200
+
+        status = json.loads(self.app.get('/api/status/ready').get_data(as_text=True))
+        assert status['ready']
+        assert status['inflight'] == 0
+        assert status['latency_ms'] > 0
+
+    def test_latency_of_upstream(self):
+        # A request that took a second, half a second of it upstream.
+        with self.auth_app.test_request_context('/api/fhir/Patient'):
+            g._admitted = time.time() - 1
+            g.upstream_seconds = 0.5
+            admission._teardown_request()  # pylint: disable=protected-access
+
+        with admission.table.locked('worker:0') as record:
+            assert record[LATENCY] == 0.5
+
+    def test_sheds_by_priority(self):
+        # 4 requests queued behind 2 workers, 0.5 s each: a 1 s wait.
+        self.saturate(6, 0.5)
+
+        response = self.app.get('/api/fhir/Observation?patient=' + self.PATIENT_ID,
+                                headers=self.headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+        response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=self.headers)
+        assert response.status_code == 503
+
+        response = self.app.get('/api/status/ready')
+        assert response.status_code == 503
+        status = json.loads(response.get_data(as_text=True))
+        assert status['queued'] == 4
+        assert status['wait_ms'] == 1000
+        assert status['shed'] == {'bulk': 1, 'normal': 1}
+
+        # Critical requests have four times the budget.
+        response = self.app.get('/api/fhir/metadata')
+        assert response.status_code == 200
+
+    def test_bulk_shed_first(self):
+        # A 0.4 s wait: over the bulk budget only.
+        self.saturate(4, 0.4)
+
+        response = self.app.get('/api/fhir/Observation?patient=' + self.PATIENT_ID,
+                                headers=self.headers)
+        assert response.status_code == 503
+
+        response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=self.headers)
+        assert response.status_code == 200
+
+    def test_queued_too_long(self):
+        headers = dict(self.headers)
+        headers['X-Request-Start'] = 't={:.3f}'.format(time.time() - 5)
+
+        response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=headers)
+        assert response.status_code == 503
+
+        headers['X-Request-Start'] = 't={:d}'.format(int(time.time() * 1000000))
+        response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=headers)
+        assert response.status_code == 200
+
+    def test_disabled(self):
+        app.config["ADMISSION"] = False
+        create_app()
+        self.saturate(6, 0.5)
+
+        response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=self.headers)
+        assert response.status_code == 200
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,19 @@
+from auth_proxy import extensions, fork, writer
 from auth_proxy.application import create_app
 
 app = create_app()
+
+try:
+    import uwsgi
+except ImportError:
+    pass
+else:
+    # Write out queued audit records and usage counts when a worker shuts down.
+    def shutdown():
+        writer.flush_all()
+        extensions.usage.flush()
+
+    uwsgi.atexit = shutdown
+
+if app.config['STARTUP_MODE'] == 'production':
+    fork.freeze()
@@ -0,0 +1,106 @@
+from auth_proxy.application import app
+from auth_proxy.models.audit import AuditEvent
+from auth_proxy.extensions import audit
+from testing import AppTestCase, StubUpstream
+from auth_proxy.writer import BatchWriter, RotatingFile
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import json
+
+
+class AuditTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        app.config["API_SERVER"] = self.stub.url
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def test_file_log(self):
+        path = os.path.join(self.directory, 'audit.ndjson')
+        self.start_app(AUDIT_LOG="file", AUDIT_PATH=path)
+
+        self.app.get('/api/fhir/Patient', headers=self.headers)
+        self.app.get('/api/fhir/Secret', headers=self.headers)
+        audit.flush()
+
+        with open(path) as log:
+            records = [json.loads(line) for line in log]
+
+        assert [(record['resource_type'], record['status']) for record in records] == \
+            [('Patient', 200), ('Secret', 403)]
+        assert records[0]['client_id'] == self.CLIENT_ID
+        assert records[0]['patient_id'] == self.PATIENT_ID
+        assert records[0]['user_id'] == 1
+        assert records[0]['latency_ms'] > 0
+
+    def test_database_log(self):
+        self.start_app(AUDIT_LOG="database", ADMIN_TOKEN="admin-secret")
+
+        for _ in range(3):
+            self.app.get('/api/fhir/Observation', headers=self.headers)
+        audit.flush()
+
+        with self.auth_app.app_context():
+            events = AuditEvent.query.all()
+        assert len(events) == 3
+        assert events[0].resource_type == 'Observation'
+
+        assert self.app.get('/api/status/audit', headers=self.headers).status_code == 403
+
+        response = self.app.get('/api/status/audit',
+                                headers={'Authorization': 'Bearer admin-secret'})
+        status = json.loads(response.get_data(as_text=True))
+        assert status['written'] == 3
+        assert status['dropped'] == 0
+
+
+class BatchWriterTestCase(unittest.TestCase):
+
+    def test_drops_when_full(self):
+        entered = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def sink(batch):
+            entered.set()
+            release.wait()
+            written.extend(batch)
+
+        writer = BatchWriter(sink, queue_size=2, batch_size=1, flush_interval=0.01)
+        writer.put(0)
+        entered.wait()
+
+        # The writer is stuck; the queue takes two more.
+        assert [writer.put(i) for i in range(1, 4)] == [True, True, False]
+
+        release.set()
+        writer.flush()
+
+        assert written == [0, 1, 2]
+        assert writer.status()['dropped'] == 1
+        assert writer.status()['written'] == 3
+
+    def test_rotation(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'log.ndjson')
+        sink = RotatingFile(path, max_bytes=100, backups=2)
+
+        for batch in range(4):
+            sink([{'batch': batch, 'padding': 'x' * 100}])
+
+        assert sorted(os.listdir(directory)) == \
+            ['log.ndjson.1', 'log.ndjson.2', 'log.ndjson.lock']
+        with open(path + '.1') as log:
+            assert json.loads(log.read())['batch'] == 3
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
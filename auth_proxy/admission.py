@@ -0,0 +1,228 @@
+""" Admission control.
+
+Once every worker is busy, new requests wait in the listen queue, and by
+the time a worker picks them up their client may already have given up.
+Admission keeps, for every worker on the host, the number of requests in
+flight and a moving average of how long requests wait for the FHIR
+server, in a SharedTable. From those, and the length of the uwsgi listen
+queue, it estimates how long a queued request waits for a worker. When that is over the budget of
+the request's priority, the request is answered at once with a 503 and a
+Retry-After, which frees the worker for the rest of the queue.
+
+Token requests and the CapabilityStatement are critical and have four
+times the budget; searches and Binary downloads are bulk reads and have
+half of it. If the front end sets X-Request-Start (for example nginx with
+`proxy_set_header X-Request-Start "t=${msec}"`), a request that has
+already waited longer than its budget is shed too.
+"""
+from collections import Counter
+import math
+import time
+
+from flask import g, jsonify, request
+
+from auth_proxy import fork, shm
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+# The fields of a worker record.
+INFLIGHT, LATENCY, UPDATED = range(3)
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+# Multiples of ADMISSION_WAIT_BUDGET.
+BUDGETS = {CRITICAL: 4.0, NORMAL: 1.0, BULK: 0.5}
+
+CRITICAL_ENDPOINTS = ('oauth.cb_oauth_token', 'api.api_fhir_metadata')
+# Subscription event streams stay open for minutes and would skew the
+# latency estimate.
+EXEMPT_ENDPOINTS = ('api.api_ready', 'api.api_upstream_status', 'api.api_audit_status',
+                    'api.api_capture_status', 'api.api_subscription_status',
+                    'api.api_subscription_events')
+
+# Weight of the latest request in the latency average.
+ALPHA = 0.2
+
+
+class OverloadedError(Exception):
+    """ Raised when a request is shed.
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(self)
+        self.retry_after = retry_after
+
+    @property
+    def message(self):
+        """ Format the message.
+        """
+        return 'The server is overloaded; try again later.'
+
+
+class Admission(object):
+    """ Sheds requests that would wait too long for a worker.
+    """
+    def __init__(self, app=None):
+        self.enabled = False
+        self.budget = None
+        self.capacity = None
+        self.header = None
+        self.table = None
+        self.counters = Counter()
+        fork.after_fork(self._reset_worker)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the settings, (re)open the shared table and install the
+        request hooks.
+        """
+        app.config.setdefault('ADMISSION', False)
+        app.config.setdefault('ADMISSION_WAIT_BUDGET', 1.0)
+        app.config.setdefault('ADMISSION_CAPACITY', uwsgi.numproc if uwsgi else 4)
+        app.config.setdefault('ADMISSION_QUEUE_HEADER', 'X-Request-Start')
+        app.config.setdefault('ADMISSION_PATH', shm.table_path('admission'))
+
+        self.enabled = app.config['ADMISSION']
+        self.budget = app.config['ADMISSION_WAIT_BUDGET']
+        self.capacity = app.config['ADMISSION_CAPACITY']
+        self.header = app.config['ADMISSION_QUEUE_HEADER']
+
+        path = app.config['ADMISSION_PATH']
+        if self.table is None or self.table.path != path:
+            if self.table is not None:
+                self.table.close()
+            self.table = shm.SharedTable(path, fields=3, slots=256)
+
+        if 'admission' not in app.extensions:
+            app.extensions['admission'] = self
+            app.before_request(self._before_request)
+            app.teardown_request(self._teardown_request)
+            app.register_error_handler(OverloadedError, handle_overloaded_error)
+
+    def priority(self, endpoint, view_args):
+        """ The priority of a request to endpoint, or None if it is not
+        subject to admission control.
+        """
+        if endpoint in CRITICAL_ENDPOINTS:
+            return CRITICAL
+        if not endpoint or not endpoint.startswith('api.') or endpoint in EXEMPT_ENDPOINTS:
+            return None
+
+        path = (view_args or {}).get('path', '')
+        if endpoint == 'api.api_fhir_proxy' and ('/' not in path or path.startswith('Binary/')):
+            return BULK
+        return NORMAL
+
+    def saturation(self):
+        """ Requests in flight and queued on this host, the average request
+        time, and the estimated wait for a worker (in seconds).
+        """
+        inflight = 0
+        latencies = []
+        for worker in range(self.capacity + 1):
+            with self.table.locked('worker:{:d}'.format(worker)) as record:
+                inflight += record[INFLIGHT]
+                if record[LATENCY]:
+                    latencies.append(record[LATENCY])
+        latency = sum(latencies) / len(latencies) if latencies else 0.0
+
+        queued = _listen_queue() + max(0, inflight - self.capacity)
+        return {
+            'inflight': int(inflight),
+            'queued': int(queued),
+            'capacity': self.capacity,
+            'latency': latency,
+            'wait': queued * latency / self.capacity,
+        }
+
+    def status(self):
+        """ Saturation, budget and what was shed by this worker.
+        """
+        status = self.saturation()
+        return {
+            'ready': status['wait'] <= self.budget,
+            'enabled': self.enabled,
+            'inflight': status['inflight'],
+            'queued': status['queued'],
+            'capacity': status['capacity'],
+            'latency_ms': round(status['latency'] * 1000, 1),
+            'wait_ms': round(status['wait'] * 1000, 1),
+            'budget_ms': round(self.budget * 1000, 1),
+            'shed': dict(self.counters),
+        }
+
+    def _before_request(self):
+        priority = self.priority(request.endpoint, request.view_args)
+        if priority is None:
+            return
+
+        if self.enabled:
+            budget = self.budget * BUDGETS[priority]
+            wait = self.saturation()['wait']
+            waited = self._waited()
+            if wait > budget or waited > budget:
+                self.counters[priority] += 1
+                raise OverloadedError(retry_after=max(1, wait))
+
+        with self.table.locked(self._key()) as record:
+            record[INFLIGHT] += 1
+        g._admitted = time.time()
+
+    def _teardown_request(self, exc=None):  # pylint: disable=unused-argument
+        started = g.pop('_admitted', None)
+        if started is None:
+            return
+
+        # The time spent waiting for the upstream, which is what grows with
+        # load, rather than how fast the client reads a streamed body.
+        # Requests that don't call the upstream are timed whole.
+        elapsed = g.get('upstream_seconds') or time.time() - started
+        with self.table.locked(self._key()) as record:
+            record[INFLIGHT] = max(0, record[INFLIGHT] - 1)
+            record[LATENCY] = elapsed if not record[LATENCY] else \
+                ALPHA * elapsed + (1 - ALPHA) * record[LATENCY]
+            record[UPDATED] = time.time()
+
+    def _waited(self):
+        # How long the request queued in front of us, if the front end says.
+        value = request.headers.get(self.header, '') if self.header else ''
+        try:
+            started = float(value.replace('t=', ''))
+        except ValueError:
+            return 0
+        # nginx sends seconds with milliseconds; others send ms or µs.
+        while started > 1e11:
+            started /= 1000
+        return max(0, time.time() - started)
+
+    def _key(self):
+        return 'worker:{:d}'.format(uwsgi.worker_id() if uwsgi else 0)
+
+    def _reset_worker(self):
+        # A worker that died mid-request left its requests in flight.
+        if self.table is not None:
+            with self.table.locked(self._key()) as record:
+                record[INFLIGHT] = 0
+
+
+def handle_overloaded_error(error):
+    """ Answer a shed request.
+    """
+    response = jsonify({'error': error.message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
+
+    return response
+
+
+def _listen_queue():
+    # Connections waiting to be accepted by a worker (uwsgi >= 2.0.15).
+    if uwsgi is not None and hasattr(uwsgi, 'listen_queue'):
+        return uwsgi.listen_queue()
+    return 0
@@ -1,46 +1,176 @@
 # pylint: disable=missing-docstring
 """ Holds the create_app() Flask application factory.
 """
+import json
 import os
 
 from flask import Flask
 
+from auth_proxy import fork
+
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret'
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db/db.sqlite'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_REPLICA_URIS'] = os.getenv('SQLALCHEMY_REPLICA_URIS', '').split()
+app.config['SQLITE_CONCURRENCY'] = os.getenv('SQLITE_CONCURRENCY') == 'True'
 
 app.config['WTF_CSRF_CHECK_DEFAULT'] = False
 
 app.config['API_SERVER'] = os.getenv('API_SERVER')
 app.config['API_SERVER_NAME'] = os.getenv('API_SERVER_NAME')
+app.config['API_SERVER_REPLICAS'] = os.getenv('API_SERVER_REPLICAS', '').split()
 app.config['ENABLE_UNSECURE_FHIR'] = os.getenv('ENABLE_UNSECURE_FHIR') == 'True'
 
 app.config['BASE_URL'] = os.getenv('BASE_URL', None)
 
+app.config['UPSTREAM_CONNECT_TIMEOUT'] = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+app.config['UPSTREAM_READ_TIMEOUT'] = float(os.getenv('UPSTREAM_READ_TIMEOUT', 30))
+app.config['UPSTREAM_RETRIES'] = int(os.getenv('UPSTREAM_RETRIES', 2))
+app.config['UPSTREAM_RETRY_BACKOFF'] = float(os.getenv('UPSTREAM_RETRY_BACKOFF', 0.1))
+app.config['UPSTREAM_RETRY_BUDGET'] = float(os.getenv('UPSTREAM_RETRY_BUDGET', 0.2))
+app.config['UPSTREAM_BREAKER_THRESHOLD'] = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', 5))
+app.config['UPSTREAM_BREAKER_RESET'] = float(os.getenv('UPSTREAM_BREAKER_RESET', 30))
+app.config['UPSTREAM_HEALTH_INTERVAL'] = float(os.getenv('UPSTREAM_HEALTH_INTERVAL', 10))
+app.config['UPSTREAM_HEDGE_AFTER'] = float(os.getenv('UPSTREAM_HEDGE_AFTER', 0))
+
+# Warm the response cache for a patient when their token is issued.
+app.config['PREFETCH'] = os.getenv('PREFETCH') == 'True'
+app.config['PREFETCH_QUERIES'] = os.getenv('PREFETCH_QUERIES', ' '.join([
+    'Patient/{patient}',
+    'AllergyIntolerance?patient={patient}',
+    'Condition?patient={patient}',
+    'MedicationStatement?patient={patient}',
+    'MedicationRequest?patient={patient}',
+    'Observation?patient={patient}',
+    'Immunization?patient={patient}',
+    'Procedure?patient={patient}',
+])).split()
+app.config['PREFETCH_TTL'] = int(os.getenv('PREFETCH_TTL', 30))
+app.config['PREFETCH_WORKERS'] = int(os.getenv('PREFETCH_WORKERS', 2))
+app.config['PREFETCH_ACCEPT'] = os.getenv('PREFETCH_ACCEPT', 'application/json+fhir')
+# "shared" (all workers on the host) or "memory" (per worker)
+app.config['PREFETCH_CACHE'] = os.getenv('PREFETCH_CACHE', 'shared')
+app.config['PREFETCH_CACHE_PATH'] = os.getenv('PREFETCH_CACHE_PATH')
+
+# Check that proxied resources belong to the token's patient.
+app.config['COMPARTMENT_CHECK'] = os.getenv('COMPARTMENT_CHECK', 'True') == 'True'
+
+# "auto" (ask the CapabilityStatement), "upstream" or "local"
+app.config['UPSTREAM_PROJECTION'] = os.getenv('UPSTREAM_PROJECTION', 'auto')
+app.config['CAPABILITY_CACHE_TTL'] = int(os.getenv('CAPABILITY_CACHE_TTL', 300))
+
+# "production" preloads the app in the uwsgi master (see uwsgi.production.ini)
+app.config['STARTUP_MODE'] = os.getenv('STARTUP_MODE', 'development')
+
+app.config['INTROSPECTION_CLIENTS'] = os.getenv('INTROSPECTION_CLIENTS', '').split()
+app.config['INTROSPECTION_MAX_TOKENS'] = int(os.getenv('INTROSPECTION_MAX_TOKENS', 100))
+app.config['INTROSPECTION_MAX_AGE'] = int(os.getenv('INTROSPECTION_MAX_AGE', 60))
+
+# Shed requests that would wait longer than ADMISSION_WAIT_BUDGET seconds.
+app.config['ADMISSION'] = os.getenv('ADMISSION') == 'True'
+app.config['ADMISSION_WAIT_BUDGET'] = float(os.getenv('ADMISSION_WAIT_BUDGET', 1.0))
+if os.getenv('ADMISSION_CAPACITY'):
+    app.config['ADMISSION_CAPACITY'] = int(os.getenv('ADMISSION_CAPACITY'))
+
+app.config['RATE_LIMITS'] = json.loads(os.getenv('RATE_LIMITS', '{}'))
+if os.getenv('RATE_LIMIT_PATH'):
+    app.config['RATE_LIMIT_PATH'] = os.getenv('RATE_LIMIT_PATH')
+
+# "database", "memory" (single worker only) or "shared"; see auth_proxy/grants.py
+app.config['GRANT_STORE'] = os.getenv('GRANT_STORE', 'database')
+app.config['GRANT_STORE_PATH'] = os.getenv('GRANT_STORE_PATH')
+
+app.config['AUDIT_LOG'] = os.getenv('AUDIT_LOG')
+app.config['AUDIT_PATH'] = os.getenv('AUDIT_PATH', 'audit.ndjson')
+
+# Count API calls per token for /apps, written every USAGE_FLUSH_INTERVAL seconds.
+app.config['USAGE_TRACKING'] = os.getenv('USAGE_TRACKING') == 'True'
+app.config['USAGE_FLUSH_INTERVAL'] = float(os.getenv('USAGE_FLUSH_INTERVAL', 10.0))
+
+# Record sanitized request shapes for benchmarks/replay.py.
+app.config['CAPTURE'] = os.getenv('CAPTURE') == 'True'
+app.config['CAPTURE_PATH'] = os.getenv('CAPTURE_PATH', 'capture.ndjson')
+
+# Answer /api/verify for a front proxy that streams FHIR responses itself.
+app.config['DELEGATE'] = os.getenv('DELEGATE') == 'True'
+app.config['DELEGATE_ACCEL_PREFIX'] = os.getenv('DELEGATE_ACCEL_PREFIX')
+
+# /api/sync pages and the overlap between syncs; see services/sync.py.
+app.config['SYNC_PAGE_SIZE'] = int(os.getenv('SYNC_PAGE_SIZE', 500))
+app.config['SYNC_SKEW'] = float(os.getenv('SYNC_SKEW', 30))
+
+# Notify apps of changes to their patient's resources; see services/subscription.py.
+app.config['SUBSCRIPTIONS'] = os.getenv('SUBSCRIPTIONS') == 'True'
+app.config['SUBSCRIPTION_POLL_INTERVAL'] = float(os.getenv('SUBSCRIPTION_POLL_INTERVAL', 30))
+app.config['SUBSCRIPTION_MAX_POLLS'] = int(os.getenv('SUBSCRIPTION_MAX_POLLS', 100))
+app.config['SUBSCRIPTION_LOCK_PATH'] = os.getenv('SUBSCRIPTION_LOCK_PATH')
+app.config['SUBSCRIPTION_LOCAL_ENDPOINTS'] = os.getenv('SUBSCRIPTION_LOCAL_ENDPOINTS') == 'True'
+
+# Answer CORS preflights of the API before Flask; see auth_proxy/preflight.py.
+# CORS_MAX_AGE also applies to the preflights flask_cors answers.
+app.config['CORS_PREFLIGHT'] = os.getenv('CORS_PREFLIGHT', 'True') == 'True'
+app.config['CORS_MAX_AGE'] = int(os.getenv('CORS_MAX_AGE', 86400))
+
+# Enables the /admin endpoints; send it as "Authorization: Bearer <token>".
+app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')
+
 def create_app():
     from auth_proxy import (
         extensions,
         filters,
     )
+    from auth_proxy.models import audit as audit_models
+    from auth_proxy.models import subscription as subscription_models
+    from auth_proxy.models import sync as sync_models
+    from auth_proxy.services import subscription_service
+    from auth_proxy.views.admin.views import BP as admin_blueprint
     from auth_proxy.views.api.views import BP as api_blueprint
-    from auth_proxy.views.cli.views import BP as cli_blueprint
     from auth_proxy.views.main.views import BP as main_blueprint
     from auth_proxy.views.oauth.views import BP as oauth_blueprint
 
+    app.register_blueprint(admin_blueprint)
     app.register_blueprint(api_blueprint)
-    app.register_blueprint(cli_blueprint)
     app.register_blueprint(main_blueprint)
     app.register_blueprint(oauth_blueprint)
 
+    # Workers never run CLI commands.
+    if app.config['STARTUP_MODE'] != 'production':
+        from auth_proxy.views.cli.views import BP as cli_blueprint
+        app.register_blueprint(cli_blueprint)
+
     extensions.db.init_app(app)
+    extensions.replicas.init_app(app)
+    extensions.sqlite_concurrency.init_app(app)
     extensions.csrf.init_app(app)
     extensions.login_manager.init_app(app)
     extensions.oauthlib.init_app(app)
     extensions.cors.init_app(app)
+    extensions.preflight.init_app(app)
+    extensions.admission.init_app(app)
+    extensions.ratelimiter.init_app(app)
+    extensions.audit.init_app(app)
+    extensions.usage.init_app(app)
+    extensions.capture.init_app(app)
+    extensions.profiler.init_app(app)
+    subscription_service.init_app(app)
 
     assert filters
+    assert audit_models
+    assert subscription_models
+    assert sync_models
 
     return app
+
+
+@fork.after_fork
+def dispose_engines():
+    """ Don't share pooled database connections with the master process.
+    """
+    from auth_proxy import extensions
+
+    if 'sqlalchemy' in app.extensions:
+        extensions.db.get_engine(app).dispose()
+        extensions.replicas.dispose(app)
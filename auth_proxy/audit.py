@@ -0,0 +1,116 @@
+""" PHI access audit log.
+
+Every proxied FHIR API call is recorded: the user and client behind the
+token, the patient, the resource type, the method, the response status and
+the latency. The request path only queues a small dict; a BatchWriter
+writes the queue to the database (AUDIT_LOG=database, as AuditEvent rows)
+or to rotated NDJSON files (AUDIT_LOG=file, at AUDIT_PATH) in batches.
+
+Drop and write counters are served to admins at /api/status/audit.
+"""
+from datetime import datetime
+from functools import wraps
+import time
+
+from flask import after_this_request, request
+
+from auth_proxy.writer import BatchWriter, RotatingFile
+
+
+class Audit(object):
+    """ Records FHIR API accesses in the background.
+    """
+    def __init__(self, db, app=None):
+        self.db = db
+        self.app = None
+        self.writer = None
+        self._sink_config = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Set up the writer for the configured sink.
+        """
+        app.config.setdefault('AUDIT_LOG', None)
+        app.config.setdefault('AUDIT_PATH', 'audit.ndjson')
+        app.config.setdefault('AUDIT_MAX_BYTES', 50 * 1024 * 1024)
+        app.config.setdefault('AUDIT_BACKUPS', 10)
+        app.config.setdefault('AUDIT_QUEUE_SIZE', 10000)
+        app.config.setdefault('AUDIT_BATCH_SIZE', 500)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 1.0)
+
+        self.app = app
+        config = tuple(app.config[key] for key in (
+            'AUDIT_LOG', 'AUDIT_PATH', 'AUDIT_MAX_BYTES', 'AUDIT_BACKUPS',
+            'AUDIT_QUEUE_SIZE', 'AUDIT_BATCH_SIZE', 'AUDIT_FLUSH_INTERVAL'))
+        if config == self._sink_config:
+            return
+
+        if self.writer is not None:
+            self.writer.flush()
+            self.writer = None
+        self._sink_config = config
+
+        if app.config['AUDIT_LOG'] == 'database':
+            sink = self._write_database
+        elif app.config['AUDIT_LOG'] == 'file':
+            sink = RotatingFile(app.config['AUDIT_PATH'],
+                                app.config['AUDIT_MAX_BYTES'],
+                                app.config['AUDIT_BACKUPS'])
+        else:
+            return
+
+        self.writer = BatchWriter(sink,
+                                  app.config['AUDIT_QUEUE_SIZE'],
+                                  app.config['AUDIT_BATCH_SIZE'],
+                                  app.config['AUDIT_FLUSH_INTERVAL'])
+
+    def record(self, func):
+        """ Decorate an OAuth protected FHIR view to audit its requests.
+        """
+        @wraps(func)
+        def decorated(path, *args, **kwargs):
+            if self.writer is None:
+                return func(path, *args, **kwargs)
+
+            start = time.perf_counter()
+            token = request.oauth.access_token
+
+            @after_this_request
+            def log(response):  # pylint: disable=unused-variable
+                self.writer.put({
+                    'created': datetime.utcnow(),
+                    'user_id': token.user_id,
+                    'client_id': token.client_id,
+                    'patient_id': token.patient_id,
+                    'method': request.method,
+                    'resource_type': path.split('/')[0],
+                    'status': response.status_code,
+                    'latency_ms': round((time.perf_counter() - start) * 1000, 3),
+                })
+                return response
+
+            return func(path, *args, **kwargs)
+
+        return decorated
+
+    def status(self):
+        """ The writer's counters.
+        """
+        if self.writer is None:
+            return {'enabled': False}
+        return dict(self.writer.status(), enabled=True)
+
+    def flush(self):
+        """ Write everything queued so far.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def _write_database(self, batch):
+        from auth_proxy.models.audit import AuditEvent
+
+        engine = self.db.get_engine(self.app)
+        with engine.begin() as connection:
+            connection.execute(AuditEvent.__table__.insert(), batch)
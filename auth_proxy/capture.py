@@ -0,0 +1,158 @@
+""" Traffic capture for replay.
+
+With CAPTURE on, the FHIR API and token routes record the shape of every
+request to rotated NDJSON files (CAPTURE_PATH), written in batches by a
+BatchWriter: the route, resource type, read or search, argument names,
+request and response sizes, status, duration and upstream latency.
+
+Captures are meant to leave the building, so they hold no PHI and no
+credentials. Paths are cut to the resource type, argument values are
+dropped (except _count and _summary, which only shape the response), and
+tokens and client ids are replaced by keyed hashes: a replay can tell
+requests of the same token apart from others, but not which token it was.
+
+benchmarks/replay.py replays a capture against a local build.
+"""
+from functools import wraps
+import hashlib
+import hmac
+import time
+
+from flask import after_this_request, current_app, g, request
+
+from auth_proxy.writer import BatchWriter, RotatingFile
+
+SUMMARIES = ('true', 'text', 'data', 'count', 'false')
+
+
+class Capture(object):
+    """ Records sanitized request shapes in the background.
+    """
+    def __init__(self, app=None):
+        self.writer = None
+        self._sink_config = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Set up the writer if capture is on.
+        """
+        app.config.setdefault('CAPTURE', False)
+        app.config.setdefault('CAPTURE_PATH', 'capture.ndjson')
+        app.config.setdefault('CAPTURE_MAX_BYTES', 50 * 1024 * 1024)
+        app.config.setdefault('CAPTURE_BACKUPS', 10)
+
+        config = tuple(app.config[key] for key in (
+            'CAPTURE', 'CAPTURE_PATH', 'CAPTURE_MAX_BYTES', 'CAPTURE_BACKUPS'))
+        if config == self._sink_config:
+            return
+
+        if self.writer is not None:
+            self.writer.flush()
+            self.writer = None
+        self._sink_config = config
+
+        if app.config['CAPTURE']:
+            self.writer = BatchWriter(RotatingFile(app.config['CAPTURE_PATH'],
+                                                   app.config['CAPTURE_MAX_BYTES'],
+                                                   app.config['CAPTURE_BACKUPS']))
+
+    def record(self, func):
+        """ Decorate a view to capture its requests.
+        """
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            if self.writer is None:
+                return func(*args, **kwargs)
+
+            started = time.time()
+            start = time.perf_counter()
+            g.upstream_seconds = 0.0
+
+            @after_this_request
+            def capture(response):  # pylint: disable=unused-variable
+                entry = self._describe(started)
+                entry['status'] = response.status_code
+                entry['upstream_ms'] = round(g.upstream_seconds * 1000, 3)
+
+                def finish():
+                    entry['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+                    self.writer.put(entry)
+
+                # A streamed body is only known once it has been sent.
+                if response.is_streamed:
+                    entry['response_bytes'] = 0
+                    response.response = _counted(response.response, entry)
+                    response.call_on_close(finish)
+                else:
+                    entry['response_bytes'] = response.content_length
+                    finish()
+                return response
+
+            return func(*args, **kwargs)
+
+        return decorated
+
+    def status(self):
+        """ The writer's counters.
+        """
+        if self.writer is None:
+            return {'enabled': False}
+        return dict(self.writer.status(), enabled=True)
+
+    def flush(self):
+        """ Write everything queued so far.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def _describe(self, started):
+        path = (request.view_args or {}).get('path', '')
+        resource_type, _, rest = path.partition('/')
+        summary = request.args.get('_summary')
+        elements = request.args.get('_elements')
+
+        entry = {
+            't': round(started, 3),
+            'route': request.endpoint,
+            'method': request.method,
+            'resource_type': resource_type or None,
+            'interaction': ('read' if rest else 'search') if resource_type else None,
+            'args': sorted(request.args),
+            'count': request.args.get('_count', type=int),
+            'summary': summary if summary in SUMMARIES else None,
+            'elements': len(elements.split(',')) if elements else None,
+            'accept': request.headers.get('Accept'),
+            'range': 'Range' in request.headers,
+            'request_bytes': request.content_length or 0,
+        }
+
+        oauth = getattr(request, 'oauth', None)
+        if oauth is not None and oauth.access_token is not None:
+            entry['token'] = self._pseudonym(oauth.access_token.access_token)
+            entry['client'] = self._pseudonym(oauth.access_token.client_id)
+        else:
+            entry['grant_type'] = request.form.get('grant_type')
+            entry['client'] = self._pseudonym(request.form.get('client_id') or
+                                              getattr(request.authorization, 'username', None))
+        return entry
+
+    @staticmethod
+    def _pseudonym(value):
+        if not value:
+            return None
+        key = current_app.config['SECRET_KEY'].encode('utf-8')
+        return hmac.new(key, value.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def _counted(chunks, entry):
+    # Count the bytes of a streamed body as they go out.
+    try:
+        for chunk in chunks:
+            entry['response_bytes'] += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
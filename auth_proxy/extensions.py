@@ -5,7 +5,16 @@ To avoid circular imports with views and create_app(), extensions are
 instantiated here. They will be initialized (calling init_app()) in
 application.py.
 """
+from auth_proxy.admission import Admission
+from auth_proxy.audit import Audit
+from auth_proxy.capture import Capture
 from auth_proxy.oauth2 import PatchedOAuth2Provider
+from auth_proxy.preflight import Preflight
+from auth_proxy.profiling import Profiler
+from auth_proxy.ratelimit import RateLimiter
+from auth_proxy.replicas import ReplicaRouter
+from auth_proxy.sqlite import SQLiteConcurrency
+from auth_proxy.usage import Usage
 from flask_cors import CORS
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
@@ -13,7 +22,16 @@ from flask_wtf.csrf import CsrfProtect
 
 
 db = SQLAlchemy()
+replicas = ReplicaRouter(db)
+sqlite_concurrency = SQLiteConcurrency(db)
 csrf = CsrfProtect()
 login_manager = LoginManager()
 oauthlib = PatchedOAuth2Provider()
 cors = CORS()
+preflight = Preflight()
+admission = Admission()
+ratelimiter = RateLimiter()
+audit = Audit(db)
+usage = Usage(db)
+capture = Capture()
+profiler = Profiler()
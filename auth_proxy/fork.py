@@ -0,0 +1,51 @@
+""" Fork safety.
+
+In the production startup mode uwsgi builds the application once in the
+master process and forks the workers from it, so they share its memory
+copy-on-write. Anything that holds sockets, threads or locks (database
+engines, HTTP sessions, background writers) must not be shared; register
+a callback here to re-create it in each worker.
+
+The callbacks run from uwsgi's postfork hook under uwsgi, and from
+os.register_at_fork otherwise (multiprocessing, for example), never both.
+"""
+import gc
+import os
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+_CALLBACKS = []
+
+
+def after_fork(func):
+    """ Register func to run in every forked worker. Usable as a decorator.
+    """
+    _CALLBACKS.append(func)
+    return func
+
+
+def run_after_fork():
+    """ Run the registered callbacks.
+    """
+    for func in _CALLBACKS:
+        func()
+
+
+def freeze():
+    """ Move everything allocated so far into the permanent generation.
+
+    Otherwise the first garbage collection in each worker touches (and so
+    copies) every page of the preloaded application.
+    """
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+if postfork is not None:
+    postfork(run_after_fork)
+elif hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=run_after_fork)
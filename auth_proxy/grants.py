@@ -0,0 +1,241 @@
+""" Authorization code grant storage.
+
+A grant lives from the authorize redirect until the client exchanges its
+code for a token, at most 100 seconds. GRANT_STORE picks where it is kept:
+
+    database  Grant rows, as before (the default).
+    memory    A dict in the worker process. Only for a single worker, since
+              the code exchange may reach another worker.
+    shared    One small file per grant in GRANT_STORE_PATH (on /dev/shm by
+              default), shared by every worker on the host.
+
+Codes are single use in every store: the first lookup of a code takes the
+grant out of the store, and later lookups in the same request are answered
+from the request context. A concurrent or replayed exchange of the same
+code finds nothing.
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app, g
+
+from auth_proxy import shm
+from auth_proxy.extensions import sqlite_concurrency
+from auth_proxy.models.oauth import Grant
+from auth_proxy.models.user import User
+
+
+class StoredGrant(object):
+    """ A grant as handed to Flask-OAuthlib, whatever the store.
+    """
+    def __init__(self, client_id, code, user_id, redirect_uri, scopes, expires):
+        self.client_id = client_id
+        self.code = code
+        self.user_id = user_id
+        self.redirect_uri = redirect_uri
+        self.scopes = scopes
+        self.expires = expires  # naive UTC
+
+    @property
+    def user(self):
+        """ The user who authorized the grant.
+        """
+        return User.query.get(self.user_id)
+
+    @property
+    def expired(self):
+        """ Whether the grant can no longer be exchanged.
+        """
+        return datetime.utcnow() > self.expires
+
+    def delete(self):
+        """ Nothing to do: the grant left the store when it was looked up.
+        """
+
+    def to_dict(self):
+        """ A JSON-friendly copy of the grant.
+        """
+        return {
+            'client_id': self.client_id,
+            'code': self.code,
+            'user_id': self.user_id,
+            'redirect_uri': self.redirect_uri,
+            'scopes': self.scopes,
+            'expires': (self.expires - datetime(1970, 1, 1)).total_seconds(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ The grant saved by to_dict().
+        """
+        return cls(data['client_id'], data['code'], data['user_id'], data['redirect_uri'],
+                   data['scopes'], datetime.utcfromtimestamp(data['expires']))
+
+
+class DatabaseStore(object):
+    """ Grants as Grant rows.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    @sqlite_concurrency.serialized
+    def save(self, grant):
+        """ Store grant.
+        """
+        self.db.session.add(Grant(
+            client_id=grant.client_id,
+            user_id=grant.user_id,
+            code=grant.code,
+            redirect_uri=grant.redirect_uri,
+            _scopes=' '.join(grant.scopes),
+            expires=grant.expires,
+        ))
+        self.db.session.commit()
+
+    @sqlite_concurrency.serialized
+    def take(self, code):
+        """ Remove the grant for code and return it, or None.
+        """
+        row = self.db.session.query(Grant).\
+            filter(Grant.code == code, Grant.expires >= datetime.utcnow()).\
+            first()
+        if row is None:
+            return None
+
+        grant = StoredGrant(row.client_id, row.code, row.user_id, row.redirect_uri,
+                            row.scopes, row.expires)
+
+        # Whoever deletes the row owns the grant.
+        deleted = self.db.session.query(Grant).\
+            filter_by(id=row.id).\
+            delete()
+        self.db.session.commit()
+
+        return grant if deleted else None
+
+
+class MemoryStore(object):
+    """ Grants in a dict, for a single worker process.
+    """
+    def __init__(self):
+        self.grants = {}
+        self._lock = threading.Lock()
+
+    def save(self, grant):
+        """ Store grant, forgetting expired ones.
+        """
+        with self._lock:
+            for code in [code for code, old in self.grants.items() if old.expired]:
+                del self.grants[code]
+            self.grants[grant.code] = grant
+
+    def take(self, code):
+        """ Remove the grant for code and return it, or None.
+        """
+        with self._lock:
+            grant = self.grants.pop(code, None)
+        if grant is None or grant.expired:
+            return None
+        return grant
+
+
+class SharedStore(object):
+    """ Grants as files in a directory shared by all workers.
+
+    A grant is published by renaming a complete file into place and taken
+    by unlinking it, which only one process can do.
+    """
+    PURGE_INTERVAL = 60
+    MAX_AGE = 300  # well past any grant's expiry
+
+    def __init__(self, path):
+        self.path = shm.private_directory(path)
+        self._purged = 0
+
+    def save(self, grant):
+        """ Store grant, now and then forgetting expired ones.
+        """
+        if time.time() - self._purged > self.PURGE_INTERVAL:
+            self._purge()
+
+        target = self._file(grant.code)
+        temporary = '{}.{}.tmp'.format(target, uuid.uuid4().hex)
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'w') as out:
+            json.dump(grant.to_dict(), out)
+        os.replace(temporary, target)
+
+    def take(self, code):
+        """ Remove the grant for code and return it, or None.
+        """
+        target = self._file(code)
+        try:
+            with os.fdopen(os.open(target, os.O_RDONLY | os.O_NOFOLLOW)) as source:
+                data = json.load(source)
+            os.unlink(target)
+        except (OSError, ValueError):
+            return None
+
+        grant = StoredGrant.from_dict(data)
+        if grant.code != code or grant.expired:
+            return None
+        return grant
+
+    def _file(self, code):
+        # Codes come from the client; never use them as file names.
+        return os.path.join(self.path, hashlib.sha256(code.encode('utf-8')).hexdigest())
+
+    def _purge(self):
+        self._purged = time.time()
+        cutoff = time.time() - self.MAX_AGE
+        for entry in os.scandir(self.path):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class GrantStore(object):
+    """ The configured grant store, with per-request single use.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._store = None
+        self._config = None
+
+    @property
+    def store(self):
+        """ The store for the current GRANT_STORE setting.
+        """
+        config = (current_app.config['GRANT_STORE'], current_app.config['GRANT_STORE_PATH'])
+
+        if config != self._config:
+            kind, path = config
+            if kind == 'memory':
+                self._store = MemoryStore()
+            elif kind == 'shared':
+                self._store = SharedStore(path or shm.default_path('grants'))
+            else:
+                self._store = DatabaseStore(self.db)
+            self._config = config
+
+        return self._store
+
+    def save(self, grant):
+        """ Store a new grant.
+        """
+        self.store.save(grant)
+
+    def get(self, code):
+        """ The grant for code, taking it out of the store on first use.
+        """
+        taken = g.setdefault('_grants', {})
+        if code not in taken:
+            taken[code] = self.store.take(code) if code else None
+        return taken[code]
@@ -0,0 +1,32 @@
+# pylint: disable=missing-docstring
+""" Audit models module """
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    String,
+)
+
+from auth_proxy.extensions import db
+
+
+class AuditEvent(db.Model):
+    """ One proxied FHIR API access.
+
+    There are deliberately no foreign keys: the trail must outlive the
+    users, clients and tokens it mentions.
+    """
+    __tablename__ = 'audit_event'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, index=True, nullable=False)
+
+    user_id = Column(Integer)
+    client_id = Column(String, index=True)
+    patient_id = Column(String, index=True)
+
+    method = Column(String)
+    resource_type = Column(String)
+    status = Column(Integer)
+    latency_ms = Column(Float)
@@ -12,7 +12,7 @@ from sqlalchemy import (
     orm
 )
 
-from auth_proxy.extensions import db
+from auth_proxy.extensions import db, sqlite_concurrency
 
 
 class Client(db.Model):
@@ -77,6 +77,7 @@ class Grant(db.Model):
 
     _scopes = Column('scopes', Text)
 
+    @sqlite_concurrency.serialized
     def delete(self):
         self.expires = datetime.now()
         # This is not ideal, but FlaskOauth forces it on us
@@ -98,10 +99,10 @@ class Token(db.Model):
     id = Column(Integer, primary_key=True)
 
     client_id = Column(String, ForeignKey('client.client_id'),
-                       nullable=False)
+                       nullable=False, index=True)
     client = orm.relationship('Client')
 
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = orm.relationship('User')
 
     # currently only bearer is supported
@@ -115,7 +116,11 @@ class Token(db.Model):
     _security_labels = Column('security_labels', Text)
 
     # FHIR Patient id
-    patient_id = Column(String)
+    patient_id = Column(String, index=True)
+
+    # Written behind by auth_proxy.usage
+    last_used = Column(DateTime)
+    request_count = Column(Integer)
 
     def refresh(self, access_token, refresh_token, expires_in, token_type, scope, **kwargs):
         expires = datetime.utcnow() + timedelta(seconds=expires_in)
@@ -126,6 +131,8 @@ class Token(db.Model):
             approval_expires=self.approval_expires,
             _security_labels=self._security_labels,
             patient_id=self.patient_id,
+            last_used=self.last_used,
+            request_count=self.request_count,
             token_type=token_type,
             access_token=access_token,
             refresh_token=refresh_token,
@@ -0,0 +1,68 @@
+# pylint: disable=missing-docstring
+""" Subscription models module """
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    String,
+    Text,
+)
+
+from auth_proxy.extensions import db
+
+
+class Subscription(db.Model):
+    """ A client's interest in changes to some resource types of the patient
+    it was authorized for.
+
+    Subscriptions belong to the client, user and patient of the token that
+    created them rather than to the token, which is replaced whenever it is
+    refreshed. They stop when the client has no valid token left.
+    """
+    __tablename__ = 'subscription'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, nullable=False)
+
+    client_id = Column(String, ForeignKey('client.client_id', ondelete='CASCADE'),
+                       nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    patient_id = Column(String, nullable=False, index=True)
+
+    _resource_types = Column('resource_types', Text, nullable=False)
+
+    # "rest-hook" (POST to endpoint) or "sse" (/api/subscriptions/<id>/events)
+    channel = Column(String, nullable=False)
+    endpoint = Column(String)
+    # Signs rest-hook notifications (X-Signature)
+    secret = Column(String)
+    failures = Column(Integer, default=0)
+
+    @property
+    def resource_types(self):
+        return self._resource_types.split()
+
+    @property
+    def interest(self):
+        return {
+            'id': self.id,
+            'resource_types': self.resource_types,
+            'channel': self.channel,
+            'endpoint': self.endpoint,
+            'created': self.created.isoformat() + 'Z',
+        }
+
+
+class SubscriptionEvent(db.Model):
+    """ A notification, kept for a while for server-sent event streams.
+    """
+    __tablename__ = 'subscription_event'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, nullable=False, index=True)
+
+    subscription_id = Column(Integer, ForeignKey('subscription.id', ondelete='CASCADE'),
+                             nullable=False, index=True)
+    # The notification, as JSON
+    payload = Column(Text, nullable=False)
@@ -0,0 +1,35 @@
+# pylint: disable=missing-docstring
+""" Sync models module """
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    String,
+    Text,
+    UniqueConstraint,
+)
+
+from auth_proxy.extensions import db
+
+
+class SyncCursor(db.Model):
+    """ The last sync cursor handed to a client for a patient's resources
+    of one type, so that it can resume without keeping it.
+    """
+    __tablename__ = 'sync_cursor'
+    __table_args__ = (
+        UniqueConstraint('client_id', 'user_id', 'patient_id', 'resource_type'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    updated = Column(DateTime, nullable=False)
+
+    client_id = Column(String, ForeignKey('client.client_id', ondelete='CASCADE'),
+                       nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    patient_id = Column(String, nullable=False)
+    resource_type = Column(String, nullable=False)
+
+    # Signed; see auth_proxy.services.sync
+    cursor = Column(Text, nullable=False)
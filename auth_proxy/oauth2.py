@@ -2,12 +2,32 @@
 
 The provider that comes with flask_oauthlib enables OpenID Connect, but we
 don't want to support that in this application.
+
+Its request validator also looks a refresh token up twice, once to check
+it and once for its scopes, and fails if the token was rotated or revoked
+in between.
 """
-from flask_oauthlib.provider import OAuth2Provider
+from flask_oauthlib.provider import OAuth2Provider, OAuth2RequestValidator
+from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
+
+
+class PatchedRequestValidator(OAuth2RequestValidator):
+    """Patched version of the OAuth2RequestValidator class."""
+    def get_original_scopes(self, refresh_token, request, *args, **kwargs):
+        """Reject a refresh token that is gone since it was validated, like
+        one that never existed.
+        """
+        tok = self._tokengetter(refresh_token=refresh_token)
+        if tok is None:
+            raise InvalidGrantError(request=request)
+        return tok.scopes
 
 
 class PatchedOAuth2Provider(OAuth2Provider):
     """Patched version of the OAuth2Provider class."""
+    def __init__(self, app=None, validator_class=PatchedRequestValidator):
+        super().__init__(app, validator_class=validator_class)
+
     @property
     def server(self):
         """The default implementation returns a Server endpoint (oauthlib)
@@ -0,0 +1,85 @@
+""" Cache warm-up after token issuance.
+
+Right after getting a token, SMART apps nearly always read the patient and
+then run the standard searches for them. When PREFETCH is enabled, issuing
+a token starts those requests (PREFETCH_QUERIES) in the background, built
+by FlaskClient exactly as the app's own requests will be, security labels
+included. Their responses go into the response cache for PREFETCH_TTL
+seconds, so the app's first requests are cache hits.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+from flask import current_app
+import requests
+
+from auth_proxy.proxy import ForbiddenError, UpstreamError
+from auth_proxy.proxy.cache import cache_key
+from auth_proxy.proxy.flask import FlaskClient
+from auth_proxy.proxy.search import TokenRequest
+
+
+class Prefetcher(object):
+    """ Fetches a token's likely first requests into the response cache.
+    """
+    def __init__(self, proxy_service):
+        self.proxy_service = proxy_service
+        self.counters = Counter()
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def prefetch(self, patient_id, security_labels):
+        """ Start prefetching for a token, unless it was just done.
+        """
+        config = current_app.config
+        if not config['PREFETCH'] or not patient_id:
+            return
+
+        labels = tuple(security_labels)
+        now = time.time()
+        with self._lock:
+            if now - self._recent.get((patient_id, labels), 0) < config['PREFETCH_TTL']:
+                return
+            self._recent = {key: seen for (key, seen) in self._recent.items()
+                            if now - seen < config['PREFETCH_TTL']}
+            self._recent[(patient_id, labels)] = now
+
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        executor = self.executor(config['PREFETCH_WORKERS'])
+        for query in config['PREFETCH_QUERIES']:
+            executor.submit(self._fetch, app, query.format(patient=patient_id),
+                            patient_id, list(labels))
+        self.counters['tokens'] += 1
+
+    def executor(self, workers):
+        """ The thread pool that prefetches in this process.
+        """
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _fetch(self, app, query, patient_id, security_labels):
+        with app.app_context():
+            orig = TokenRequest(query, app.config['PREFETCH_ACCEPT'],
+                                patient_id, security_labels)
+            client = FlaskClient(orig.view_args['path'], orig)
+            try:
+                client.check_request()
+                request = client.request()
+                response = self.proxy_service.server(cached=False).respond(request)
+            except (ForbiddenError, UpstreamError, requests.RequestException):
+                self.counters['errors'] += 1
+                return
+
+            if response['status'] != 200:
+                self.counters['errors'] += 1
+                return
+
+            self.proxy_service.cache.put(cache_key(request), response)
+            self.counters['fetched'] += 1
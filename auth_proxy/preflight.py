@@ -0,0 +1,86 @@
+""" CORS preflight fast path.
+
+Browser SMART apps send an OPTIONS preflight before most API calls, since
+they carry an Authorization header. Flask would build a request context,
+load the session and run every before_request hook for each one only for
+flask_cors to answer it. With CORS_PREFLIGHT on, preflights of /api/ are
+answered by a WSGI middleware in front of Flask instead, with the headers
+flask_cors would send (any origin, any requested header) and an
+Access-Control-Max-Age of CORS_MAX_AGE seconds, so that browsers ask again
+rarely. The headers are built once per set of requested headers.
+
+Other OPTIONS requests, and everything else, go to Flask as usual.
+"""
+import re
+
+PREFIXES = ('/api/',)
+METHODS = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+# Requested header lists are echoed back; anything else isn't.
+HEADER_LIST = re.compile(r'^[A-Za-z0-9!#$%&\'*+.^_`|~, -]*$')
+
+# Distinct sets of requested headers to keep the headers of.
+MAX_HEADER_SETS = 64
+
+
+class Preflight(object):
+    """ Answers CORS preflights of the API without Flask.
+    """
+    def __init__(self, app=None):
+        self.wsgi_app = None
+        self.enabled = False
+        self.max_age = None
+        self._headers = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the settings and wrap the app's WSGI callable.
+        """
+        app.config.setdefault('CORS_PREFLIGHT', True)
+        app.config.setdefault('CORS_MAX_AGE', 86400)
+
+        self.enabled = app.config['CORS_PREFLIGHT']
+        self.max_age = app.config['CORS_MAX_AGE']
+        self._headers = {}
+
+        if 'preflight' not in app.extensions:
+            app.extensions['preflight'] = self
+            self.wsgi_app = app.wsgi_app
+            app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        if not self.enabled or environ.get('REQUEST_METHOD') != 'OPTIONS' or \
+                'HTTP_ORIGIN' not in environ or \
+                'HTTP_ACCESS_CONTROL_REQUEST_METHOD' not in environ or \
+                not environ.get('PATH_INFO', '').startswith(PREFIXES):
+            return self.wsgi_app(environ, start_response)
+
+        requested = environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS', '')
+        headers = self._headers.get(requested)
+        if headers is None:
+            headers = self._build(requested)
+
+        start_response('200 OK', [('Access-Control-Allow-Origin', environ['HTTP_ORIGIN'])] +
+                       headers)
+        return [b'']
+
+    def _build(self, requested):
+        headers = [
+            ('Access-Control-Allow-Methods', METHODS),
+            ('Access-Control-Max-Age', str(self.max_age)),
+            ('Vary', 'Origin'),
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '0'),
+        ]
+        if requested and HEADER_LIST.match(requested):
+            allowed = sorted({name.strip().lower() for name in requested.split(',')
+                              if name.strip()})
+            if allowed:
+                headers.insert(0, ('Access-Control-Allow-Headers', ', '.join(allowed)))
+
+        if len(self._headers) >= MAX_HEADER_SETS:
+            self._headers = {}
+        self._headers[requested] = headers
+        return headers
@@ -0,0 +1,280 @@
+""" On-demand profiling of live requests.
+
+Two kinds of session can be started from the admin blueprint, each for the
+next N requests to one endpoint (or to any endpoint, for allocations):
+
+- A CPU profile. A sampler thread looks at the stacks of the threads that
+  are serving a profiled request every few milliseconds, and counts them
+  as folded stacks ("root;caller;callee count"), the input format of
+  flamegraph.pl and speedscope.
+- An allocation profile. tracemalloc runs for the session, and a snapshot
+  taken before and after each request is compared, so the report shows
+  which lines allocated (and kept) memory, grouped by endpoint.
+
+Sessions are per worker: they profile requests served by the worker that
+received the start request. When no session is running, the cost is one
+attribute check per request.
+"""
+from collections import Counter
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from flask import g, request
+
+CPU = 'cpu'
+ALLOCATIONS = 'allocations'
+
+# Session defaults and limits.
+MAX_REQUESTS = 1000
+MAX_SECONDS = 600
+# The most frames tracemalloc keeps per traceback.
+MAX_FRAMES = 65535
+
+
+class ProfilingError(Exception):
+    """ A profiling session could not be started.
+    """
+    def __init__(self, message):
+        Exception.__init__(self)
+        self.message = message
+
+
+class Session(object):
+    """ One profiling session.
+    """
+    def __init__(self, kind, endpoint, requests, interval=0.005, frames=10):
+        self.kind = kind
+        self.endpoint = endpoint
+        self.remaining = requests
+        self.requests = requests
+        self.interval = interval
+        self.frames = frames
+        self.started = time.time()
+        self.finished = None
+        self.samples = Counter()
+        self.allocations = {}
+        self.threads = set()
+
+    @property
+    def active(self):
+        """ Whether the session still profiles requests.
+        """
+        return self.finished is None
+
+    def matches(self, endpoint):
+        """ Whether a request to endpoint should be profiled.
+        """
+        return self.remaining > 0 and self.endpoint in (None, endpoint)
+
+    def status(self):
+        """ What the session is doing.
+        """
+        return {
+            'kind': self.kind,
+            'endpoint': self.endpoint,
+            'requests': self.requests,
+            'profiled': self.requests - self.remaining,
+            'active': self.active,
+            'started': self.started,
+            'finished': self.finished,
+            'pid': os.getpid(),
+        }
+
+
+class Profiler(object):
+    """ Profiles requests on demand.
+    """
+    def __init__(self, app=None):
+        self.session = None
+        self.results = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Install the request hooks.
+        """
+        if 'profiler' in app.extensions:
+            return
+        app.extensions['profiler'] = self
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def start(self, kind, endpoint, requests, interval=0.005, frames=10):
+        """ Start a session for the next `requests` requests to endpoint.
+
+        Raises:
+            ProfilingError: A session is already running, or the arguments
+                are out of range.
+        """
+        if kind not in (CPU, ALLOCATIONS):
+            raise ProfilingError('Unknown profile "{}".'.format(kind))
+        if kind == CPU and endpoint is None:
+            raise ProfilingError('CPU profiles need an endpoint.')
+        if not 0 < requests <= MAX_REQUESTS:
+            raise ProfilingError('Profile between 1 and {} requests.'.format(MAX_REQUESTS))
+        if not 0.001 <= interval <= 1:
+            raise ProfilingError('The sampling interval must be between 0.001 and 1s.')
+        if not 0 < frames <= MAX_FRAMES:
+            raise ProfilingError('Trace between 1 and {} frames.'.format(MAX_FRAMES))
+
+        with self._lock:
+            if self.session is not None and self.session.active:
+                raise ProfilingError('A {} profile is already running.'.format(
+                    self.session.kind))
+
+            session = Session(kind, endpoint, requests, interval, frames)
+            if kind == ALLOCATIONS:
+                tracemalloc.start(frames)
+            else:
+                thread = threading.Thread(target=self._sample, args=(session,),
+                                          name='profiler')
+                thread.daemon = True
+                thread.start()
+            self.session = session
+
+        return session
+
+    def stop(self):
+        """ End the running session, if any.
+        """
+        with self._lock:
+            session = self.session
+            if session is None or not session.active:
+                return
+            session.finished = time.time()
+            if session.kind == ALLOCATIONS:
+                tracemalloc.stop()
+            self.results[session.kind] = session
+
+    def folded(self):
+        """ The last CPU profile as folded stacks.
+        """
+        session = self._result(CPU)
+        if session is None:
+            return ''
+        return ''.join('{} {:d}\n'.format(stack, count)
+                       for (stack, count) in session.samples.most_common())
+
+    def allocations(self, limit=20):
+        """ The last allocation profile: the top lines of each endpoint.
+        """
+        session = self._result(ALLOCATIONS)
+        if session is None:
+            return {}
+
+        report = {}
+        for endpoint, stats in session.allocations.items():
+            lines = sorted(stats['lines'].items(), key=lambda item: -item[1][0])[:limit]
+            report[endpoint] = {
+                'requests': stats['requests'],
+                'size_diff': stats['size_diff'],
+                'size_per_request': stats['size_diff'] // stats['requests'],
+                'top': [{'line': line, 'size_diff': size, 'count_diff': count}
+                        for (line, (size, count)) in lines],
+            }
+        return report
+
+    def status(self):
+        """ The running or last session of each kind.
+        """
+        status = {kind: session.status() for (kind, session) in self.results.items()}
+        if self.session is not None and self.session.active:
+            status[self.session.kind] = self.session.status()
+        return status
+
+    def _result(self, kind):
+        session = self.session
+        if session is not None and session.kind == kind:
+            return session
+        return self.results.get(kind)
+
+    def _before_request(self):
+        session = self.session
+        if session is None or not session.active:
+            return
+        if time.time() - session.started > MAX_SECONDS:
+            self.stop()
+            return
+
+        with self._lock:
+            if not session.active or not session.matches(request.endpoint):
+                return
+            session.remaining -= 1
+
+        g._profile_session = session
+        if session.kind == CPU:
+            session.threads.add(threading.get_ident())
+        else:
+            g._profile_snapshot = tracemalloc.take_snapshot()
+
+    def _teardown_request(self, exc=None):  # pylint: disable=unused-argument
+        session = g.pop('_profile_session', None)
+        if session is None:
+            return
+
+        if session.kind == CPU:
+            session.threads.discard(threading.get_ident())
+        elif session.active and tracemalloc.is_tracing():
+            self._compare(session, request.endpoint, g.pop('_profile_snapshot'))
+
+        if session.remaining <= 0 and not session.threads:
+            self.stop()
+
+    def _compare(self, session, endpoint, before):
+        after = tracemalloc.take_snapshot()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, __file__)]
+        diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+
+        with self._lock:
+            stats = session.allocations.setdefault(
+                endpoint, {'requests': 0, 'size_diff': 0, 'lines': {}})
+            stats['requests'] += 1
+            for stat in diff:
+                if not stat.size_diff:
+                    continue
+                frame = stat.traceback[0]
+                line = '{}:{}'.format(frame.filename, frame.lineno)
+                size, count = stats['lines'].get(line, (0, 0))
+                stats['lines'][line] = (size + stat.size_diff, count + stat.count_diff)
+                stats['size_diff'] += stat.size_diff
+
+    def _sample(self, session):
+        while session.active:
+            if time.time() - session.started > MAX_SECONDS:
+                self.stop()
+                return
+
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for ident in list(session.threads):
+                frame = frames.get(ident)
+                if frame is not None:
+                    session.samples[_fold(frame)] += 1
+            del frames
+
+            time.sleep(session.interval)
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{:d})'.format(code.co_name, _short(code.co_filename),
+                                           code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _short(filename):
+    marker = 'site-packages' + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    if filename.startswith(os.getcwd()):
+        return os.path.relpath(filename)
+    return filename
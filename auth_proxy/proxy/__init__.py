@@ -7,11 +7,12 @@ class ForbiddenError(Exception):
     """
     msg_tmpl = 'Not allowed to query for "{disallowed}" {part}.'
 
-    def __init__(self, segment=None, parameter=None, method=None):
+    def __init__(self, segment=None, parameter=None, method=None, resource=None):
         Exception.__init__(self)
         self.segment = segment
         self.parameter = parameter
         self.method = method
+        self.resource = resource
 
     @property
     def message(self):
@@ -26,9 +27,33 @@ class ForbiddenError(Exception):
         elif self.method is not None:
             return self.msg_tmpl.format(disallowed=self.method,
                                         part='method')
+        elif self.resource is not None:
+            return self.msg_tmpl.format(disallowed=self.resource,
+                                        part='resource')
         return 'Forbidden'
 
 
+class UpstreamError(Exception):
+    """ Raised when the upstream server is unreachable or unhealthy.
+    """
+    messages = {
+        502: 'The upstream server could not be reached.',
+        503: 'The upstream server is unavailable.',
+        504: 'The upstream server did not respond in time.',
+    }
+
+    def __init__(self, status=503, retry_after=None):
+        Exception.__init__(self)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def message(self):
+        """ Format the message.
+        """
+        return self.messages.get(self.status, 'Upstream error')
+
+
 class Client(object):
     """ A Proxy Client interface.
     """
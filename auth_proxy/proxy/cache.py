@@ -0,0 +1,166 @@
+""" A short-lived cache of upstream responses.
+
+Entries are keyed by the upstream request: method, URL (which includes the
+security labels FlaskClient injects, so a hit can never widen what a token
+may see) and Accept header. Only the prefetcher (auth_proxy.prefetch)
+fills the cache; CachedServer answers matching requests from it until the
+entries expire.
+
+MemoryCache is per worker; SharedCache keeps one file per entry (on
+/dev/shm by default) so every worker on the host sees what any worker
+prefetched.
+"""
+from collections import Counter, OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from . import Server
+
+
+def cache_key(request):
+    """ The cache key of a generic request dict.
+    """
+    headers = request.get('headers') or {}
+    return '{} {} {}'.format(request.get('method'), request.get('url'),
+                             headers.get('Accept', ''))
+
+
+class MemoryCache(object):
+    """ Responses in an LRU dict in this process.
+    """
+    def __init__(self, ttl, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.counters = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ The cached response dict for key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self._entries.pop(key, None)
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            # Callers change the headers of what they get.
+            return dict(entry[1], headers=dict(entry[1]['headers']))
+
+    def put(self, key, response):
+        """ Cache a response dict with a bytes body.
+        """
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.counters['stores'] += 1
+
+    def status(self):
+        """ Size and counters.
+        """
+        return dict(self.counters, entries=len(self._entries))
+
+
+class SharedCache(object):
+    """ Responses as files in a directory shared by all workers.
+
+    The directory must exist and be writable by this user only (see
+    shm.private_directory); files in it are not trusted otherwise.
+    """
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.counters = Counter()
+        self._purged = 0
+
+    def get(self, key):
+        """ The cached response dict for key, or None.
+        """
+        try:
+            with os.fdopen(os.open(self._file(key), os.O_RDONLY | os.O_NOFOLLOW), 'rb') as source:
+                header = json.loads(source.readline().decode('utf-8'))
+                body = source.read()
+        except (OSError, ValueError):
+            self.counters['misses'] += 1
+            return None
+
+        if header['key'] != key or header['expires'] < time.time():
+            self.counters['misses'] += 1
+            return None
+
+        self.counters['hits'] += 1
+        return {
+            'response': body,
+            'status': header['status'],
+            'headers': header['headers'],
+        }
+
+    def put(self, key, response):
+        """ Cache a response dict with a bytes body.
+        """
+        if time.time() - self._purged > self.PURGE_INTERVAL:
+            self._purge()
+
+        header = json.dumps({
+            'key': key,
+            'expires': time.time() + self.ttl,
+            'status': response['status'],
+            'headers': response['headers'],
+        })
+
+        target = self._file(key)
+        temporary = '{}.{}.tmp'.format(target, uuid.uuid4().hex)
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(header.encode('utf-8') + b'\n')
+            out.write(response['response'])
+        os.replace(temporary, target)
+        self.counters['stores'] += 1
+
+    def status(self):
+        """ Counters.
+        """
+        return dict(self.counters)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _purge(self):
+        self._purged = time.time()
+        cutoff = time.time() - self.ttl - self.PURGE_INTERVAL
+        for entry in os.scandir(self.path):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class CachedServer(Server):
+    """ Answers GET requests from `cache`, and the rest from `server`.
+    """
+    def __init__(self, server, cache):
+        self.server = server
+        self.cache = cache
+
+    def respond(self, request):
+        """ @inherit
+        """
+        if request.get('method') == 'GET':
+            response = self.cache.get(cache_key(request))
+            if response is not None:
+                if request.get('stream'):
+                    response['response'] = [response['response']]
+                return response
+
+        return self.server.respond(request)
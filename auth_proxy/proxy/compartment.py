@@ -0,0 +1,169 @@
+""" Patient compartment verification of proxied responses.
+
+Searches carry the token's patient as a _security label, but reads by id
+go upstream as they are, and nothing else stops the upstream server from
+returning another patient's data. CompartmentFilter checks what comes
+back: a resource belongs to the token's patient if it is that Patient, or
+if every subject, patient and beneficiary reference it has points to it.
+Resources without such references (Practitioner, Medication, ...) are not
+in any patient's compartment and pass.
+
+Search Bundles are checked entry by entry as they stream through (see
+jsonstream), and entries of other patients are dropped. A read of another
+patient's resource is refused with a 403; only the few top-level values
+the check needs are decoded.
+
+The _security labels the proxy adds to a search only filter its matches:
+resources added by _include and _revinclude come back whatever their
+labels. An Inclusion describes what those may be, and entries that are
+not marked as matches and are not of an allowed type, or don't carry the
+labels the search asked for, are dropped as well.
+"""
+from collections import Counter
+import logging
+
+from . import ForbiddenError
+from .jsonstream import BundleTransformer, top_level
+
+FIELDS = ('subject', 'patient', 'beneficiary')
+
+LOGGER = logging.getLogger(__name__)
+
+
+def references_patient(reference, patient_id):
+    """ Whether a reference string points to Patient/patient_id.
+    """
+    reference = reference.split('/_history/')[0]
+    target = 'Patient/' + patient_id
+    return reference == target or reference.endswith('/' + target)
+
+
+def belongs(resource, patient_id):
+    """ Whether a resource (or its top-level values) is in the compartment
+    of patient_id.
+    """
+    if resource.get('resourceType') == 'Patient':
+        return resource.get('id') == patient_id
+
+    for field in FIELDS:
+        value = resource.get(field)
+        for reference in value if isinstance(value, list) else [value]:
+            if isinstance(reference, dict) and 'reference' in reference and \
+                    not references_patient(reference['reference'], patient_id):
+                return False
+    return True
+
+
+class Inclusion(object):
+    """ The resources a search may include.
+
+    `labels` is a list of sets of security label codes, one per _security
+    parameter of the search: a resource needs a code of each set.
+    """
+    def __init__(self, resource_types, labels):
+        self.resource_types = resource_types
+        self.labels = labels
+
+    def allows(self, resource):
+        """ Whether an included resource may be returned.
+        """
+        if resource.get('resourceType') not in self.resource_types:
+            return False
+
+        security = (resource.get('meta') or {}).get('security') or []
+        codes = {coding.get('code') for coding in security if isinstance(coding, dict)}
+        return all(codes & labels for labels in self.labels)
+
+
+class CompartmentFilter(object):
+    """ Keeps other patients' resources out of proxied responses.
+    """
+    def __init__(self):
+        self.counters = Counter()
+
+    def verify(self, path, response, patient_id, inclusion=None):
+        """ Check a response dict to a request for path, for the compartment
+        of patient_id (if any) and, with an Inclusion, for included entries
+        it doesn't allow.
+
+        Raises:
+            ForbiddenError: A read returned another patient's resource, or
+                a response that should be checked is not JSON.
+        """
+        if response['status'] != 200:
+            return response
+
+        resource_type = path.split('/')[0]
+        if resource_type == 'metadata':
+            return response
+
+        # Only JSON can be checked. Checked requests ask for JSON, so
+        # anything else came from an upstream that ignored the Accept
+        # header. Binary content has no references and is passed as it is.
+        content_type = response['headers'].get('Content-Type', '')
+        if 'json' not in content_type:
+            if (patient_id is None and inclusion is None) or \
+                    (resource_type == 'Binary' and '/' in path):
+                return response
+            self.counters['refused'] += 1
+            LOGGER.warning('Refused %s as %s', path, content_type)
+            raise ForbiddenError(resource=path)
+
+        body = response['response']
+        if '/' not in path:
+            return self._filter(response, body, patient_id, inclusion)
+
+        if patient_id is None:
+            return response
+
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+            response['response'] = body
+        values = top_level(body.decode('utf-8'), ('resourceType', 'id') + FIELDS)
+        # _history and compartment searches (Patient/x/Observation) answer
+        # a Bundle too, which has no references of its own to check.
+        if values.get('resourceType') == 'Bundle':
+            return self._filter(response, body, patient_id, inclusion)
+
+        self.counters['resources'] += 1
+        if not belongs(values, patient_id):
+            self.counters['refused'] += 1
+            LOGGER.warning('Refused %s outside the compartment of Patient/%s', path, patient_id)
+            raise ForbiddenError(resource=path)
+
+        return response
+
+    def status(self):
+        """ Counters.
+        """
+        return dict(self.counters)
+
+    def _filter(self, response, body, patient_id, inclusion):
+        response['headers'].pop('Content-Length', None)
+        transformer = BundleTransformer(
+            lambda entry: self._check_entry(entry, patient_id, inclusion), rewrite=False)
+        response['response'] = transformer([body] if isinstance(body, bytes) else body)
+        return response
+
+    def _check_entry(self, entry, patient_id, inclusion):
+        resource = entry.get('resource')
+        self.counters['resources'] += 1
+        if resource is None:
+            return entry
+
+        # search.mode is optional, and DSTU2 servers often leave it out:
+        # entries not marked as matches are checked as included ones.
+        if inclusion is not None and (entry.get('search') or {}).get('mode') != 'match':
+            self.counters['included'] += 1
+            if not inclusion.allows(resource):
+                self.counters['excluded'] += 1
+                LOGGER.warning('Dropped included %s/%s', resource.get('resourceType'),
+                               resource.get('id'))
+                return None
+
+        if patient_id is not None and not belongs(resource, patient_id):
+            self.counters['dropped'] += 1
+            LOGGER.warning('Dropped %s/%s outside the compartment of Patient/%s',
+                           resource.get('resourceType'), resource.get('id'), patient_id)
+            return None
+        return entry
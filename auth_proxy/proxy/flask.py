@@ -3,19 +3,23 @@
 from urllib import parse
 
 from . import Client, ForbiddenError
+from .compartment import Inclusion
 
 
 class FlaskClient(Client):
     """ Converts a Flask request object into a generic one.
     """
     allowed_headers = ['Accept', 'Origin']
+    range_headers = ['Range', 'If-Range']
     allowed_args = [
         '_count',
+        '_elements',
         '_format',
         '_lastUpdated',
         'category',
         'patient',
         '_security',
+        '_summary',
         'beneficiary'
     ]
     allowed_methods = ['GET']
@@ -40,12 +44,29 @@ class FlaskClient(Client):
         'Practitioner',
         'Procedure',
     ]
+    # Reads of these may ask for byte ranges (see ranges.py). JSON resources
+    # are left out: a range of one can't be checked against the patient
+    # compartment. DocumentReference content is fetched from Binary.
+    range_resources = [
+        'Binary',
+    ]
+    # Searches may include resources of these types with _include and
+    # _revinclude. Included resources are checked by CompartmentFilter,
+    # since the _security labels of the search don't apply to them.
+    # Medications are only ever reached through a patient's resources.
+    include_args = ['_include', '_revinclude']
+    include_resources = [resource for resource in allowed_resources
+                         if resource not in ('metadata', 'Binary')] + ['Medication']
 
     SECURITY_ARG_NAME = '_security'
+    # CompartmentFilter can only check JSON. Responses it checks are asked
+    # for as JSON whatever the app asked for (see ProxyService.api).
+    JSON_ACCEPT = 'application/json+fhir'
 
-    def __init__(self, url, orig):
-        self.url = url
+    def __init__(self, path, orig):
+        self.url = path
         self.orig = orig
+        self.json_only = False
 
     def request(self):
         """ @inherit
@@ -58,8 +79,16 @@ class FlaskClient(Client):
         if len(path) == 1:
             args = self._get_secure_args(args)
 
+        allowed_headers = self.allowed_headers
+        if self.ranged():
+            allowed_headers = allowed_headers + self.range_headers
+
         headers = {key: val for (key, val) in self.orig.headers.items()
-                            if key in self.allowed_headers}
+                            if key in allowed_headers}
+
+        if self.json_only:
+            args = [arg for arg in args if arg[0] != '_format']
+            headers['Accept'] = self.JSON_ACCEPT
 
         return {
             'headers': headers,
@@ -68,6 +97,30 @@ class FlaskClient(Client):
             'body': self.orig.data,
         }
 
+    def ranged(self):
+        """ Whether the request is a read that may ask for byte ranges.
+        """
+        path = self.orig.view_args.get('path').split('/')
+        return len(path) == 2 and path[0] in self.range_resources
+
+    def inclusion(self):
+        """ The Inclusion of a search that includes resources, or None.
+        """
+        if not any(key in self.include_args for key in self.orig.args):
+            return None
+
+        labels = [set(self._get_scope_security_label().split(',')),
+                  {self._get_patient_security_label()}]
+        return Inclusion(self.include_resources, labels)
+
+    def patient_id(self):
+        """ The patient the access token is scoped to, or None.
+        """
+        try:
+            return self.orig.oauth.access_token.patient_id
+        except AttributeError:
+            return None
+
     def _get_secure_args(self, original_args):
         """
         Strip existing security arguments and apply our own.
@@ -84,17 +137,38 @@ class FlaskClient(Client):
     def check_request(self):
         """ @inherit
         """
+        path = self.orig.view_args.get('path').split('/')
+
         for key in self.orig.args:
-            if key not in self.allowed_args:
+            if key in self.include_args:
+                for value in self.orig.args.getlist(key):
+                    self._check_include(key, value, path)
+            elif key not in self.allowed_args:
                 raise ForbiddenError(parameter=key)
 
         if self.orig.method not in self.allowed_methods:
             raise ForbiddenError(method=self.orig.method)
 
-        path = self.orig.view_args.get('path').split('/')[0]
+        if path[0] not in self.allowed_resources:
+            raise ForbiddenError(segment=path[0])
 
-        if path not in self.allowed_resources:
-            raise ForbiddenError(segment=path)
+    def _check_include(self, key, value, path):
+        """ Allow `_include=Source:param[:Target]` on searches of Source and
+        `_revinclude=Source:param[:Target]` on searches of Target, between
+        include_resources only. Wildcards and :iterate are not allowed.
+        """
+        parts = value.split(':')
+        if len(path) != 1 or len(parts) not in (2, 3) or '*' in parts or not all(parts):
+            raise ForbiddenError(parameter='{}={}'.format(key, value))
+
+        source, target = parts[0], parts[2] if len(parts) == 3 else None
+        if key == '_include':
+            allowed = source == path[0] and target in [None] + self.include_resources
+        else:
+            allowed = source in self.include_resources and target in (None, path[0])
+
+        if not allowed or path[0] not in self.include_resources:
+            raise ForbiddenError(parameter='{}={}'.format(key, value))
 
     def _get_scope_security_label(self):
         """ Determine which categories the client should be allowed to see
@@ -122,3 +196,9 @@ class UnsecureFlaskClient(FlaskClient):
 
     def _get_secure_args(self, original_args):
         return original_args
+
+    def patient_id(self):
+        return None
+
+    def inclusion(self):
+        return None
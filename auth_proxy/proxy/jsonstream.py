@@ -0,0 +1,174 @@
+""" Streaming rewrites of JSON Bundles.
+
+BundleTransformer rewrites the entries of a Bundle as the response streams
+through the proxy, without parsing the whole document. Outside the "entry"
+array it only scans for structure (strings, braces and brackets) and
+passes the text through unchanged. Each entry is parsed on its own with
+the C decoder as soon as it has fully arrived, so only one entry at a time
+is held in memory.
+
+top_level() uses the same scan to pick a few top-level values out of a
+resource without decoding the rest of it.
+"""
+import codecs
+import json
+import re
+
+STRUCTURE = re.compile(r'["{}\[\]]')
+COLON = re.compile(r'\s*:')
+SEPARATOR = re.compile(r'[\s,]*')
+WHITESPACE = re.compile(r'\s*')
+
+DECODER = json.JSONDecoder()
+
+
+class BundleTransformer(object):
+    """ Applies `transform` to every entry of a streamed Bundle.
+
+    `transform` is called with an entry (a dict) and returns the new entry,
+    or None to drop it. With `rewrite` off, the entries it keeps are passed
+    through as they arrived, which saves serializing them again.
+    """
+    def __init__(self, transform, rewrite=True):
+        self.transform = transform
+        self.rewrite = rewrite
+
+    def __call__(self, chunks):
+        """ Transform an iterable of byte chunks; yields byte chunks.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        buf = ''
+        pos = 0        # scanned up to here
+        depth = 0
+        key = None     # the last key seen in the Bundle itself
+        entries = False
+        first = True
+
+        for chunk in chunks:
+            buf += decoder.decode(chunk)
+            out = []
+            emitted = 0
+
+            while True:
+                if entries:
+                    # Between entries: skip separators, then parse an entry.
+                    pos = SEPARATOR.match(buf, pos).end()
+                    if pos == len(buf):
+                        emitted = pos
+                        break
+                    if buf[pos] == '{':
+                        try:
+                            entry, end = DECODER.raw_decode(buf, pos)
+                        except ValueError:
+                            emitted = pos  # the entry continues in the next chunk
+                            break
+                        entry = self.transform(entry)
+                        if entry is not None:
+                            out.append('' if first else ',')
+                            if self.rewrite:
+                                out.append(json.dumps(entry, separators=(',', ':')))
+                            else:
+                                out.append(buf[pos:end])
+                            first = False
+                        pos = emitted = end
+                        continue
+                    # The closing bracket; it and the rest pass through.
+                    entries = False
+                    emitted = pos
+                    pos += 1
+                    continue
+
+                match = STRUCTURE.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                start = match.start()
+                char = match.group()
+
+                if char == '"':
+                    end = string_end(buf, start)
+                    if end < 0:
+                        pos = start  # the string continues in the next chunk
+                        break
+                    if depth == 1:
+                        colon = COLON.match(buf, end)
+                        if colon is None and not buf[end:].strip():
+                            pos = start  # can't tell key from value yet
+                            break
+                        key = buf[start + 1:end - 1] if colon else None
+                    pos = end
+                    continue
+
+                pos = match.end()
+                if char in '{[':
+                    depth += 1
+                    if depth == 2 and char == '[' and key == 'entry':
+                        entries = True
+                        first = True
+                        out.append(buf[emitted:pos])
+                        emitted = pos
+                        depth -= 1  # the entries are consumed whole
+                else:
+                    depth -= 1
+
+            if not entries:
+                out.append(buf[emitted:pos])
+                emitted = pos
+            buf = buf[emitted:]
+            pos -= emitted
+
+            data = ''.join(out)
+            if data:
+                yield data.encode('utf-8')
+
+        buf += decoder.decode(b'', final=True)
+        if buf:
+            yield buf.encode('utf-8')
+
+
+def top_level(text, names):
+    """ The values of the top-level keys `names` of the JSON object in
+    text, as a dict. Nothing else is decoded.
+    """
+    values = {}
+    depth = 0
+    pos = 0
+
+    while True:
+        match = STRUCTURE.search(text, pos)
+        if match is None:
+            return values
+        start = match.start()
+        char = match.group()
+
+        if char == '"':
+            pos = string_end(text, start)
+            if pos < 0:
+                return values
+            if depth == 1:
+                colon = COLON.match(text, pos)
+                if colon is not None and text[start + 1:pos - 1] in names:
+                    value_start = WHITESPACE.match(text, colon.end()).end()
+                    values[text[start + 1:pos - 1]], pos = DECODER.raw_decode(text, value_start)
+            continue
+
+        pos = match.end()
+        depth += 1 if char in '{[' else -1
+
+
+def string_end(text, start):
+    """ The end of the JSON string that starts at text[start], or -1 if it
+    is not complete.
+    """
+    # str.find is much faster than a regular expression on long strings.
+    pos = start + 1
+    while True:
+        quote = text.find('"', pos)
+        if quote < 0:
+            return -1
+        escape = quote
+        while text[escape - 1] == '\\':
+            escape -= 1
+        if (quote - escape) % 2 == 0:
+            return quote + 1
+        pos = quote + 1
@@ -0,0 +1,198 @@
+""" A pool of upstream FHIR server replicas.
+
+Reads go to the healthy replica with the fewest outstanding requests (ties
+go to the lowest recent latency). Writes always go to the first replica,
+API_SERVER. A background thread checks each replica's /metadata every
+UPSTREAM_HEALTH_INTERVAL seconds, and a replica whose circuit breaker is
+open is treated as unhealthy too.
+
+Outstanding counts and latency stats are per worker process.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+
+class LatencyStats(object):
+    """ Recent latencies of one replica.
+    """
+    ALPHA = 0.2
+
+    def __init__(self, size=256):
+        self.count = 0
+        self.errors = 0
+        self.ewma = None
+        self.recent = deque(maxlen=size)
+
+    def record(self, seconds, error=False):
+        """ Record one request.
+        """
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.recent.append(seconds)
+        self.ewma = seconds if self.ewma is None else \
+            self.ALPHA * seconds + (1 - self.ALPHA) * self.ewma
+
+    def percentile(self, fraction):
+        """ A percentile of the recent latencies, in seconds.
+        """
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def status(self):
+        """ The stats, in milliseconds.
+        """
+        def millis(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'ewma_ms': millis(self.ewma),
+            'p50_ms': millis(self.percentile(0.5)),
+            'p95_ms': millis(self.percentile(0.95)),
+            'p99_ms': millis(self.percentile(0.99)),
+        }
+
+
+class Replica(object):
+    """ One upstream FHIR server.
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.outstanding = 0
+        self.healthy = True
+        self.latency = LatencyStats()
+
+    def status(self):
+        """ The replica's load, health and latency.
+        """
+        return dict(self.latency.status(),
+                    base_url=self.base_url,
+                    outstanding=self.outstanding,
+                    healthy=self.healthy)
+
+
+class UpstreamPool(object):
+    """ Chooses a replica for each upstream request.
+    """
+    def __init__(self, base_urls, resilience=None, health_interval=0):
+        self.base_urls = list(base_urls)
+        self.replicas = [Replica(url) for url in self.base_urls]
+        self.resilience = resilience
+        self.health_interval = health_interval
+        self.counters = {'hedges': 0, 'hedge_wins': 0}
+        self._lock = threading.Lock()
+        self._health_pid = None
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def primary(self):
+        """ The replica that takes writes, if any.
+        """
+        return self.replicas[0] if self.replicas else None
+
+    def choose(self, exclude=()):
+        """ The least loaded healthy replica, not in `exclude`.
+
+        Returns None if every replica is excluded.
+        """
+        self._ensure_health_checks()
+
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        if not candidates:
+            return None
+
+        healthy = [replica for replica in candidates if self._is_healthy(replica)]
+
+        return min(healthy or candidates,
+                   key=lambda replica: (replica.outstanding, replica.latency.ewma or 0))
+
+    def available(self):
+        """ How many replicas are healthy.
+        """
+        return sum(1 for replica in self.replicas if self._is_healthy(replica))
+
+    @contextmanager
+    def track(self, replica):
+        """ Count an outstanding request to replica and time it.
+        """
+        with self._lock:
+            replica.outstanding += 1
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+                replica.latency.record(time.perf_counter() - start, error)
+
+    def executor(self):
+        """ The thread pool that sends hedged requests in this process.
+        """
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=2 * len(self.replicas))
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def close(self):
+        """ Stop the health checks and the hedging threads.
+        """
+        self._health_pid = None
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def status(self):
+        """ Per-replica load, health and latency.
+        """
+        return {
+            'replicas': [replica.status() for replica in self.replicas],
+            'counters': dict(self.counters),
+        }
+
+    def _is_healthy(self, replica):
+        if not replica.healthy:
+            return False
+        if self.resilience is None:
+            return True
+        breaker = self.resilience.breakers.get(urlparse(replica.base_url).netloc)
+        return breaker is None or breaker.state != breaker.OPEN
+
+    def _ensure_health_checks(self):
+        # Threads don't survive a fork, so each worker starts its own.
+        if not self.health_interval or len(self.replicas) < 2 \
+                or self._health_pid == os.getpid():
+            return
+        self._health_pid = os.getpid()
+
+        thread = threading.Thread(target=self._check_health, name='upstream-health')
+        thread.daemon = True
+        thread.start()
+
+    def _check_health(self):
+        session = requests.Session()
+        pid = os.getpid()
+
+        while self._health_pid == pid:
+            for replica in self.replicas:
+                try:
+                    response = session.get(replica.base_url + '/metadata',
+                                           headers={'Accept': 'application/json+fhir'},
+                                           timeout=(3.05, 5))
+                    replica.healthy = response.status_code < 500
+                except requests.RequestException:
+                    replica.healthy = False
+            time.sleep(self.health_interval)
@@ -0,0 +1,239 @@
+""" _elements and _summary support.
+
+Clients may ask for a subset of each resource with `_elements` (a list of
+top-level elements) or `_summary` (true, text, data, count or false). When
+the upstream server's CapabilityStatement lists these parameters they are
+passed through. Otherwise the proxy strips them from the upstream request
+and applies them to the response itself. Search Bundles are rewritten
+entry by entry as they stream through (see jsonstream). Every resource that
+was cut down is tagged SUBSETTED, as the FHIR spec asks.
+"""
+import json
+from urllib import parse
+
+from . import Proxy
+from .jsonstream import BundleTransformer
+
+PARAMETERS = ('_elements', '_summary')
+
+SUBSETTED = {
+    'system': 'http://hl7.org/fhir/v3/ObservationValue',
+    'code': 'SUBSETTED',
+}
+
+# Kept by every projection.
+ALWAYS = ('resourceType', 'id', 'meta', 'implicitRules')
+
+# Summary elements (isSummary in the FHIR spec) of the resources we proxy.
+# A trailing "[x]" matches every type of a choice element.
+SUMMARY_ELEMENTS = {
+    'AllergyIntolerance': ['identifier', 'clinicalStatus', 'verificationStatus', 'type',
+                           'category', 'criticality', 'code', 'patient', 'onset[x]'],
+    'Binary': ['contentType', 'securityContext'],
+    'Condition': ['identifier', 'clinicalStatus', 'verificationStatus', 'category',
+                  'severity', 'code', 'bodySite', 'subject', 'patient', 'encounter',
+                  'onset[x]', 'abatement[x]', 'recordedDate'],
+    'Coverage': ['identifier', 'status', 'type', 'policyHolder', 'subscriber',
+                 'subscriberId', 'beneficiary', 'dependent', 'relationship', 'period',
+                 'payor', 'class', 'grouping', 'order', 'network', 'contract'],
+    'DocumentReference': ['masterIdentifier', 'identifier', 'status', 'docStatus', 'type',
+                          'category', 'class', 'subject', 'created', 'date', 'indexed',
+                          'author', 'authenticator', 'custodian', 'relatesTo',
+                          'description', 'securityLabel', 'content', 'context'],
+    'Encounter': ['identifier', 'status', 'class', 'type', 'serviceType', 'priority',
+                  'subject', 'patient', 'episodeOfCare', 'basedOn', 'participant',
+                  'appointment', 'period', 'length', 'reasonCode', 'reasonReference',
+                  'diagnosis', 'account', 'serviceProvider', 'partOf'],
+    'ExplanationOfBenefit': ['identifier', 'status', 'type', 'subType', 'use', 'patient',
+                             'billablePeriod', 'created', 'enterer', 'insurer', 'provider',
+                             'outcome', 'insurance', 'total', 'payment'],
+    'ImagingStudy': ['identifier', 'status', 'modality', 'modalityList', 'subject',
+                     'patient', 'encounter', 'started', 'basedOn', 'referrer',
+                     'interpreter', 'endpoint', 'numberOfSeries', 'numberOfInstances',
+                     'procedureReference', 'procedureCode', 'location', 'reasonCode',
+                     'reasonReference', 'description', 'series'],
+    'Immunization': ['identifier', 'status', 'vaccineCode', 'patient', 'encounter',
+                     'occurrence[x]', 'date', 'primarySource', 'performer'],
+    'MedicationAdministration': ['identifier', 'instantiates', 'partOf', 'status',
+                                 'category', 'medication[x]', 'subject', 'patient',
+                                 'context', 'effective[x]', 'performer', 'request'],
+    'MedicationDispense': ['identifier', 'partOf', 'status', 'medication[x]', 'subject',
+                           'patient', 'context', 'performer', 'authorizingPrescription',
+                           'whenPrepared', 'whenHandedOver'],
+    'MedicationOrder': ['identifier', 'dateWritten', 'status', 'patient', 'prescriber',
+                        'encounter', 'reason[x]', 'medication[x]'],
+    'MedicationRequest': ['identifier', 'status', 'statusReason', 'intent', 'category',
+                          'priority', 'doNotPerform', 'reported[x]', 'medication[x]',
+                          'subject', 'encounter', 'authoredOn', 'requester', 'performer',
+                          'reasonCode', 'reasonReference'],
+    'MedicationStatement': ['identifier', 'basedOn', 'partOf', 'status', 'category',
+                            'medication[x]', 'subject', 'patient', 'context',
+                            'effective[x]', 'dateAsserted', 'informationSource'],
+    'Observation': ['identifier', 'basedOn', 'partOf', 'status', 'category', 'code',
+                    'subject', 'focus', 'encounter', 'effective[x]', 'issued', 'performer',
+                    'value[x]', 'hasMember', 'derivedFrom'],
+    'Patient': ['identifier', 'active', 'name', 'telecom', 'gender', 'birthDate',
+                'deceased[x]', 'address', 'managingOrganization', 'link'],
+    'Practitioner': ['identifier', 'active', 'name', 'telecom', 'address', 'gender',
+                     'birthDate'],
+    'Procedure': ['identifier', 'instantiatesCanonical', 'instantiatesUri', 'basedOn',
+                  'partOf', 'status', 'category', 'code', 'subject', 'encounter',
+                  'performed[x]', 'recorder', 'asserter', 'performer', 'location',
+                  'reasonCode', 'reasonReference', 'bodySite', 'outcome'],
+}
+
+
+class Projection(object):
+    """ The _elements and _summary a client asked for.
+    """
+    def __init__(self, elements=None, summary=None):
+        self.elements = elements
+        self.summary = summary
+
+    @classmethod
+    def from_args(cls, args):
+        """ The projection requested by `args`, or None.
+        """
+        elements = args.get('_elements')
+        summary = args.get('_summary')
+
+        if elements is None and summary in (None, 'false'):
+            return None
+
+        if elements is not None:
+            elements = [element.strip().split('.')[-1]
+                        for element in elements.split(',') if element.strip()]
+
+        return cls(elements, summary)
+
+    @property
+    def parameters(self):
+        """ The parameters in use.
+        """
+        return [name for (name, value) in (('_elements', self.elements),
+                                           ('_summary', self.summary))
+                if value is not None]
+
+    def entry(self, entry):
+        """ Project the resource of a Bundle entry.
+        """
+        if self.summary == 'count':
+            return None
+        if 'resource' in entry:
+            entry['resource'] = self.resource(entry['resource'])
+        return entry
+
+    def resource(self, resource):
+        """ Project one resource.
+        """
+        keep = self._keep(resource.get('resourceType'))
+        if keep is None:
+            return resource
+
+        projected = {key: value for (key, value) in resource.items() if keep(key)}
+        if len(projected) < len(resource):
+            meta = dict(projected.get('meta') or {})
+            meta['tag'] = list(meta.get('tag', [])) + [SUBSETTED]
+            projected['meta'] = meta
+
+        return projected
+
+    def _keep(self, resource_type):
+        # A predicate on element names, or None to keep everything.
+        if self.elements is not None:
+            allowed = set(self.elements)
+            return lambda key: key in ALWAYS or key in allowed
+
+        if self.summary == 'text':
+            return lambda key: key in ALWAYS or key == 'text'
+        if self.summary == 'data':
+            return lambda key: key != 'text'
+        if self.summary == 'true' and resource_type in SUMMARY_ELEMENTS:
+            names = SUMMARY_ELEMENTS[resource_type]
+            plain = {name for name in names if not name.endswith('[x]')}
+            choices = tuple(name[:-3] for name in names if name.endswith('[x]'))
+
+            def keep(key):
+                if key in ALWAYS or key in plain:
+                    return True
+                return any(key.startswith(choice) and key[len(choice):len(choice) + 1].isupper()
+                           for choice in choices)
+
+            return keep
+
+        return None
+
+
+class ProjectingProxy(Proxy):
+    """ A Proxy that applies a Projection to the response itself.
+
+    `check`, if given, is called with the response before it is projected
+    and returns the response to project.
+    """
+    def __init__(self, client, server, projection, check=None):
+        Proxy.__init__(self, client, server)
+        self.projection = projection
+        self.check = check
+
+    def proxy(self):
+        """ @inherit
+        """
+        self.client.check_request()
+
+        request = self.client.request()
+        request['url'] = strip_parameters(request['url'], PARAMETERS)
+        request['stream'] = True
+
+        response = self.server.respond(request)
+        if self.check is not None:
+            response = self.check(response)
+
+        content_type = response['headers'].get('Content-Type', '')
+        if response['status'] != 200 or 'json' not in content_type:
+            return response
+
+        response['headers'].pop('Content-Length', None)
+        if '/' in request['url'].split('?')[0]:
+            body = response['response']
+            if not isinstance(body, bytes):
+                body = b''.join(body)
+            body = json.loads(body.decode('utf-8'))
+            body = self._project(body)
+            response['response'] = json.dumps(body).encode('utf-8')
+        else:
+            transformer = BundleTransformer(self.projection.entry)
+            response['response'] = transformer(response['response'])
+
+        return response
+
+    def _project(self, resource):
+        if resource.get('resourceType') != 'Bundle':
+            return self.projection.resource(resource)
+
+        entries = [self.projection.entry(entry) for entry in resource.get('entry', [])]
+        resource['entry'] = [entry for entry in entries if entry is not None]
+        return resource
+
+
+def strip_parameters(url, names):
+    """ Remove the query parameters called `names` from url.
+    """
+    path, _, query = url.partition('?')
+    args = [(key, val) for (key, val) in parse.parse_qsl(query, keep_blank_values=True)
+            if key not in names]
+    return path + '?' + parse.urlencode(args)
+
+
+def supported_parameters(conformance, resource_type):
+    """ Which of PARAMETERS the CapabilityStatement says are supported for
+    searches on resource_type.
+    """
+    supported = set()
+    for rest in conformance.get('rest', []):
+        params = list(rest.get('searchParam', []))
+        for resource in rest.get('resource', []):
+            if resource.get('type') == resource_type:
+                params.extend(resource.get('searchParam', []))
+        supported.update(param.get('name') for param in params)
+
+    return supported.intersection(PARAMETERS)
@@ -0,0 +1,175 @@
+""" Byte range requests (RFC 7233).
+
+Reads of the resources in FlaskClient.range_resources forward Range and
+If-Range upstream, and their responses are streamed. When the upstream
+server answers 206 itself, the response passes through. When it ignores
+the Range header and sends the whole body, RangeProxy cuts the range out
+of the stream: if the length is known it skips to the first byte, and
+otherwise it spools the body to a temporary file (kept in memory up to
+SPOOL_MEMORY) to learn it. The body is never held whole in memory.
+"""
+import re
+import tempfile
+
+from . import Proxy
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+SPOOL_MEMORY = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header):
+    """ The (first, last) byte positions of a Range header.
+
+    `last` is None for open-ended ranges and `first` is None for suffix
+    ranges ("the last N bytes"). Returns None if the header is missing,
+    malformed or asks for several ranges, which are all served whole.
+    """
+    match = RANGE.match((header or '').strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if first and last and int(last) < int(first):
+        return None
+
+    return (int(first) if first else None, int(last) if last else None)
+
+
+def resolve(byte_range, length):
+    """ The inclusive (start, end) offsets of byte_range in a body of
+    `length` bytes, or None if the range is unsatisfiable.
+    """
+    first, last = byte_range
+    if first is None:
+        if not last or not length:
+            return None
+        return (max(length - last, 0), length - 1)
+
+    if first >= length:
+        return None
+    return (first, length - 1 if last is None else min(last, length - 1))
+
+
+def if_range_matches(value, headers):
+    """ Whether an If-Range header still matches the representation.
+    """
+    if not value:
+        return True
+    if value.startswith('W/'):
+        return False  # weak validators never match
+    if value.startswith('"'):
+        return value == headers.get('ETag')
+    return value == headers.get('Last-Modified')
+
+
+class RangeProxy(Proxy):
+    """ A Proxy that streams the response and serves byte ranges of it.
+    """
+    def proxy(self):
+        """ @inherit
+        """
+        self.client.check_request()
+
+        request = self.client.request()
+        request['stream'] = True
+
+        response = self.server.respond(request)
+        if response['status'] != 200:
+            return response
+
+        response['headers']['Accept-Ranges'] = 'bytes'
+
+        headers = request.get('headers') or {}
+        byte_range = parse_range(headers.get('Range'))
+        if byte_range is None or not if_range_matches(headers.get('If-Range'),
+                                                      response['headers']):
+            return response
+
+        return self._serve_range(response, byte_range)
+
+    @staticmethod
+    def _serve_range(response, byte_range):
+        body = response['response']
+        if isinstance(body, bytes):
+            body = [body]
+
+        length = response['headers'].get('Content-Length')
+        if length is None:
+            spool, length = _spool(body)
+        else:
+            spool, length = None, int(length)
+
+        span = resolve(byte_range, length)
+        if span is None:
+            _close(spool if spool is not None else body)
+            return {
+                'response': b'',
+                'status': 416,
+                'headers': {'Content-Range': 'bytes */{:d}'.format(length)},
+            }
+
+        start, end = span
+        headers = dict(response['headers'])
+        headers['Content-Range'] = 'bytes {:d}-{:d}/{:d}'.format(start, end, length)
+        headers['Content-Length'] = str(end - start + 1)
+
+        if spool is not None:
+            content = _read_file(spool, start, end)
+        else:
+            content = _slice(body, start, end)
+
+        return {
+            'response': content,
+            'status': 206,
+            'headers': headers,
+        }
+
+
+def _spool(chunks):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+    finally:
+        _close(chunks)
+    return spool, spool.tell()
+
+
+def _read_file(spool, start, end):
+    try:
+        spool.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = spool.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        spool.close()
+
+
+def _slice(chunks, start, end):
+    offset = 0
+    try:
+        for chunk in chunks:
+            chunk_end = offset + len(chunk)
+            if chunk_end > start:
+                data = chunk[max(start - offset, 0):end + 1 - offset]
+                if data:
+                    yield data
+            offset = chunk_end
+            if offset > end:
+                break
+    finally:
+        _close(chunks)
+
+
+def _close(resource):
+    close = getattr(resource, 'close', None)
+    if close is not None:
+        close()
@@ -1,29 +1,140 @@
 """ Requests specific implementation of Proxy.
 """
+from concurrent.futures import FIRST_COMPLETED, wait
+import time
+
+from flask import current_app, g, has_request_context
 import requests
 
-from . import Server
+from . import Server, UpstreamError
+from .resilience import IDEMPOTENT_METHODS, Resilience
 
-ALLOWED_HEADERS = ['Content-Type', 'Access-Control-Allow-Origin']
+ALLOWED_HEADERS = [
+    'Content-Type',
+    'Access-Control-Allow-Origin',
+    'Accept-Ranges',
+    'Content-Range',
+    'ETag',
+    'Last-Modified',
+]
+CHUNK_SIZE = 64 * 1024
 
 
 class RequestsServer(Server):
     """ Makes a requests request and returns the response.
+
+    Request URLs are relative to the upstream replica chosen by `pool`.
+    With `hedge_after` set, an idempotent request that has not completed
+    after that many seconds is also sent to a second replica, and the
+    first response wins.
+
+    If the request has 'stream' set, the response body is an iterator of
+    byte chunks instead of bytes, and the upstream Content-Length is kept
+    when it describes those bytes (the body is not content-encoded).
     """
+    def __init__(self, pool, session=None, resilience=None, hedge_after=None):
+        self.pool = pool
+        self.session = session or requests.Session()
+        self.resilience = resilience or Resilience()
+        self.hedge_after = hedge_after
 
     def respond(self, request):
         """ @inherit
         """
-        response = requests.request(method=request.get('method'),
-                                    url=request.get('url'),
-                                    headers=request.get('headers'),
-                                    data=request.get('body'))
+        start = time.perf_counter()
+        if request.get('method') not in IDEMPOTENT_METHODS:
+            response = self._send(self.pool.primary, request)
+        elif self.hedge_after and self.pool.available() > 1:
+            response = self._send_hedged(request)
+        else:
+            response = self._send(self.pool.choose(), request)
+
+        # Time to the response headers, for traffic capture.
+        if has_request_context():
+            g.upstream_seconds = g.get('upstream_seconds', 0.0) + time.perf_counter() - start
 
         headers = {key: val for (key, val) in response.headers.items()
                    if key in ALLOWED_HEADERS}
 
+        if request.get('stream'):
+            content = _iter_and_close(response)
+            if 'Content-Length' in response.headers and \
+                    'Content-Encoding' not in response.headers:
+                headers['Content-Length'] = response.headers['Content-Length']
+        else:
+            content = response.content
+
         return {
-            'response': response.content,
+            'response': content,
             'status': response.status_code,
             'headers': headers,
         }
+
+    def _send(self, replica, request):
+        if replica is None:
+            raise UpstreamError(status=502)
+
+        with self.pool.track(replica):
+            return self.resilience.request(self.session,
+                                           method=request.get('method'),
+                                           url=replica.base_url + '/' + request.get('url'),
+                                           headers=request.get('headers'),
+                                           data=request.get('body'),
+                                           stream=request.get('stream', False))
+
+    def _send_hedged(self, request):
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        executor = self.pool.executor()
+
+        def send(replica):
+            with app.app_context():
+                return self._send(replica, request)
+
+        first = self.pool.choose()
+        futures = {executor.submit(send, first): first}
+
+        done, pending = wait(futures, timeout=self.hedge_after)
+        if not done:
+            second = self.pool.choose(exclude=[first])
+            if second is not None:
+                self.pool.counters['hedges'] += 1
+                futures[executor.submit(send, second)] = second
+            pending = set(futures)
+
+        error = None
+        while done or pending:
+            for future in done:
+                try:
+                    response = future.result()
+                except UpstreamError as err:
+                    error = err
+                    continue
+                if futures[future] is not first:
+                    self.pool.counters['hedge_wins'] += 1
+                # The loser's connection goes back to the pool once it is done.
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(_close_result)
+                return response
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        raise error
+
+
+def _close_result(future):
+    # Close the response of a hedged request that lost, if it got one.
+    try:
+        future.result().close()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+def _iter_and_close(response):
+    # Release the connection as soon as the body is read, or abandoned.
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
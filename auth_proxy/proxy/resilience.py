@@ -0,0 +1,225 @@
+""" Timeouts, retries and circuit breaking for upstream requests.
+
+Every upstream request gets connect and read timeouts. Idempotent requests
+that fail with a connection error, a timeout or a 502/503/504 are retried
+a few times, as long as the process-wide retry budget allows it. Each
+upstream host has a circuit breaker: after enough consecutive failures it
+opens and requests fail fast with a 503 instead of tying up a worker. Once
+the reset timeout has passed, one trial request is let through. If it
+succeeds the breaker closes again.
+
+State is per worker process.
+"""
+from collections import Counter
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from flask import current_app
+import requests
+
+from . import UpstreamError
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+RETRY_STATUSES = (502, 503, 504)
+
+
+class CircuitBreaker(object):
+    """ A circuit breaker for one upstream host.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.counters = Counter()
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a request may be sent now.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.counters['rejected'] += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial = False
+
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    self.counters['rejected'] += 1
+                    return False
+                self._trial = True
+
+            return True
+
+    def count(self, counter):
+        """ Bump one of the counters.
+        """
+        with self._lock:
+            self.counters[counter] += 1
+
+    def retry_after(self):
+        """ Seconds until the breaker lets a trial request through.
+        """
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        """ The upstream answered.
+        """
+        with self._lock:
+            self.counters['successes'] += 1
+            self.failures = 0
+            self._trial = False
+            self.state = self.CLOSED
+
+    def record_failure(self, kind='failures'):
+        """ The upstream failed; `kind` names the counter to bump.
+        """
+        with self._lock:
+            self.counters[kind] += 1
+            self.failures += 1
+            self._trial = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.counters['opened'] += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        """ The breaker state and counters.
+        """
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'retry_after': round(self.retry_after(), 1),
+                'counters': dict(self.counters),
+            }
+
+
+class RetryBudget(object):
+    """ Limits retries to a fraction of all requests.
+
+    Every request deposits `ratio` tokens and every retry withdraws one, so
+    a failing upstream gets at most `ratio` extra load rather than a
+    multiple of it. The budget starts with (and may save up) `minimum`
+    tokens, so a quiet process can still retry.
+    """
+    def __init__(self, ratio, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.balance = minimum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """ Account for a new request.
+        """
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.minimum)
+
+    def withdraw(self):
+        """ Take one retry from the budget. Returns False if it is spent.
+        """
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class Resilience(object):
+    """ Sends upstream requests with timeouts, retries and circuit breakers.
+    """
+    def __init__(self):
+        self.breakers = {}
+        self.budget = None
+        self._lock = threading.Lock()
+
+    def breaker(self, url):
+        """ The circuit breaker for the host serving url.
+        """
+        upstream = urlparse(url).netloc
+        with self._lock:
+            if upstream not in self.breakers:
+                self.breakers[upstream] = CircuitBreaker(
+                    current_app.config['UPSTREAM_BREAKER_THRESHOLD'],
+                    current_app.config['UPSTREAM_BREAKER_RESET'],
+                )
+            return self.breakers[upstream]
+
+    def request(self, session, method, url, **kwargs):
+        """ Send a request with `session`. Returns the response.
+
+        Raises:
+            UpstreamError: The breaker is open, or the upstream could not be
+                reached within its timeouts and retries.
+        """
+        config = current_app.config
+        breaker = self.breaker(url)
+        if self.budget is None:
+            self.budget = RetryBudget(config['UPSTREAM_RETRY_BUDGET'])
+
+        if not breaker.allow():
+            raise UpstreamError(status=503, retry_after=breaker.retry_after())
+
+        breaker.count('requests')
+        timeout = (config['UPSTREAM_CONNECT_TIMEOUT'], config['UPSTREAM_READ_TIMEOUT'])
+        retries = config['UPSTREAM_RETRIES'] if method in IDEMPOTENT_METHODS else 0
+        self.budget.deposit()
+
+        for attempt in range(retries + 1):
+            if attempt:
+                breaker.count('retries')
+                time.sleep(config['UPSTREAM_RETRY_BACKOFF'] * 2 ** (attempt - 1) *
+                           random.uniform(0.5, 1.5))
+
+            error = None
+            try:
+                response = session.request(method=method, url=url, timeout=timeout, **kwargs)
+            except requests.Timeout:
+                breaker.record_failure('timeouts')
+                error = UpstreamError(status=504)
+            except requests.ConnectionError:
+                breaker.record_failure('connection_errors')
+                error = UpstreamError(status=502)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure('server_errors')
+
+            last_attempt = attempt == retries
+            if last_attempt or not breaker.allow() or not self.budget.withdraw():
+                break
+            if error is None:
+                # Retried: give its connection back before waiting.
+                response.close()
+
+        if error is not None:
+            raise error
+        return response
+
+    def status(self):
+        """ Breaker state and counters for every upstream seen so far.
+        """
+        with self._lock:
+            return {upstream: breaker.status()
+                    for (upstream, breaker) in self.breakers.items()}
+
+    def reset(self):
+        """ Forget all breakers and the retry budget.
+        """
+        with self._lock:
+            self.breakers = {}
+            self.budget = None
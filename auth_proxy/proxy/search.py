@@ -0,0 +1,121 @@
+""" Searches the proxy runs itself on behalf of a token.
+
+Subscriptions and sync search a patient's resources without a request from
+the app. patient_search() builds such a search with FlaskClient exactly as
+the app's own searches are built, _security labels included, and
+search_resources() sends it and returns the resources of the Bundle.
+TokenRequest, which stands in for the app's request, is what the
+prefetcher builds its requests with as well.
+"""
+import json
+from urllib import parse
+
+import arrow
+import requests
+from werkzeug.datastructures import MultiDict
+
+from . import UpstreamError
+from .flask import FlaskClient
+
+# The resource types a patient's apps may subscribe to or sync.
+RESOURCE_TYPES = [resource for resource in FlaskClient.allowed_resources
+                  if resource not in ('metadata', 'Binary')]
+
+# The search parameter that picks a patient's resources of a type. Patient
+# searches are narrowed to the patient by the _security label alone.
+PATIENT_PARAMETERS = {'Patient': None, 'Coverage': 'beneficiary'}
+
+
+class PatientRequestError(Exception):
+    """ Raised for invalid requests for a patient's resources.
+    """
+    def __init__(self, description):
+        Exception.__init__(self)
+        self.description = description
+
+    @property
+    def message(self):
+        """ Format the message.
+        """
+        return self.description
+
+
+class _AccessToken(object):
+    # The parts of a Token that FlaskClient reads.
+    def __init__(self, patient_id, security_labels):
+        self.patient_id = patient_id
+        self.security_labels = security_labels
+
+
+class _OAuth(object):
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+
+class TokenRequest(object):
+    """ Just enough of a Flask request for FlaskClient, for a GET the proxy
+    makes itself for a token's patient and security labels.
+    """
+    method = 'GET'
+    data = b''
+
+    def __init__(self, query, accept, patient_id, security_labels):
+        path, _, query_string = query.partition('?')
+        self.view_args = {'path': path}
+        self.args = MultiDict(parse.parse_qsl(query_string, keep_blank_values=True))
+        self.headers = {'Accept': accept}
+        self.oauth = _OAuth(_AccessToken(patient_id, security_labels))
+
+
+def patient_search(resource_type, patient_id, security_labels, args):
+    """ The upstream request for a search of the patient's resources of
+    resource_type with args (a list of pairs).
+
+    Parameters such as _sort are the caller's to add.
+    """
+    args = list(args)
+    parameter = PATIENT_PARAMETERS.get(resource_type, 'patient')
+    if parameter:
+        args.append((parameter, patient_id))
+
+    orig = TokenRequest(resource_type + '?' + parse.urlencode(args),
+                        'application/json+fhir', patient_id, security_labels)
+    return FlaskClient(resource_type, orig).request()
+
+
+def search_resources(server, request):
+    """ Send a search to server, and return the resources of the Bundle.
+
+    Raises:
+        UpstreamError: The search failed or did not return a Bundle.
+    """
+    try:
+        response = server.respond(request)
+        body = response['response']
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+    except requests.RequestException:
+        raise UpstreamError(status=502)
+
+    if response['status'] != 200:
+        raise UpstreamError(status=502)
+
+    try:
+        bundle = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise UpstreamError(status=502)
+    if not isinstance(bundle, dict):
+        raise UpstreamError(status=502)
+
+    return [entry['resource'] for entry in bundle.get('entry') or []
+            if isinstance(entry.get('resource'), dict)]
+
+
+def last_updated(resource):
+    """ When resource was last updated, as a naive UTC datetime, or None.
+    """
+    updated = (resource.get('meta') or {}).get('lastUpdated')
+    try:
+        return arrow.get(updated).to('utc').naive if updated else None
+    except (TypeError, ValueError):
+        return None
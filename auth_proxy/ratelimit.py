@@ -0,0 +1,166 @@
+""" Per-client and per-patient rate limiting.
+
+Each client_id, and each patient_id a token is scoped to, gets a token
+bucket (`rate` requests per second, bursts of up to `burst`) and a cap on
+concurrent requests (`concurrency`). Buckets live in a SharedTable, so the
+limits hold across all the workers on a host.
+
+RATE_LIMITS configures them, for example:
+
+    {
+        "client": {"rate": 20, "burst": 40, "concurrency": 8},
+        "patient": {"rate": 10, "burst": 20, "concurrency": 4},
+        "clients": {"bulk-export": {"rate": 100, "burst": 200, "concurrency": 16}}
+    }
+
+"clients" overrides the client limits of individual clients. A scope with
+no limits, or a limit of 0, is not limited.
+
+A request refused by one limit takes nothing from the other, and holds its
+concurrency slots until its response has been sent, streamed bodies
+included.
+"""
+from functools import wraps
+import time
+
+from flask import make_response, request
+
+from auth_proxy import shm
+
+# The fields of a bucket record.
+TOKENS, UPDATED, INFLIGHT, TOUCHED = range(4)
+
+
+class RateLimitError(Exception):
+    """ Raised when a client or patient is over its limit.
+    """
+    def __init__(self, scope, retry_after):
+        Exception.__init__(self)
+        self.scope = scope
+        self.retry_after = retry_after
+
+    @property
+    def message(self):
+        """ Format the message.
+        """
+        return 'Too many requests for this {}.'.format(self.scope)
+
+
+class RateLimiter(object):
+    """ Token buckets and concurrency caps shared by all workers.
+    """
+    def __init__(self, app=None):
+        self.limits = {}
+        self.stale = None
+        self.table = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the limits and (re)open the shared table.
+        """
+        app.config.setdefault('RATE_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_PATH', shm.table_path('ratelimit'))
+        app.config.setdefault('RATE_LIMIT_SLOTS', 4096)
+        app.config.setdefault('RATE_LIMIT_STALE', 120)
+
+        self.limits = app.config['RATE_LIMITS']
+        self.stale = app.config['RATE_LIMIT_STALE']
+
+        path = app.config['RATE_LIMIT_PATH']
+        if self.table is None or self.table.path != path:
+            if self.table is not None:
+                self.table.close()
+            self.table = shm.SharedTable(path, fields=4, slots=app.config['RATE_LIMIT_SLOTS'])
+
+    def limits_for(self, scope, client_id):
+        """ The limits for scope ('client' or 'patient'), or None.
+        """
+        limits = self.limits.get(scope)
+        if scope == 'client':
+            limits = self.limits.get('clients', {}).get(client_id, limits)
+        return limits or None
+
+    def acquire(self, scope, key, limits):
+        """ Take a token and a concurrency slot from the bucket of key.
+
+        Raises:
+            RateLimitError: The bucket is empty or the cap is reached.
+        """
+        rate = limits.get('rate', 0)
+        burst = limits.get('burst', rate)
+        concurrency = limits.get('concurrency', 0)
+        now = time.time()
+
+        with self.table.locked('{}:{}'.format(scope, key)) as bucket:
+            if rate:
+                if not bucket[UPDATED]:
+                    bucket[TOKENS] = burst
+                elapsed = max(0, now - bucket[UPDATED])
+                bucket[TOKENS] = min(burst, bucket[TOKENS] + elapsed * rate)
+                bucket[UPDATED] = now
+
+            # A worker that died mid-request never released its slot.
+            if now - bucket[TOUCHED] > self.stale:
+                bucket[INFLIGHT] = 0
+
+            if concurrency and bucket[INFLIGHT] >= concurrency:
+                raise RateLimitError(scope, retry_after=1)
+            if rate and bucket[TOKENS] < 1:
+                raise RateLimitError(scope, retry_after=(1 - bucket[TOKENS]) / rate)
+
+            if rate:
+                bucket[TOKENS] -= 1
+            bucket[INFLIGHT] += 1
+            bucket[TOUCHED] = now
+
+    def release(self, scope, key, limits=None):
+        """ Give back the concurrency slot taken by acquire(), and with
+        the limits it was taken with, the token as well.
+        """
+        with self.table.locked('{}:{}'.format(scope, key)) as bucket:
+            bucket[INFLIGHT] = max(0, bucket[INFLIGHT] - 1)
+            bucket[TOUCHED] = time.time()
+            if limits and limits.get('rate'):
+                bucket[TOKENS] = min(limits.get('burst', limits['rate']), bucket[TOKENS] + 1)
+
+    def limit(self, func):
+        """ Decorate an OAuth protected view to apply the limits of the
+        requesting client and of the token's patient.
+        """
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            if not self.limits:
+                return func(*args, **kwargs)
+
+            client_id = request.oauth.client.client_id
+            keys = [('client', client_id),
+                    ('patient', request.oauth.access_token.patient_id)]
+
+            acquired = []
+            try:
+                for scope, key in keys:
+                    limits = self.limits_for(scope, client_id)
+                    if key is not None and limits is not None:
+                        self.acquire(scope, key, limits)
+                        acquired.append((scope, key, limits))
+            except RateLimitError:
+                # Refused: give back everything, tokens included.
+                for scope, key, limits in acquired:
+                    self.release(scope, key, limits)
+                raise
+
+            def release():
+                for scope, key, _ in acquired:
+                    self.release(scope, key)
+
+            try:
+                response = make_response(func(*args, **kwargs))
+            except Exception:
+                release()
+                raise
+            response.call_on_close(release)
+            return response
+
+        return decorated
@@ -0,0 +1,71 @@
+""" Read replica routing.
+
+High-volume, read-only lookups (token validation, client lookups, the
+audit views) can be sent to one or more replica databases configured in
+SQLALCHEMY_REPLICA_URIS. Everything else, and every write, stays on the
+primary database behind `db.session`.
+
+Once the primary session flushes or commits during a request, all later
+reads in that request go to the primary too, so a request always reads
+its own writes.
+"""
+import random
+
+from flask import _app_ctx_stack, current_app, g, has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, orm
+
+
+class ReplicaRouter(object):
+    """ Routes read-only queries to a replica database.
+    """
+    def __init__(self, db, app=None):
+        self.db = db
+        self.session = orm.scoped_session(self._create_session,
+                                          scopefunc=_app_ctx_stack.__ident_func__)
+
+        for name in ('after_flush', 'after_commit', 'after_bulk_delete',
+                     'after_bulk_update'):
+            event.listen(SignallingSession, name, self._stick)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Create an engine for each configured replica.
+        """
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+
+        for engine in app.extensions.get('replicas', []):
+            engine.dispose()
+
+        app.extensions['replicas'] = [create_engine(uri) for uri
+                                      in app.config['SQLALCHEMY_REPLICA_URIS']]
+        app.teardown_appcontext(self._teardown)
+
+    def query(self, *entities):
+        """ Query a replica, or the primary if this request has written.
+        """
+        if not current_app.extensions.get('replicas') or g.get('_replica_sticky'):
+            return self.db.session.query(*entities)
+
+        return self.session.query(*entities)
+
+    def dispose(self, app):
+        """ Close all pooled replica connections, e.g. after a fork.
+        """
+        for engine in app.extensions.get('replicas', []):
+            engine.dispose()
+
+    def _create_session(self):
+        engine = random.choice(current_app.extensions['replicas'])
+        return orm.Session(bind=engine, autoflush=False)
+
+    def _stick(self, session, *args):
+        # pylint: disable=unused-argument
+        if has_app_context():
+            g._replica_sticky = True  # pylint: disable=protected-access
+
+    def _teardown(self, exception):
+        # pylint: disable=unused-argument
+        self.session.remove()
@@ -1,13 +1,19 @@
 # pylint: disable=invalid-name
 ''' The services module.
 '''
-from auth_proxy.extensions import db, login_manager, oauthlib
+from auth_proxy.extensions import db, login_manager, oauthlib, replicas
+from auth_proxy.grants import GrantStore
+from auth_proxy.prefetch import Prefetcher
 from auth_proxy.services.login import LoginService
 from auth_proxy.services.oauth import OAuthService, OAuthServiceError
 from auth_proxy.services.proxy import ProxyService
+from auth_proxy.services.subscription import SubscriptionService
+from auth_proxy.services.sync import SyncService
 
 
 # Create some singletons
-login_service = LoginService(db, login_manager)
-oauth_service = OAuthService(db, oauthlib)
+login_service = LoginService(db, login_manager, replicas)
 proxy_service = ProxyService()
+oauth_service = OAuthService(db, oauthlib, replicas, GrantStore(db), Prefetcher(proxy_service))
+subscription_service = SubscriptionService(db, proxy_service)
+sync_service = SyncService(db, proxy_service)
@@ -8,9 +8,10 @@ from auth_proxy.models.user import User
 class LoginService(object):
     """ Handle all our login operations.
     """
-    def __init__(self, db, login_manager):
+    def __init__(self, db, login_manager, replicas):
         self.db = db
         self.login_manager = login_manager
+        self.replicas = replicas
 
         login_manager.login_view = 'main.login'
         login_manager.user_loader(self.load_user)
@@ -18,7 +19,7 @@ class LoginService(object):
     def load_user(self, user_id):
         """ LoginManager user_loader callback.
         """
-        user = self.db.session.query(User).\
+        user = self.replicas.query(User).\
             filter_by(id=user_id).first()
 
         return user
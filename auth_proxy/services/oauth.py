@@ -1,13 +1,18 @@
 """ OAuth Service module.
 """
+from calendar import timegm
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
+import hmac
 import uuid
 
 import arrow
 import flask_login
+from sqlalchemy import and_, or_, select
 
-from auth_proxy.models.oauth import Client, Grant, Token
+from auth_proxy.extensions import sqlite_concurrency
+from auth_proxy.grants import StoredGrant
+from auth_proxy.models.oauth import Client, Token
 from auth_proxy.models.user import User
 
 
@@ -21,9 +26,17 @@ class OAuthServiceError(Exception):
 class OAuthService(object):
     """ Handle all our oAuth operations.
     """
-    def __init__(self, db, oauth):
+    # Rows per INSERT statement when creating debug tokens in bulk.
+    DEBUG_TOKEN_CHUNK = 1000
+    # Rows per DELETE statement when revoking tokens in bulk.
+    REVOKE_CHUNK = 10000
+
+    def __init__(self, db, oauth, replicas, grants, prefetcher):
         self.db = db
         self.oauth = oauth
+        self.replicas = replicas
+        self.grants = grants
+        self.prefetcher = prefetcher
 
         oauth.clientgetter(self.cb_clientgetter)
         oauth.grantgetter(self.cb_grantgetter)
@@ -31,6 +44,7 @@ class OAuthService(object):
         oauth.tokengetter(self.cb_tokengetter)
         oauth.tokensetter(self.cb_tokensetter)
 
+    @sqlite_concurrency.serialized
     def register(self, redirect_uris, scopes, client_name=None):
         """ Register new clients. See RFC7591.
         """
@@ -85,7 +99,7 @@ class OAuthService(object):
     def audit(self, client_id):
         """ Audit all the tokens available to a client.
         """
-        return self.db.session.query(Token).\
+        return self.replicas.query(Token).\
             filter_by(client_id=client_id)
 
     def authorizations(self):
@@ -93,9 +107,10 @@ class OAuthService(object):
         """
         user = flask_login.current_user
 
-        return self.db.session.query(Token).\
+        return self.replicas.query(Token).\
             filter_by(user_id=user.id)
 
+    @sqlite_concurrency.serialized
     def revoke_token(self, token_id):
         """ Revoke an authorized token.
         """
@@ -104,6 +119,131 @@ class OAuthService(object):
             delete()
         self.db.session.commit()
 
+    @sqlite_concurrency.serialized
+    def revoke_tokens(self, client_id=None, username=None, patient_id=None):
+        """ Revoke every token matching all the given criteria.
+
+        Tokens are deleted REVOKE_CHUNK rows per statement, each chunk in a
+        transaction of its own, so revoking a very large set doesn't hold
+        the write lock for long. Returns the number of tokens revoked.
+        """
+        if not (client_id or username or patient_id):
+            raise OAuthServiceError(
+                'no_criteria',
+                'One of "client_id", "username" or "patient_id" is required.'
+            )
+
+        table = Token.__table__
+        criteria = []
+        if client_id:
+            criteria.append(table.c.client_id == client_id)
+        if username:
+            user = self.db.session.query(User).filter_by(username=username).first()
+            if not user:
+                raise OAuthServiceError(
+                    'no_user',
+                    'Username "{}" not found'.format(username)
+                )
+            criteria.append(table.c.user_id == user.id)
+        if patient_id:
+            criteria.append(table.c.patient_id == patient_id)
+
+        chunk = select([table.c.id]).where(and_(*criteria)).limit(self.REVOKE_CHUNK)
+        revoked = 0
+        while True:
+            result = self.db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+            self.db.session.commit()
+            revoked += result.rowcount
+            if result.rowcount < self.REVOKE_CHUNK:
+                return revoked
+
+    def authenticate_client(self, client_id, client_secret, allowed=None):
+        """ Authenticate a client by its credentials.
+
+        If `allowed` is a non-empty list of client IDs, the client must be
+        one of them.
+        """
+        client = self.cb_clientgetter(client_id) if client_id else None
+
+        # In constant time, so the secret can't be guessed from timings.
+        if not client or not hmac.compare_digest(client.client_secret.encode('utf-8'),
+                                                 (client_secret or '').encode('utf-8')):
+            raise OAuthServiceError(
+                'invalid_client',
+                'Client authentication failed.'
+            )
+
+        if allowed and client.client_id not in allowed:
+            raise OAuthServiceError(
+                'unauthorized_client',
+                'Client "{}" may not use this endpoint.'.format(client_id)
+            )
+
+        return client
+
+    def introspect(self, tokens):
+        """ Introspect a batch of access or refresh tokens. See RFC7662.
+
+        All tokens are resolved with a single query that selects only the
+        columns we report, so no relationships are loaded.
+
+        Returns:
+            A (responses, max_age) tuple. The responses are in the order the
+            tokens were given; max_age is the number of seconds until the
+            first of the active tokens expires, or None if none are active.
+        """
+        rows = self.replicas.query(
+            Token.access_token,
+            Token.refresh_token,
+            Token.token_type,
+            Token.expires,
+            Token.approval_expires,
+            Token._scopes,  # pylint: disable=protected-access
+            Token.client_id,
+            Token.patient_id,
+            User.username,
+        ).\
+            outerjoin(User, Token.user_id == User.id).\
+            filter(or_(Token.access_token.in_(tokens),
+                       Token.refresh_token.in_(tokens)))
+
+        found = {}
+        for row in rows:
+            # Tokens without a refresh token (or not issued yet) have NULLs.
+            if row.access_token is not None:
+                found[row.access_token] = (row, row.expires, row.token_type)
+            if row.refresh_token is not None:
+                found[row.refresh_token] = (row, row.approval_expires, 'refresh_token')
+
+        now = datetime.utcnow()
+        max_age = None
+        responses = []
+
+        for token in tokens:
+            row, expires, token_type = found.get(token, (None, None, None))
+
+            if row is None or expires is None or expires < now:
+                responses.append({'active': False})
+                continue
+
+            remaining = int((expires - now).total_seconds())
+            max_age = remaining if max_age is None else min(max_age, remaining)
+
+            response = {
+                'active': True,
+                'scope': row._scopes or '',  # pylint: disable=protected-access
+                'client_id': row.client_id,
+                'token_type': token_type,
+                'exp': timegm(expires.utctimetuple()),
+                'patient': row.patient_id,
+            }
+            if row.username:
+                response['username'] = row.username
+
+            responses.append(response)
+
+        return responses, max_age
+
     def show_authorize_prompt(self, client_id):
         """ Provide everything necessary to show the authorize prompt.
         """
@@ -116,11 +256,12 @@ class OAuthService(object):
         """ Provide additional credentials required by a SMART token request.
         """
         if grant_type == 'authorization_code':
-            grant = self.db.session.query(Grant).\
-                filter_by(code=code).first()
+            grant = self.grants.get(code)
+            if not grant:
+                return False
             token = self.db.session.query(Token).\
-                filter_by(client=grant.client).\
-                filter_by(user=grant.user).\
+                filter_by(client_id=grant.client_id).\
+                filter_by(user_id=grant.user_id).\
                 first()
         elif grant_type == 'refresh_token':
             token = self.db.session.query(Token).\
@@ -135,18 +276,18 @@ class OAuthService(object):
             'patient': token.patient_id,
         }
 
+    @sqlite_concurrency.serialized
     def create_authorization(self, client_id, expires, security_labels, user, patient_id):
-        """ Creates the initial authorization token.
+        """ Creates the initial authorization token, replacing the client's
+        tokens in the same transaction.
         """
-        old = self.db.session.query(Token).\
+        self.db.session.query(Token).\
             filter_by(client_id=client_id).\
-            all()
-        for token in old:
-            self.db.session.delete(token)
+            delete(synchronize_session=False)
 
         token = Token(
             client_id=client_id,
-            user=user,
+            user_id=user.id,
             approval_expires=arrow.get(expires).datetime,
             _security_labels=security_labels,
             patient_id=patient_id,
@@ -158,19 +299,19 @@ class OAuthService(object):
     def cb_clientgetter(self, client_id):
         """ OAuth2Provider Client getter.
         """
-        return self.db.session.query(Client).\
+        return self.replicas.query(Client).\
             filter_by(client_id=client_id).first()
 
     def cb_grantgetter(self, client_id, code):
         """ OAuth2Provider Grant getter.
+
+        The first lookup uses up the code; see auth_proxy.grants.
         """
-        now = datetime.now()
+        grant = self.grants.get(code)
+        if grant is None or grant.client_id != client_id or grant.expired:
+            return None
 
-        return self.db.session.query(Grant).filter(
-            Grant.client_id == client_id,
-            Grant.code == code,
-            Grant.expires >= now,
-        ).first()
+        return grant
 
     def cb_grantsetter(self, client_id, code, request, *args, **kwargs):
         """ OAuth2Provider Grant setter.
@@ -180,17 +321,16 @@ class OAuthService(object):
 
         assert user is not None
 
-        grant = Grant(
+        grant = StoredGrant(
             client_id=client_id,
-            user=user,
             code=code['code'],
+            user_id=user.id,
             redirect_uri=request.redirect_uri,
-            _scopes=' '.join(request.scopes),
-            expires=expires
+            scopes=request.scopes,
+            expires=expires,
         )
 
-        self.db.session.add(grant)
-        self.db.session.commit()
+        self.grants.save(grant)
 
         return grant
 
@@ -198,12 +338,13 @@ class OAuthService(object):
         """ OAuth2Provider Token getter.
         """
         if access_token:
-            return self.db.session.query(Token).\
+            return self.replicas.query(Token).\
                 filter_by(access_token=access_token).first()
         elif refresh_token:
-            return self.db.session.query(Token).\
+            return self.replicas.query(Token).\
                 filter_by(refresh_token=refresh_token).first()
 
+    @sqlite_concurrency.serialized
     def cb_tokensetter(self, token, request, *args, **kwargs):
         """ OAuth2Provider Token setter.
 
@@ -211,9 +352,15 @@ class OAuthService(object):
             token : dict
             request : oauthlib.Request
 
-        Retrieve all unexpired tokens, and update the one with the latest
-        approval expiration time; delete the remainder. See
+        Replace the refreshed token (for a code, the unexpired token with
+        the latest approval expiration time) and delete the client's other
+        tokens. See
         https://github.com/sync-for-science/auth-proxy/issues/45 for details.
+
+        The replaced token is claimed with a conditional DELETE first. Of
+        concurrent refreshes of one token, or a refresh racing a revocation
+        or a new authorization, only one can claim it; the others fail with
+        invalid_grant instead of minting a second token.
         """
         assert request.user is not None
 
@@ -221,77 +368,50 @@ class OAuthService(object):
 
         old_tokens = self.db.session.query(Token).\
             filter_by(client_id=request.client.client_id).\
-            filter(Token.approval_expires >= today).\
-            order_by(Token.approval_expires)
-
-        # use the token with latest approval expires date
-        new = old_tokens[-1].refresh(**token)
+            filter(Token.approval_expires >= today)
+        if request.grant_type == 'refresh_token':
+            old = old_tokens.filter_by(refresh_token=request.refresh_token).first()
+        else:
+            old = old_tokens.order_by(Token.approval_expires.desc()).first()
+
+        # By refresh token too: a deleted token's id may be reused.
+        claimed = old is not None and self.db.session.query(Token).\
+            filter_by(id=old.id).\
+            filter(Token.refresh_token.is_(None) if old.refresh_token is None
+                   else Token.refresh_token == old.refresh_token).\
+            delete(synchronize_session=False)
+        if not claimed:
+            self.db.session.rollback()
+            raise OAuthServiceError('invalid_grant',
+                                    'The grant was already used or has been revoked.')
 
-        for old in old_tokens:
-            self.db.session.delete(old)
+        self.db.session.query(Token).\
+            filter_by(client_id=request.client.client_id).\
+            delete(synchronize_session=False)
 
+        new = old.refresh(**token)
+        # The new row may reuse the old one's id.
+        self.db.session.expunge(old)
         self.db.session.add(new)
+        # Read before the commit expires them: the row may be gone by then.
+        patient_id, security_labels = new.patient_id, new.security_labels
         self.db.session.commit()
 
+        self.prefetcher.prefetch(patient_id, security_labels)
+
         return new
 
+    @sqlite_concurrency.serialized
     def create_debug_token(self, client_id, access_lifetime, approval_expires, scopes, user, patient_id):
 
-        if not user:
-            raise OAuthServiceError(
-                'no_user',
-                '"username" is required.'
-            )
-
-        creating_user = User.query.filter_by(username=user).first()
-        if not creating_user:
-            raise OAuthServiceError(
-                'no_user',
-                'Username "{}" not found'.format(user)
-            )
-
-        if not client_id:
-            raise OAuthServiceError(
-                'no_client',
-                '"client_id" is required.'
-            )
-
-        client = Client.query.filter_by(client_id=client_id).first()
-        if not client:
-            raise OAuthServiceError(
-                'no_client',
-                'Client ID "{}" not found.'.format(client_id)
-            )
-
-        if not patient_id:
-            raise OAuthServiceError(
-                'no_patient',
-                '"patient_id" is required.'
-            )
-
-        # ensure the patient belongs to the user
-        if not creating_user.patient(patient_id):
-            raise OAuthServiceError(
-                'no_patient_for_user',
-                'Patient ID "{}" does not belong to user "{}"'.format(patient_id, user)
-            )
-
-        try:
-            access_lifetime = int(access_lifetime)
-        except ValueError:
-            raise OAuthServiceError(
-                'malformed_lifetime',
-                'Access token lifetime should be an integer.'
-            )
-
-        try:
-            approval_expires = datetime.fromtimestamp(int(approval_expires))
-        except ValueError:
-            raise OAuthServiceError(
-                'malformed_expiration',
-                'Approval expiration time should be a Unix timestamp.'
-            )
+        checker = DebugTokenChecker()
+        creating_user = checker.user(user)
+        client = checker.client(client_id)
+        checker.patient(creating_user, patient_id)
+        access_lifetime = checker.lifetime(access_lifetime)
+        approval_expires = checker.approval_expires(approval_expires)
 
+        scopes = checker.scopes(scopes)
         if scopes is None:
             scopes = ' '.join(client.default_scopes)
 
@@ -324,6 +444,177 @@ class OAuthService(object):
 
         return new
 
+    @sqlite_concurrency.serialized
+    def create_debug_tokens(self, specs):
+        """ Create many debug tokens in one transaction.
+
+        Each spec is a dict of create_debug_token() arguments. Clients,
+        users and patients are looked up once per distinct value, and
+        every spec is checked before anything is written. Returns a list
+        of (access_token, refresh_token) pairs in spec order.
+        """
+        checker = DebugTokenChecker()
+        now = datetime.utcnow()
+        rows = []
+
+        for spec in specs:
+            if not isinstance(spec, dict):
+                raise OAuthServiceError(
+                    'malformed_token',
+                    'Each token should be an object.'
+                )
+
+            user = checker.user(spec.get('user'))
+            client = checker.client(spec.get('client_id'))
+            checker.patient(user, spec.get('patient_id'))
+            scopes = checker.scopes(spec.get('scopes'))
+            if scopes is None:
+                scopes = ' '.join(client.default_scopes)
+
+            # The same columns as Token.refresh() sets.
+            rows.append({
+                'client_id': client.client_id,
+                'user_id': user.id,
+                'token_type': 'Bearer',
+                'access_token': str(uuid.uuid4()),
+                'refresh_token': str(uuid.uuid4()),
+                'expires': now + timedelta(seconds=checker.lifetime(spec.get('access_lifetime'))),
+                'approval_expires': checker.approval_expires(spec.get('approval_expires')),
+                'scopes': scopes,
+                'security_labels': None,
+                'patient_id': spec.get('patient_id'),
+            })
+
+        for start in range(0, len(rows), self.DEBUG_TOKEN_CHUNK):
+            self.db.session.execute(Token.__table__.insert(),
+                                    rows[start:start + self.DEBUG_TOKEN_CHUNK])
+        self.db.session.commit()
+
+        return [(row['access_token'], row['refresh_token']) for row in rows]
+
+
+class DebugTokenChecker(object):
+    """ Validates debug token arguments, remembering what it has looked up.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._users = {}
+        self._patients = set()
+        self._lifetimes = {}
+        self._approvals = {}
+
+    def client(self, client_id):
+        """ The Client called client_id.
+        """
+        _check_string('client_id', client_id)
+        if client_id not in self._clients:
+            if not client_id:
+                raise OAuthServiceError(
+                    'no_client',
+                    '"client_id" is required.'
+                )
+
+            client = Client.query.filter_by(client_id=client_id).first()
+            if not client:
+                raise OAuthServiceError(
+                    'no_client',
+                    'Client ID "{}" not found.'.format(client_id)
+                )
+            self._clients[client_id] = client
+
+        return self._clients[client_id]
+
+    def user(self, username):
+        """ The User called username.
+        """
+        _check_string('username', username)
+        if username not in self._users:
+            if not username:
+                raise OAuthServiceError(
+                    'no_user',
+                    '"username" is required.'
+                )
+
+            user = User.query.filter_by(username=username).first()
+            if not user:
+                raise OAuthServiceError(
+                    'no_user',
+                    'Username "{}" not found'.format(username)
+                )
+            self._users[username] = user
+
+        return self._users[username]
+
+    def patient(self, user, patient_id):
+        """ Check that patient_id belongs to user.
+        """
+        _check_string('patient_id', patient_id)
+        if (user.id, patient_id) in self._patients:
+            return
+
+        if not patient_id:
+            raise OAuthServiceError(
+                'no_patient',
+                '"patient_id" is required.'
+            )
+
+        if not user.patient(patient_id):
+            raise OAuthServiceError(
+                'no_patient_for_user',
+                'Patient ID "{}" does not belong to user "{}"'.format(patient_id, user.username)
+            )
+        self._patients.add((user.id, patient_id))
+
+    def lifetime(self, access_lifetime):
+        """ The access token lifetime in seconds.
+        """
+        # Lists and objects can't be looked up either (TypeError).
+        try:
+            if access_lifetime not in self._lifetimes:
+                self._lifetimes[access_lifetime] = int(access_lifetime)
+        except (TypeError, ValueError, OverflowError):
+            raise OAuthServiceError(
+                'malformed_lifetime',
+                'Access token lifetime should be an integer.'
+            )
+
+        return self._lifetimes[access_lifetime]
+
+    def approval_expires(self, approval_expires):
+        """ The approval expiry as a datetime.
+        """
+        try:
+            if approval_expires not in self._approvals:
+                self._approvals[approval_expires] = datetime.fromtimestamp(int(approval_expires))
+        except (TypeError, ValueError, OverflowError, OSError):
+            raise OAuthServiceError(
+                'malformed_expiration',
+                'Approval expiration time should be a Unix timestamp.'
+            )
+
+        return self._approvals[approval_expires]
+
+    @staticmethod
+    def scopes(scopes):
+        """ The space separated scopes, or None for the client's defaults.
+        """
+        if scopes is not None and not isinstance(scopes, str):
+            raise OAuthServiceError(
+                'malformed_scope',
+                '"scope" should be a space separated string.'
+            )
+
+        return scopes
+
+
+def _check_string(name, value):
+    # Lookups by lists or objects would fail with a TypeError.
+    if value is not None and not isinstance(value, str):
+        raise OAuthServiceError(
+            'malformed_{}'.format(name),
+            '"{}" should be a string.'.format(name)
+        )
+
 
 def validate_redirect_uri(uri):
     result = urlparse(uri)
@@ -1,29 +1,110 @@
 """ Services module.
 """
+import json
+import time
+
+from flask import current_app
 import requests
 
-from auth_proxy.proxy import Proxy
+from auth_proxy import fork, shm
+from auth_proxy.proxy import Proxy, UpstreamError
+from auth_proxy.proxy.cache import CachedServer, MemoryCache, SharedCache
+from auth_proxy.proxy.compartment import CompartmentFilter
 from auth_proxy.proxy.flask import FlaskClient
+from auth_proxy.proxy.pool import UpstreamPool
+from auth_proxy.proxy.projection import Projection, ProjectingProxy, supported_parameters
+from auth_proxy.proxy.ranges import RangeProxy
 from auth_proxy.proxy.requests import RequestsServer
+from auth_proxy.proxy.resilience import Resilience
 
 
 class ProxyService(object):
     """ Handle proxying the FHIR API."""
     def __init__(self):
         self.default_client_factory = FlaskClient
+        self.session = requests.Session()
+        self.resilience = Resilience()
+        self.compartments = CompartmentFilter()
+        self._pool = None
+        self._capabilities = (None, 0, None)
+        self._cache = None
+        self._cache_config = None
+
+        fork.after_fork(self.reset_session)
+
+    def reset_session(self):
+        """ Start a new HTTP session, dropping any pooled connections.
+        """
+        self.session = requests.Session()
+
+    @property
+    def pool(self):
+        """ The upstream pool for the configured API servers.
+        """
+        config = current_app.config
+        base_urls = [url for url in [config['API_SERVER']] + config['API_SERVER_REPLICAS']
+                     if url]
+
+        if self._pool is None or self._pool.base_urls != base_urls:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = UpstreamPool(base_urls, self.resilience,
+                                      config['UPSTREAM_HEALTH_INTERVAL'])
 
-    def conformance(self, url, extensions=None):
+        return self._pool
+
+    @property
+    def cache(self):
+        """ The response cache filled by the prefetcher.
+        """
+        config = current_app.config
+        cache_config = (config['PREFETCH_CACHE'], config['PREFETCH_CACHE_PATH'],
+                        config['PREFETCH_TTL'])
+
+        if self._cache is None or self._cache_config != cache_config:
+            kind, path, ttl = cache_config
+            if kind == 'memory':
+                self._cache = MemoryCache(ttl)
+            else:
+                self._cache = SharedCache(
+                    shm.private_directory(path or shm.default_path('cache')), ttl)
+            self._cache_config = cache_config
+
+        return self._cache
+
+    def server(self, cached=True):
+        """ A Server for the upstream pool, answering from the response
+        cache when prefetching is enabled.
+        """
+        server = RequestsServer(self.pool, self.session, self.resilience,
+                                current_app.config['UPSTREAM_HEDGE_AFTER'])
+
+        if cached and current_app.config['PREFETCH']:
+            server = CachedServer(server, self.cache)
+
+        return server
+
+    def status(self):
+        """ Upstream breakers, replica stats and cache counters.
+        """
+        status = {
+            'breakers': self.resilience.status(),
+            'pool': self.pool.status(),
+            'compartment': self.compartments.status(),
+        }
+        if current_app.config['PREFETCH']:
+            status['cache'] = self.cache.status()
+
+        return status
+
+    def conformance(self, extensions=None):
         """ Proxy the conformance statement.
         We need to set the oAuth uris extension though.
         """
         if not extensions:
             extensions = []
 
-        headers = {
-            'Accept': 'application/json+fhir',
-        }
-        response = requests.get(url, headers=headers)
-        conformance = response.json()
+        conformance = self._fetch_conformance()
 
         extension = {
             'url': 'http://fhir-registry.smarthealthit.org/StructureDefinition/oauth-uris',
@@ -51,15 +132,109 @@ class ProxyService(object):
 
         return conformance
 
-    def api(self, url, request, client_factory=None):
+    def capabilities(self):
+        """ The upstream conformance statement, cached for a while.
+        """
+        base_urls, expires, conformance = self._capabilities
+        if base_urls != self.pool.base_urls or time.time() >= expires:
+            conformance = self._fetch_conformance()
+            ttl = current_app.config['CAPABILITY_CACHE_TTL']
+            self._capabilities = (self.pool.base_urls, time.time() + ttl, conformance)
+
+        return conformance
+
+    def projects(self, resource_type, projection):
+        """ Whether the upstream applies projection itself.
+        """
+        mode = current_app.config['UPSTREAM_PROJECTION']
+        if mode != 'auto':
+            return mode == 'upstream'
+
+        try:
+            conformance = self.capabilities()
+        except (UpstreamError, ValueError):
+            return False
+
+        supported = supported_parameters(conformance, resource_type)
+        return supported.issuperset(projection.parameters)
+
+    def api(self, path, request, client_factory=None):
         """ Proxy FHIR API requests.
         """
         client_factory = client_factory or self.default_client_factory
-        client = client_factory(url, request)
-        server = RequestsServer()
-        proxy = Proxy(client, server)
+        client = client_factory(path, request)
+        projection = Projection.from_args(request.args)
+
+        # Included resources are always checked; see CompartmentFilter.
+        patient_id = client.patient_id() if current_app.config['COMPARTMENT_CHECK'] else None
+        inclusion = client.inclusion()
+        # The check reads JSON only; Binary content is passed as it is.
+        client.json_only = bool(patient_id or inclusion is not None) and not client.ranged()
+
+        def check(response):
+            if patient_id or inclusion is not None:
+                return self.compartments.verify(path, response, patient_id, inclusion)
+            return response
+
+        # A projection may drop the references the compartment check reads,
+        # so responses it applies to are projected here, after the check.
+        if projection is not None and \
+                (patient_id or not self.projects(path.split('/')[0], projection)):
+            return ProjectingProxy(client, self.server(), projection, check).proxy()
+
+        if client.ranged():
+            proxy = RangeProxy(client, self.server())
+        else:
+            proxy = Proxy(client, self.server())
+
+        return check(proxy.proxy())
+
+    def delegate(self, path, request, client_factory=None):
+        """ Where a front proxy may fetch a FHIR API request from itself: a
+        dict with the upstream `url` and its `path` relative to the FHIR
+        server's base URL. None if the response has to pass through the
+        proxy.
+
+        Range reads, and searches when the compartment check is off, only
+        need the query the proxy rewrites. The CapabilityStatement,
+        includes, local projection and whatever the compartment check
+        applies to need the response.
+
+        Raises:
+            ForbiddenError: As api() would.
+        """
+        client_factory = client_factory or self.default_client_factory
+        client = client_factory(path, request)
+        client.check_request()
+
+        resource_type = path.split('/')[0]
+        projection = Projection.from_args(request.args)
+
+        if resource_type == 'metadata' or client.inclusion() is not None:
+            return None
+        if projection is not None and not self.projects(resource_type, projection):
+            return None
+        if not client.ranged() and client.patient_id() and \
+                current_app.config['COMPARTMENT_CHECK']:
+            return None
+
+        path = client.request()['url']
+        return {
+            'url': self.pool.choose().base_url + '/' + path,
+            'path': path,
+        }
+
+    def _fetch_conformance(self):
+        headers = {
+            'Accept': 'application/json+fhir',
+        }
+        response = self.server().respond({
+            'method': 'GET',
+            'url': 'metadata',
+            'headers': headers,
+        })
 
-        return proxy.proxy()
+        return json.loads(response['response'].decode('utf-8'))
 
 
 def configure(binder):
@@ -0,0 +1,512 @@
+""" Change notifications.
+
+Apps that want to know about new data for their patient subscribe to
+resource types instead of polling the FHIR API. One process per host (the
+one holding the lock at SUBSCRIPTION_LOCK_PATH) watches the FHIR server
+for all of them: every SUBSCRIPTION_POLL_INTERVAL seconds it runs one
+_lastUpdated search per patient and resource type that anyone subscribed
+to, however many subscriptions there are, and at most
+SUBSCRIPTION_MAX_POLLS searches per round. Searches are sorted by
+_lastUpdated; when one fills a page of SUBSCRIPTION_PAGE_SIZE, the next
+starts from the newest resource it returned rather than from the time it
+ran.
+
+The search is built by FlaskClient for the union of the subscribers'
+security labels. Each subscriber is then told only about the resources its
+own token may read: the resource must carry its labels and belong to its
+patient, as CompartmentFilter checks. Notifications hold resource ids, not
+content; apps fetch the resources through the API with their token. A
+subscription ends when its client has no valid token for the patient left.
+
+Notifications are POSTed to the app (rest-hook, signed with the
+subscription's secret in X-Signature) or kept in the subscription_event
+table for SUBSCRIPTION_EVENT_TTL seconds, where the server-sent event
+stream of any worker picks them up (sse). A stream holds its worker, so
+only SUBSCRIPTION_MAX_STREAMS of them are open on a host at once; each
+holds the lock of a slot file, which goes away with its worker. Webhook endpoints must be https
+URLs of public addresses, unless SUBSCRIPTION_LOCAL_ENDPOINTS is set for
+development. Notifications are sent to the address that was checked, with
+the endpoint's host name for Host, SNI and the certificate, so the name
+can't point somewhere else in between.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import fcntl
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib import parse
+import uuid
+
+from flask import current_app
+import requests
+from sqlalchemy import and_
+
+from auth_proxy import fork, shm
+from auth_proxy.extensions import sqlite_concurrency
+from auth_proxy.models.oauth import Token
+from auth_proxy.models.subscription import Subscription, SubscriptionEvent
+from auth_proxy.proxy import UpstreamError
+from auth_proxy.proxy.compartment import Inclusion, belongs
+from auth_proxy.proxy.search import (
+    PatientRequestError,
+    RESOURCE_TYPES,
+    last_updated,
+    patient_search,
+    search_resources,
+)
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+LOG = logging.getLogger(__name__)
+
+CHANNELS = ('rest-hook', 'sse')
+
+# Overlap between polls, for resources committed while the last one ran.
+SKEW = timedelta(seconds=5)
+
+# Seconds between keep-alive comments on event streams.
+HEARTBEAT = 15
+
+
+class SubscriptionError(PatientRequestError):
+    """ Raised for invalid subscription requests.
+    """
+
+
+class SubscriptionService(object):
+    """ Manages subscriptions and watches the FHIR server for them.
+    """
+    def __init__(self, db, proxy_service):
+        self.db = db
+        self.proxy_service = proxy_service
+        self.counters = Counter()
+        self._watermarks = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._leader = None
+        self._pid = None
+
+        fork.after_fork(self._forget)
+
+    def init_app(self, app):
+        """ Read the settings, and start watching from the first request of
+        each worker.
+        """
+        app.config.setdefault('SUBSCRIPTIONS', False)
+        app.config.setdefault('SUBSCRIPTION_POLL_INTERVAL', 30.0)
+        app.config.setdefault('SUBSCRIPTION_MAX_POLLS', 100)
+        app.config.setdefault('SUBSCRIPTION_PAGE_SIZE', 100)
+        app.config.setdefault('SUBSCRIPTION_MAX_FAILURES', 10)
+        app.config.setdefault('SUBSCRIPTION_EVENT_TTL', 3600)
+        app.config.setdefault('SUBSCRIPTION_STREAM_INTERVAL', 2.0)
+        app.config.setdefault('SUBSCRIPTION_STREAM_TIMEOUT', 300)
+        app.config.setdefault('SUBSCRIPTION_MAX_STREAMS',
+                              max(1, (uwsgi.numproc if uwsgi else 4) // 4))
+        app.config.setdefault('SUBSCRIPTION_LOCAL_ENDPOINTS', False)
+        if not app.config.get('SUBSCRIPTION_LOCK_PATH'):
+            app.config['SUBSCRIPTION_LOCK_PATH'] = shm.table_path('subscriptions.lock')
+
+        if 'subscriptions' not in app.extensions:
+            app.extensions['subscriptions'] = self
+            app.before_request(self._start)
+
+    @sqlite_concurrency.serialized
+    def create(self, token, resource_types, channel, endpoint=None):
+        """ Subscribe the token's client to changes to resource_types of
+        the token's patient.
+        """
+        if not token.patient_id:
+            raise SubscriptionError('Subscriptions need a token for a patient.')
+        if not resource_types or not isinstance(resource_types, list) or \
+                not set(resource_types) <= set(RESOURCE_TYPES):
+            raise SubscriptionError('"resource_types" must list some of: {}.'.format(
+                ', '.join(RESOURCE_TYPES)))
+        if channel not in CHANNELS:
+            raise SubscriptionError('"channel" must be one of: {}.'.format(', '.join(CHANNELS)))
+
+        if channel == 'rest-hook':
+            if not isinstance(endpoint, str) or self._address(endpoint) is None:
+                raise SubscriptionError('"endpoint" must be an https URL of a public host.')
+        else:
+            endpoint = None
+
+        subscription = Subscription(
+            created=datetime.utcnow(),
+            client_id=token.client_id,
+            user_id=token.user_id,
+            patient_id=token.patient_id,
+            _resource_types=' '.join(sorted(set(resource_types))),
+            channel=channel,
+            endpoint=endpoint,
+            secret=str(uuid.uuid4()) if channel == 'rest-hook' else None,
+            failures=0,
+        )
+        self.db.session.add(subscription)
+        self.db.session.commit()
+
+        return subscription
+
+    def subscriptions(self, token):
+        """ The subscriptions of the token's client for its patient.
+        """
+        return self.db.session.query(Subscription).\
+            filter_by(client_id=token.client_id).\
+            filter_by(user_id=token.user_id).\
+            filter_by(patient_id=token.patient_id)
+
+    def get(self, token, subscription_id):
+        """ One of the token's subscriptions, or None.
+        """
+        return self.subscriptions(token).filter_by(id=subscription_id).first()
+
+    @sqlite_concurrency.serialized
+    def delete(self, token, subscription_id):
+        """ End one of the token's subscriptions. Returns False if there is
+        no such subscription.
+        """
+        subscription = self.get(token, subscription_id)
+        if subscription is None:
+            return False
+
+        self._delete(subscription)
+        self.db.session.commit()
+        return True
+
+    def events(self, subscription_id, after, timeout):
+        """ Server-sent events for a subscription's notifications after
+        event id `after`, for `timeout` seconds.
+        """
+        interval = current_app.config['SUBSCRIPTION_STREAM_INTERVAL']
+        deadline = time.monotonic() + timeout
+        heartbeat = time.monotonic() + HEARTBEAT
+
+        yield 'retry: {:d}\n\n'.format(int(interval * 1000))
+        while True:
+            events = self.db.session.query(SubscriptionEvent).\
+                filter(SubscriptionEvent.subscription_id == subscription_id).\
+                filter(SubscriptionEvent.id > after).\
+                order_by(SubscriptionEvent.id).\
+                all()
+            self.db.session.rollback()
+
+            for event in events:
+                after = event.id
+                yield 'id: {:d}\nevent: notification\ndata: {}\n\n'.format(
+                    event.id, event.payload)
+            if events:
+                heartbeat = time.monotonic() + HEARTBEAT
+            elif time.monotonic() >= heartbeat:
+                yield ': keep-alive\n\n'
+                heartbeat = time.monotonic() + HEARTBEAT
+
+            if time.monotonic() + interval > deadline:
+                return
+            time.sleep(interval)
+
+    def stream_slot(self):
+        """ Take a free one of the SUBSCRIPTION_MAX_STREAMS slots for an
+        event stream. Returns the open slot file, to close when the stream
+        ends, or None if every slot is taken.
+        """
+        config = current_app.config
+        for slot in range(config['SUBSCRIPTION_MAX_STREAMS']):
+            lock = _acquire('{}.stream-{:d}'.format(config['SUBSCRIPTION_LOCK_PATH'], slot))
+            if lock is not None:
+                return lock
+        self.counters['streams_refused'] += 1
+        return None
+
+    def poll(self):
+        """ Run one round of searches and send the notifications.
+        """
+        config = current_app.config
+        now = datetime.utcnow()
+
+        self._purge(now - timedelta(seconds=config['SUBSCRIPTION_EVENT_TTL']))
+
+        groups = defaultdict(list)
+        for subscription, token in self._active(now):
+            for resource_type in subscription.resource_types:
+                groups[(subscription.patient_id, resource_type)].append((subscription, token))
+
+        # Stale groups first, and only so many searches per round.
+        due = [key for key in groups
+               if now - self._watermarks.get(key, datetime.min) >=
+               timedelta(seconds=config['SUBSCRIPTION_POLL_INTERVAL'])]
+        due.sort(key=lambda key: self._watermarks.get(key, datetime.min))
+
+        for key in due[:config['SUBSCRIPTION_MAX_POLLS']]:
+            self._poll_group(key, groups[key], now)
+
+        for key in set(self._watermarks) - set(groups):
+            del self._watermarks[key]
+            self._seen.pop(key, None)
+
+        self.counters['rounds'] += 1
+
+    def status(self):
+        """ Leadership and counters.
+        """
+        status = dict(self.counters)
+        status['leader'] = self._leader is not None
+        status['watched'] = len(self._watermarks)
+        return status
+
+    def _active(self, now):
+        # Subscriptions with the newest valid token of their client, user and
+        # patient; the others are over. Only those tokens are loaded.
+        subscriptions = {}
+        tokens = {}
+        for subscription, token in self.db.session.query(Subscription, Token).\
+                outerjoin(Token, and_(Token.client_id == Subscription.client_id,
+                                      Token.user_id == Subscription.user_id,
+                                      Token.patient_id == Subscription.patient_id,
+                                      Token.approval_expires >= now)).\
+                order_by(Subscription.id, Token.approval_expires):
+            subscriptions[subscription.id] = subscription
+            if token is not None:
+                tokens[subscription.id] = token
+
+        active = []
+        ended = False
+        for subscription_id, subscription in subscriptions.items():
+            token = tokens.get(subscription_id)
+            if token is None:
+                self._delete(subscription)
+                self.counters['ended'] += 1
+                ended = True
+            else:
+                active.append((subscription, token))
+
+        if ended:
+            self.db.session.commit()
+        return active
+
+    def _poll_group(self, key, subscribers, now):
+        patient_id, resource_type = key
+        since = self._watermarks.get(key)
+        self._watermarks[key] = now
+        if since is None:
+            # The first search only sets the baseline.
+            self._seen[key] = {}
+            return
+
+        labels = sorted({label for (_, token) in subscribers for label in token.security_labels})
+        resources = self._search(resource_type, patient_id, since - SKEW, labels)
+        if resources is None:
+            self._watermarks[key] = since
+            return
+
+        if len(resources) >= current_app.config['SUBSCRIPTION_PAGE_SIZE']:
+            # There may be more: the next search starts from the newest
+            # resource of this page, which is due again right away.
+            newest = max(_updated(resource) for resource in resources)
+            if newest > since:
+                self._watermarks[key] = newest
+            else:
+                LOG.warning('More than a page of %s of Patient/%s updated at once; '
+                            'some changes were skipped', resource_type, patient_id)
+            self.counters['pages'] += 1
+
+        seen = self._seen.setdefault(key, {})
+        changed = []
+        for resource in resources:
+            meta = resource.get('meta') or {}
+            version = meta.get('versionId') or meta.get('lastUpdated')
+            if seen.get(resource.get('id')) != version:
+                seen[resource.get('id')] = version
+                changed.append(resource)
+        # Only the overlap with the next poll has to be remembered.
+        overlap = self._watermarks[key] - SKEW
+        self._seen[key] = {resource.get('id'): seen[resource.get('id')] for resource in resources
+                           if _updated(resource) >= overlap}
+
+        for subscription, token in subscribers:
+            inclusion = Inclusion([resource_type],
+                                  [set(['public'] + token.security_labels),
+                                   {'Patient/{}'.format(patient_id)}])
+            ids = [resource.get('id') for resource in changed
+                   if inclusion.allows(resource) and belongs(resource, patient_id)]
+            if ids:
+                self._notify(subscription, resource_type, ids, now)
+
+    def _search(self, resource_type, patient_id, since, labels):
+        config = current_app.config
+        args = [('_sort', '_lastUpdated'),
+                ('_lastUpdated', 'gt' + since.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                ('_count', config['SUBSCRIPTION_PAGE_SIZE'])]
+
+        request = patient_search(resource_type, patient_id, labels, args)
+        try:
+            resources = search_resources(self.proxy_service.server(cached=False), request)
+        except UpstreamError:
+            self.counters['errors'] += 1
+            return None
+
+        self.counters['searches'] += 1
+        return resources
+
+    def _notify(self, subscription, resource_type, ids, now):
+        payload = json.dumps({
+            'subscription': subscription.id,
+            'resourceType': resource_type,
+            'ids': ids,
+            'timestamp': now.isoformat() + 'Z',
+        })
+
+        if subscription.channel == 'sse':
+            self.db.session.add(SubscriptionEvent(created=now, subscription_id=subscription.id,
+                                                  payload=payload))
+            self.db.session.commit()
+            self.counters['notifications'] += 1
+            return
+
+        signature = hmac.new(subscription.secret.encode('utf-8'), payload.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        delivered = False
+        # Checked again: where the host name points may have changed.
+        address = self._address(subscription.endpoint)
+        if address is not None:
+            try:
+                response = _post(subscription.endpoint, address, payload, {
+                    'Content-Type': 'application/json',
+                    'X-Signature': 'sha256=' + signature,
+                })
+                delivered = response.status_code < 300
+            except requests.RequestException:
+                pass
+
+        if delivered:
+            subscription.failures = 0
+            self.counters['notifications'] += 1
+        else:
+            subscription.failures = (subscription.failures or 0) + 1
+            self.counters['failures'] += 1
+            if subscription.failures >= current_app.config['SUBSCRIPTION_MAX_FAILURES']:
+                LOG.warning('Ending subscription %d after %d failed notifications',
+                            subscription.id, subscription.failures)
+                self._delete(subscription)
+                self.counters['ended'] += 1
+        self.db.session.commit()
+
+    def _address(self, endpoint):
+        # The address notifications for endpoint are POSTed to, or None if
+        # they may not be: endpoint must be an https URL of a host with public
+        # addresses only, or any http(s) URL for development.
+        url = parse.urlparse(endpoint)
+        local = current_app.config['SUBSCRIPTION_LOCAL_ENDPOINTS']
+        if url.scheme not in (('http', 'https') if local else ('https',)) or not url.hostname:
+            return None
+
+        try:
+            addresses = [address[4][0].split('%')[0] for address in socket.getaddrinfo(
+                url.hostname, url.port or 443, proto=socket.IPPROTO_TCP)]
+        except (socket.error, UnicodeError, ValueError):
+            return None
+        if not addresses or not (local or all(ipaddress.ip_address(address).is_global
+                                              for address in addresses)):
+            return None
+        return addresses[0]
+
+    def _delete(self, subscription):
+        self.db.session.query(SubscriptionEvent).\
+            filter_by(subscription_id=subscription.id).\
+            delete(synchronize_session=False)
+        self.db.session.delete(subscription)
+
+    def _purge(self, before):
+        deleted = self.db.session.query(SubscriptionEvent).\
+            filter(SubscriptionEvent.created < before).\
+            delete(synchronize_session=False)
+        if deleted:
+            self.db.session.commit()
+
+    def _start(self):
+        if not current_app.config['SUBSCRIPTIONS'] or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            app = current_app._get_current_object()  # pylint: disable=protected-access
+            thread = threading.Thread(target=self._run, args=(app,), name='subscriptions')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, app):
+        interval = app.config['SUBSCRIPTION_POLL_INTERVAL']
+        while True:
+            if self._leader is None:
+                self._leader = _acquire(app.config['SUBSCRIPTION_LOCK_PATH'])
+            if self._leader is not None:
+                with app.app_context():
+                    try:
+                        self.poll()
+                    except Exception:  # pylint: disable=broad-except
+                        self.counters['errors'] += 1
+                        LOG.exception('Subscription poll failed')
+                    finally:
+                        self.db.session.remove()
+            time.sleep(interval)
+
+    def _forget(self):
+        # The parent's thread and lock don't exist in a forked child.
+        self._lock = threading.Lock()
+        self._leader = None
+        self._pid = None
+        self._watermarks = {}
+        self._seen = {}
+
+
+def _updated(resource):
+    # When the resource was last updated, as a naive UTC datetime.
+    return last_updated(resource) or datetime.min
+
+
+class _PinnedAdapter(requests.adapters.HTTPAdapter):
+    # Connects to whatever address the URL names, with hostname for SNI and
+    # the certificate check.
+    def __init__(self, hostname):
+        self.hostname = hostname
+        super().__init__(max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _post(endpoint, address, payload, headers):
+    # POST payload to endpoint at address, without resolving its host again.
+    url = parse.urlparse(endpoint)
+    netloc = '[{}]'.format(address) if ':' in address else address
+    if url.port:
+        netloc += ':{:d}'.format(url.port)
+    headers = dict(headers, Host=url.netloc.rpartition('@')[2])
+
+    with requests.Session() as session:
+        session.mount('https://', _PinnedAdapter(url.hostname))
+        return session.post(url._replace(netloc=netloc).geturl(), data=payload, timeout=5,
+                            allow_redirects=False, headers=headers)
+
+
+def _acquire(path):
+    # The open lock file if this process now holds it, else None.
+    shm.private_directory(os.path.dirname(os.path.abspath(path)))
+    lock = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
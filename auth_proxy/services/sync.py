@@ -0,0 +1,162 @@
+""" Incremental sync.
+
+/api/sync/<resource type> returns the token's patient's resources of a
+type that changed since the app's last call. Where that was is kept in a
+cursor: the latest meta.lastUpdated the app was sent (the high-water mark)
+and the versions of the resources it was sent within SYNC_SKEW seconds of
+it. Only the FHIR server's clocks are involved, never the app's.
+
+Each call searches with _lastUpdated=ge<high-water mark - SYNC_SKEW>, so a
+resource committed late with an earlier lastUpdated is still found; the
+versions in the cursor keep the overlap from being sent twice. Results are
+sorted by _lastUpdated and paged by SYNC_PAGE_SIZE, which has to exceed
+the number of resources of one patient and type updated within SYNC_SKEW.
+
+Cursors are signed with SECRET_KEY and bound to the client, user, patient
+and resource type. The last one handed out is stored, so an app that lost
+its cursor resumes where it left off instead of starting over.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from auth_proxy.extensions import sqlite_concurrency
+from auth_proxy.models.sync import SyncCursor
+from auth_proxy.proxy import ForbiddenError
+from auth_proxy.proxy.compartment import belongs
+from auth_proxy.proxy.search import (
+    PatientRequestError,
+    RESOURCE_TYPES,
+    last_updated,
+    patient_search,
+    search_resources,
+)
+
+TIMESTAMP = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+class SyncError(PatientRequestError):
+    """ Raised for invalid sync requests.
+    """
+
+
+class SyncService(object):
+    """ Sends apps what changed since their last sync.
+    """
+    def __init__(self, db, proxy_service):
+        self.db = db
+        self.proxy_service = proxy_service
+
+    def sync(self, token, resource_type, cursor=None):
+        """ The resources of resource_type that changed after cursor, as a
+        dict of `resources`, the next `cursor` and whether there are `more`.
+        A cursor of None resumes from the stored cursor, and an empty one
+        starts over.
+
+        Raises:
+            ForbiddenError: resource_type can't be synced.
+            SyncError: The cursor is invalid.
+            UpstreamError: The search failed.
+        """
+        if not token.patient_id:
+            raise SyncError('Sync needs a token for a patient.')
+        if resource_type not in RESOURCE_TYPES:
+            raise ForbiddenError(segment=resource_type)
+
+        if cursor is None:
+            stored = self._stored(token, resource_type)
+            cursor = stored.cursor if stored is not None else ''
+        high_water, versions = self._load(token, resource_type, cursor) if cursor \
+            else (None, {})
+
+        page_size = current_app.config['SYNC_PAGE_SIZE']
+        skew = timedelta(seconds=current_app.config['SYNC_SKEW'])
+        resources = self._search(token, resource_type, high_water and high_water - skew,
+                                 page_size)
+        more = len(resources) >= page_size
+
+        if current_app.config['COMPARTMENT_CHECK']:
+            resources = [resource for resource in resources
+                         if belongs(resource, token.patient_id)]
+
+        changed = [resource for resource in resources
+                   if versions.get(resource.get('id')) != _version(resource)]
+
+        # The new mark, and what was sent close enough to it to come again.
+        for resource in resources:
+            updated = last_updated(resource)
+            if updated is not None and (high_water is None or updated > high_water):
+                high_water = updated
+        if high_water is not None:
+            versions = {key: value for (key, value) in versions.items()
+                        if value[1] >= (high_water - skew).strftime(TIMESTAMP)}
+            for resource in resources:
+                updated = last_updated(resource)
+                if updated is not None and updated >= high_water - skew:
+                    versions[resource.get('id')] = _version(resource)
+
+        cursor = self._dump(token, resource_type, high_water, versions)
+        self._store(token, resource_type, cursor)
+
+        return {'resources': changed, 'cursor': cursor, 'more': more}
+
+    def _search(self, token, resource_type, since, page_size):
+        args = [('_sort', '_lastUpdated'), ('_count', page_size)]
+        if since is not None:
+            args.append(('_lastUpdated', 'ge' + since.strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+        request = patient_search(resource_type, token.patient_id, token.security_labels, args)
+        return search_resources(self.proxy_service.server(cached=False), request)
+
+    def _serializer(self):
+        return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='sync-cursor')
+
+    def _dump(self, token, resource_type, high_water, versions):
+        return self._serializer().dumps({
+            'c': token.client_id,
+            'u': token.user_id,
+            'p': token.patient_id,
+            'r': resource_type,
+            't': high_water.strftime(TIMESTAMP) if high_water is not None else None,
+            'v': versions,
+        })
+
+    def _load(self, token, resource_type, cursor):
+        try:
+            position = self._serializer().loads(cursor)
+        except BadSignature:
+            raise SyncError('Invalid cursor.')
+
+        if [position.get(key) for key in 'cupr'] != \
+                [token.client_id, token.user_id, token.patient_id, resource_type]:
+            raise SyncError('The cursor is for another sync.')
+
+        high_water = datetime.strptime(position['t'], TIMESTAMP) if position.get('t') else None
+        return high_water, {key: tuple(value) for (key, value) in position['v'].items()}
+
+    def _stored(self, token, resource_type):
+        return self.db.session.query(SyncCursor).\
+            filter_by(client_id=token.client_id).\
+            filter_by(user_id=token.user_id).\
+            filter_by(patient_id=token.patient_id).\
+            filter_by(resource_type=resource_type).\
+            first()
+
+    @sqlite_concurrency.serialized
+    def _store(self, token, resource_type, cursor):
+        stored = self._stored(token, resource_type)
+        if stored is None:
+            stored = SyncCursor(client_id=token.client_id, user_id=token.user_id,
+                                patient_id=token.patient_id, resource_type=resource_type)
+            self.db.session.add(stored)
+        stored.cursor = cursor
+        stored.updated = datetime.utcnow()
+        self.db.session.commit()
+
+
+def _version(resource):
+    # What tells the versions of a resource apart, with when it was updated.
+    updated = last_updated(resource)
+    return ((resource.get('meta') or {}).get('versionId'),
+            updated.strftime(TIMESTAMP) if updated is not None else '')
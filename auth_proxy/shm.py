@@ -0,0 +1,176 @@
+""" Counters shared by all worker processes on a host.
+
+A SharedTable is a fixed-size hash table of float records in a memory
+mapped file (on /dev/shm where available). Every worker maps the same
+file, so a record updated by one worker is seen by all of them. Each slot
+is guarded by a POSIX record lock on its byte range, so updates from
+different processes don't interleave, plus a thread lock for the threads
+of one process (record locks are per process).
+
+The table is lossy: when every slot a key may use is taken by other keys,
+the key evicts one of them and starts from zeroes. It is meant for
+counters that may be forgotten, such as rate limits.
+
+private_directory() makes sure a directory of files shared by the workers
+(tables, grants, cached responses) can't have been planted by another user.
+Tables are kept in one, by default table_path(), and their files must be
+ours as well.
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+
+
+def default_path(name):
+    """ Where to keep the table called name.
+    """
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'auth-proxy-{}'.format(name))
+
+
+def table_path(name):
+    """ Where to keep the table called name by default.
+    """
+    return os.path.join(default_path('tables'), name)
+
+
+def private_directory(path):
+    """ Create the directory at path for this user only, or check that it
+    already is one.
+
+    The default paths are predictable, and anyone on the host may create
+    them first; the files in them must not be trusted unless only we can
+    write there.
+
+    Raises:
+        PermissionError: path is not a directory (or is a symlink), is
+            owned by another user or is open to others.
+    """
+    os.makedirs(path, 0o700, exist_ok=True)
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            stat.S_IMODE(info.st_mode) != 0o700:
+        raise PermissionError('{} must be a directory of user {:d} with mode 0700'.format(
+            path, os.getuid()))
+    return path
+
+
+class SharedTable(object):
+    """ A table of `fields` floats per key, shared across processes.
+    """
+    def __init__(self, path, fields, slots=4096, probes=8):
+        self.path = path
+        self.fields = fields
+        self.slots = slots
+        self.probes = probes
+        self.record = struct.Struct('<Q{:d}d'.format(fields))
+        self.size = self.record.size * slots
+        self._fd = None
+        self._map = None
+        self._pid = None
+        self._lock = None
+
+    @contextmanager
+    def locked(self, key):
+        """ Lock the record of key and yield its values as a list.
+
+        Changes to the list are written back when the block exits, unless
+        it raises.
+
+        Raises:
+            PermissionError: The table's directory is not private (see
+                private_directory), or its file is not a file of ours.
+        """
+        self._open()
+        digest = _hash(key)
+
+        with self._lock:
+            offset = self._claim(digest)
+            try:
+                values = list(self.record.unpack_from(self._map, offset)[1:])
+                yield values
+                self.record.pack_into(self._map, offset, digest, *values)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.record.size, offset)
+
+    def reset(self):
+        """ Forget every record.
+        """
+        self._open()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(self.size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """ Unmap the table.
+        """
+        if self._pid == os.getpid():
+            self._map.close()
+            os.close(self._fd)
+        self._pid = None
+
+    def _open(self):
+        # Record locks are not inherited by forked workers, so each process
+        # opens the file itself.
+        if self._pid == os.getpid():
+            return
+
+        private_directory(os.path.dirname(os.path.abspath(self.path)))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid():
+            os.close(fd)
+            raise PermissionError('{} must be a file of user {:d}'.format(
+                self.path, os.getuid()))
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _claim(self, digest):
+        # Returns the offset of the (locked) slot that holds digest.
+        for probe in range(self.probes):
+            offset = ((digest + probe) % self.slots) * self.record.size
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.record.size, offset)
+
+            (current,) = struct.unpack_from('<Q', self._map, offset)
+            if current == digest:
+                return offset
+            if current == 0:
+                self._clear(offset, digest)
+                return offset
+
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.record.size, offset)
+
+        # Every slot is taken; evict the key in the first one.
+        offset = (digest % self.slots) * self.record.size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.record.size, offset)
+        self._clear(offset, digest)
+        return offset
+
+    def _clear(self, offset, digest):
+        self.record.pack_into(self._map, offset, digest, *([0.0] * self.fields))
+
+
+def _hash(key):
+    # 0 marks an empty slot.
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return struct.unpack('<Q', digest)[0] or 1
@@ -0,0 +1,122 @@
+""" SQLite concurrency mode.
+
+SQLite allows one writer at a time. When several uwsgi workers share one
+database file, a transaction that starts by reading and then tries to
+write fails at once with "database is locked" if another worker wrote in
+the meantime. The busy timeout does not help in that case.
+
+When SQLITE_CONCURRENCY is enabled, every SQLite connection runs in WAL
+mode with a busy timeout, so readers never block the writer. Service
+methods that write are decorated with `serialized`, which starts their
+transaction with BEGIN IMMEDIATE. The write lock is taken up front, where
+the busy timeout applies, and a still-busy database is retried a bounded
+number of times.
+"""
+from functools import wraps
+import random
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+
+class SQLiteConcurrency(object):
+    """ WAL mode and a serialized write path for SQLite databases.
+    """
+    def __init__(self, db, app=None):
+        self.db = db
+        self.enabled = False
+        self.busy_timeout = None
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Install the connection hooks if the mode is enabled.
+        """
+        app.config.setdefault('SQLITE_CONCURRENCY', False)
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+        app.config.setdefault('SQLITE_WRITE_RETRIES', 5)
+        app.config.setdefault('SQLITE_WRITE_BACKOFF', 0.02)
+
+        self.enabled = app.config['SQLITE_CONCURRENCY']
+        self.busy_timeout = app.config['SQLITE_BUSY_TIMEOUT']
+
+        if self.enabled and not event.contains(Engine, 'connect', self._on_connect):
+            event.listen(Engine, 'connect', self._on_connect)
+            event.listen(Engine, 'begin', self._on_begin)
+
+    def serialized(self, func):
+        """ Decorate a method that writes to the database.
+
+        The method must commit its own work; it is re-run from scratch if
+        the database stays busy.
+        """
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            if not self.enabled or getattr(self._local, 'writing', False):
+                return func(*args, **kwargs)
+
+            retries = current_app.config['SQLITE_WRITE_RETRIES']
+            backoff = current_app.config['SQLITE_WRITE_BACKOFF']
+            session = self.db.session
+
+            with self._lock:
+                self._local.writing = True
+                try:
+                    for attempt in range(retries + 1):
+                        # A transaction that is already open only holds a
+                        # read snapshot; end it so the write starts fresh.
+                        if not (session.new or session.dirty or session.deleted):
+                            session.rollback()
+                        try:
+                            return func(*args, **kwargs)
+                        except OperationalError as err:
+                            session.rollback()
+                            if attempt == retries or not _is_busy(err):
+                                raise
+                        except Exception:
+                            session.rollback()
+                            raise
+
+                        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+                finally:
+                    self._local.writing = False
+
+        return decorated
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        if not self.enabled or not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+
+        # Let SQLAlchemy (see _on_begin), not pysqlite, issue BEGIN.
+        dbapi_connection.isolation_level = None
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(self.busy_timeout))
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+        connection_record.info['sqlite_concurrency'] = True
+
+    def _on_begin(self, conn):
+        if not conn.connection.info.get('sqlite_concurrency'):
+            return
+
+        if getattr(self._local, 'writing', False):
+            conn.execute('BEGIN IMMEDIATE')
+        else:
+            conn.execute('BEGIN')
+
+
+def _is_busy(err):
+    message = str(err.orig)
+    return 'locked' in message or 'busy' in message
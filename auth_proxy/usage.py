@@ -0,0 +1,148 @@
+""" Token usage tracking.
+
+/apps shows when each app last used its token and how many FHIR API calls
+it made. Writing the token row on every call would serialize the API on
+the database, so the request path only bumps a per-token counter in
+memory, keyed by the access token. A background thread in each worker
+writes the counters out every USAGE_FLUSH_INTERVAL seconds, in one batched
+UPDATE (serialized with the other writes, see auth_proxy.sqlite) that adds
+the worker's counts to the row and keeps the later of the last-used
+times, which is how the counts of all workers add up.
+
+Refreshing a token replaces its row; the new row takes over the counts
+written so far (see Token.refresh), and what was not flushed yet is lost.
+"""
+import atexit
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+import logging
+import os
+import threading
+
+from flask import request
+from sqlalchemy import bindparam, case, func, or_
+
+from auth_proxy import fork
+
+LOG = logging.getLogger(__name__)
+
+
+class Usage(object):
+    """ Counts FHIR API calls per token and writes them behind.
+    """
+    def __init__(self, db, app=None):
+        self.db = db
+        self.app = None
+        self.enabled = False
+        self.interval = None
+        self.counters = Counter()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = None
+        self._pid = None
+
+        fork.after_fork(self._forget)
+        atexit.register(self.flush)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the settings.
+        """
+        app.config.setdefault('USAGE_TRACKING', False)
+        app.config.setdefault('USAGE_FLUSH_INTERVAL', 10.0)
+
+        self.app = app
+        self.enabled = app.config['USAGE_TRACKING']
+        self.interval = app.config['USAGE_FLUSH_INTERVAL']
+
+    def record(self, view):
+        """ Decorate an OAuth protected view to count its requests.
+        """
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            if self.enabled:
+                self.seen(request.oauth.access_token.access_token)
+            return view(*args, **kwargs)
+
+        return decorated
+
+    def seen(self, access_token):
+        """ Count a request made with the access token.
+        """
+        self._start()
+        now = datetime.utcnow()
+        with self._lock:
+            pending = self._pending.get(access_token)
+            if pending is None:
+                self._pending[access_token] = [1, now]
+            else:
+                pending[0] += 1
+                pending[1] = now
+
+    def flush(self):
+        """ Write the counts gathered so far.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self.app is None:
+            return
+
+        rows = [{'token': access_token, 'count': count, 'last': last}
+                for access_token, (count, last) in pending.items()]
+        try:
+            with self.app.app_context():
+                self._write(rows)
+        except Exception:  # pylint: disable=broad-except
+            self.counters['failed'] += len(rows)
+            LOG.exception('Failed to write the usage of %d tokens', len(rows))
+        else:
+            self.counters['written'] += len(rows)
+            self.counters['flushes'] += 1
+
+    def _write(self, rows):
+        from auth_proxy.extensions import sqlite_concurrency
+        from auth_proxy.models.oauth import Token
+
+        table = Token.__table__
+        last = bindparam('last')
+        statement = table.update().\
+            where(table.c.access_token == bindparam('token')).\
+            values(request_count=func.coalesce(table.c.request_count, 0) + bindparam('count'),
+                   last_used=case([(or_(table.c.last_used.is_(None),
+                                        table.c.last_used < last), last)],
+                                  else_=table.c.last_used))
+
+        engine = self.db.get_engine(self.app)
+
+        @sqlite_concurrency.serialized
+        def write():
+            with engine.begin() as connection:
+                connection.execute(statement, rows)
+
+        write()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            thread = threading.Thread(target=self._run, args=(self._stop,), name='usage-writer')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            self.flush()
+
+    def _forget(self):
+        # The parent's thread doesn't exist in a forked child, and its counts
+        # are the parent's to write.
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pid = None
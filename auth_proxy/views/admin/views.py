@@ -0,0 +1,154 @@
+# pylint: disable=missing-docstring
+""" Admin views: on-demand profiling and bulk token revocation.
+
+Every view needs "Authorization: Bearer <ADMIN_TOKEN>". Without an
+ADMIN_TOKEN the blueprint answers 404, as if it did not exist.
+"""
+from functools import wraps
+import hmac
+
+from flask import (
+    abort,
+    Blueprint,
+    current_app,
+    jsonify,
+    request,
+    Response
+)
+
+from auth_proxy.extensions import profiler
+from auth_proxy.profiling import ALLOCATIONS, CPU, ProfilingError
+from auth_proxy.services import oauth_service
+from auth_proxy.services import OAuthServiceError
+
+BP = Blueprint('admin',
+               __name__,
+               url_prefix='/admin')
+
+
+def admin_required(view):
+    """ Only let requests with the admin token through.
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        token = current_app.config.get('ADMIN_TOKEN')
+        if not token:
+            abort(404)
+
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            abort(401)
+        if not hmac.compare_digest(header[len('Bearer '):].encode('utf-8'),
+                                   token.encode('utf-8')):
+            abort(403)
+
+        return view(*args, **kwargs)
+    return decorated
+
+
+@BP.route('/profile', methods=['GET'])
+@admin_required
+def admin_profile_status():
+    return jsonify(profiler.status())
+
+
+@BP.route('/profile', methods=['DELETE'])
+@admin_required
+def admin_profile_stop():
+    profiler.stop()
+    return jsonify(profiler.status())
+
+
+@BP.route('/profile/cpu', methods=['POST'])
+@admin_required
+def admin_profile_cpu():
+    params = request.get_json(silent=True) or {}
+    endpoint = _endpoint(params.get('endpoint'))
+    if endpoint is None:
+        raise ProfilingError('"endpoint" must name a view, e.g. "api.api_fhir_proxy".')
+
+    session = profiler.start(CPU, endpoint, _number(params, 'requests', 100, int),
+                             interval=_number(params, 'interval', 0.005, float))
+
+    response = jsonify(session.status())
+    response.status_code = 202
+    return response
+
+
+@BP.route('/profile/cpu', methods=['GET'])
+@admin_required
+def admin_profile_cpu_result():
+    if request.args.get('format') == 'folded':
+        return Response(profiler.folded(), mimetype='text/plain')
+
+    return jsonify(profiler.status().get(CPU, {}))
+
+
+@BP.route('/profile/allocations', methods=['POST'])
+@admin_required
+def admin_profile_allocations():
+    params = request.get_json(silent=True) or {}
+    endpoint = None
+    if params.get('endpoint'):
+        endpoint = _endpoint(params['endpoint'])
+        if endpoint is None:
+            raise ProfilingError('"endpoint" must name a view, e.g. "api.api_fhir_proxy".')
+
+    session = profiler.start(ALLOCATIONS, endpoint, _number(params, 'requests', 100, int),
+                             frames=_number(params, 'frames', 10, int))
+
+    response = jsonify(session.status())
+    response.status_code = 202
+    return response
+
+
+@BP.route('/profile/allocations', methods=['GET'])
+@admin_required
+def admin_profile_allocations_result():
+    limit = request.args.get('limit', 20, type=int)
+
+    return jsonify({
+        'session': profiler.status().get(ALLOCATIONS, {}),
+        'endpoints': profiler.allocations(limit),
+    })
+
+
+@BP.route('/tokens/revoke', methods=['POST'])
+@admin_required
+def admin_revoke_tokens():
+    params = request.get_json(silent=True) or {}
+    revoked = oauth_service.revoke_tokens(client_id=params.get('client_id'),
+                                          username=params.get('username'),
+                                          patient_id=params.get('patient_id'))
+
+    return jsonify({'revoked': revoked})
+
+
+@BP.errorhandler(ProfilingError)
+def handle_profiling_error(error):
+    response = jsonify({'error': error.message})
+    response.status_code = 400
+
+    return response
+
+
+@BP.errorhandler(OAuthServiceError)
+def handle_oauth_error(error):
+    response = jsonify(error=error.error, description=error.description)
+    response.status_code = 400
+
+    return response
+
+
+def _endpoint(name):
+    # The endpoint name if the app has such a view.
+    if name and name in current_app.view_functions:
+        return name
+    return None
+
+
+def _number(params, name, default, kind):
+    try:
+        return kind(params.get(name, default))
+    except (TypeError, ValueError):
+        raise ProfilingError('"{}" must be a number.'.format(name))
@@ -1,19 +1,32 @@
 # pylint: disable=missing-docstring
 """ Views module
 """
+import json
+import math
+
 from flask import (
     Blueprint,
     current_app,
     jsonify,
     request,
     Response,
+    stream_with_context,
     url_for,
     abort
 )
 
-from auth_proxy.extensions import oauthlib
-from auth_proxy.proxy import ForbiddenError
-from auth_proxy.services import oauth_service, proxy_service
+from auth_proxy.admission import OverloadedError
+from auth_proxy.extensions import admission, audit, capture, oauthlib, ratelimiter, usage
+from auth_proxy.proxy import ForbiddenError, UpstreamError
+from auth_proxy.proxy.search import PatientRequestError
+from auth_proxy.ratelimit import RateLimitError
+from auth_proxy.services import (
+    oauth_service,
+    proxy_service,
+    subscription_service,
+    sync_service,
+)
+from auth_proxy.views.admin.views import admin_required
 
 from auth_proxy.proxy.flask import UnsecureFlaskClient
 
@@ -37,7 +50,6 @@ def api_me():
 @BP.route('/fhir/metadata')
 def api_fhir_metadata():
 
-    url = current_app.config['API_SERVER'] + '/metadata'
     authorize_url = url_for('oauth.cb_oauth_authorize', _external=True)
     manage_url = url_for('main.apps', _external=True)
 
@@ -57,25 +69,207 @@ def api_fhir_metadata():
         'register': url_for('oauth.oauth_register', _external=True),
     }
 
-    conformance = proxy_service.conformance(url, extensions)
+    conformance = proxy_service.conformance(extensions)
 
     return jsonify(conformance)
 
 
+# Names the upstream servers, so it is for admins only.
+@BP.route('/status/upstream')
+@admin_required
+def api_upstream_status():
+    return jsonify(proxy_service.status())
+
+
+@BP.route('/status/audit')
+@admin_required
+def api_audit_status():
+    return jsonify(audit.status())
+
+
+@BP.route('/status/capture')
+@admin_required
+def api_capture_status():
+    return jsonify(capture.status())
+
+
+@BP.route('/status/ready')
+def api_ready():
+    status = admission.status()
+    response = jsonify(status)
+    if not status['ready']:
+        response.status_code = 503
+
+    return response
+
+
 @BP.route('/fhir/<path:path>', methods=['GET', 'POST'])
 @oauthlib.require_oauth()
+@audit.record
+@usage.record
+@capture.record
+@ratelimiter.limit
 def api_fhir_proxy(path):
-    url = current_app.config['API_SERVER'] + '/' + path
-    response = proxy_service.api(url, request)
+    response = proxy_service.api(path, request)
 
     return Response(**response)
 
 
+@BP.route('/verify/<path:path>')
+@oauthlib.require_oauth()
+def api_verify(path):
+    if not current_app.config['DELEGATE']:
+        abort(404)
+
+    try:
+        upstream = proxy_service.delegate(path, request)
+    except ForbiddenError as error:
+        return _verified(path, None, error)
+
+    if upstream is None and not current_app.config['DELEGATE_ACCEL_PREFIX']:
+        # The front proxy gets the response from us instead, with the token.
+        # That request is audited, counted and limited; this one isn't.
+        url = url_for('.api_fhir_proxy', path=path, _external=True)
+        if request.query_string:
+            url += '?' + request.query_string.decode('utf-8')
+        response = Response(status=200)
+        response.headers['X-Upstream-Url'] = url
+        response.headers['X-Upstream-Authorization'] = request.headers.get('Authorization', '')
+        return response
+
+    return _verified(path, upstream)
+
+
+@audit.record
+@usage.record
+@ratelimiter.limit
+def _verified(path, upstream, error=None):
+    # Refusals are recorded here, like those of /api/fhir/<path>.
+    if error is not None:
+        raise error
+
+    if upstream is None:
+        return Response(**proxy_service.api(path, request))
+
+    prefix = current_app.config['DELEGATE_ACCEL_PREFIX']
+    response = Response(status=200)
+    response.headers['X-Upstream-Url'] = upstream['url']
+    if prefix:
+        response.headers['X-Accel-Redirect'] = prefix + upstream['path']
+
+    return response
+
+
+@BP.route('/sync/<path>')
+@oauthlib.require_oauth()
+@audit.record
+@usage.record
+@ratelimiter.limit
+def api_sync(path):
+    cursor = request.args.get('cursor')
+    if request.args.get('reset') == 'true':
+        cursor = ''
+    delta = sync_service.sync(request.oauth.access_token, path, cursor)
+
+    bundle = {
+        'resourceType': 'Bundle',
+        'type': 'collection',
+        'total': len(delta['resources']),
+        'entry': [{'resource': resource} for resource in delta['resources']],
+    }
+    if delta['more']:
+        bundle['link'] = [{
+            'relation': 'next',
+            'url': url_for('.api_sync', path=path, cursor=delta['cursor'], _external=True),
+        }]
+
+    response = Response(json.dumps(bundle), mimetype='application/json+fhir')
+    response.headers['X-Sync-Cursor'] = delta['cursor']
+
+    return response
+
+
+@BP.route('/subscriptions', methods=['GET', 'POST'])
+@oauthlib.require_oauth()
+def api_subscriptions():
+    if not current_app.config['SUBSCRIPTIONS']:
+        abort(404)
+
+    token = request.oauth.access_token
+    if request.method == 'GET':
+        return jsonify({
+            'subscriptions': [subscription.interest
+                              for subscription in subscription_service.subscriptions(token)],
+        })
+
+    data = request.get_json(silent=True) or {}
+    subscription = subscription_service.create(token, data.get('resource_types'),
+                                               data.get('channel'), data.get('endpoint'))
+
+    interest = subscription.interest
+    if subscription.secret:
+        interest['secret'] = subscription.secret
+    response = jsonify(interest)
+    response.status_code = 201
+
+    return response
+
+
+@BP.route('/subscriptions/<int:subscription_id>', methods=['GET', 'DELETE'])
+@oauthlib.require_oauth()
+def api_subscription(subscription_id):
+    if not current_app.config['SUBSCRIPTIONS']:
+        abort(404)
+
+    token = request.oauth.access_token
+    if request.method == 'DELETE':
+        if not subscription_service.delete(token, subscription_id):
+            abort(404)
+        return Response(status=204)
+
+    subscription = subscription_service.get(token, subscription_id)
+    if subscription is None:
+        abort(404)
+
+    return jsonify(subscription.interest)
+
+
+@BP.route('/subscriptions/<int:subscription_id>/events')
+@oauthlib.require_oauth()
+def api_subscription_events(subscription_id):
+    if not current_app.config['SUBSCRIPTIONS']:
+        abort(404)
+
+    subscription = subscription_service.get(request.oauth.access_token, subscription_id)
+    if subscription is None or subscription.channel != 'sse':
+        abort(404)
+
+    # Streams hold their worker; only so many may be open at once.
+    slot = subscription_service.stream_slot()
+    if slot is None:
+        raise OverloadedError(retry_after=current_app.config['SUBSCRIPTION_STREAM_INTERVAL'])
+
+    after = request.headers.get('Last-Event-ID', 0, type=int)
+    events = subscription_service.events(subscription.id, after,
+                                         current_app.config['SUBSCRIPTION_STREAM_TIMEOUT'])
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.call_on_close(slot.close)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+@BP.route('/status/subscriptions')
+@admin_required
+def api_subscription_status():
+    return jsonify(subscription_service.status())
+
+
 @BP.route('/open-fhir/<path:path>', methods=['GET', 'POST'])
 def api_open_fhir_proxy(path):
     if current_app.config['ENABLE_UNSECURE_FHIR']:
-        url = current_app.config['API_SERVER'] + '/' + path
-        response = proxy_service.api(url, request, UnsecureFlaskClient)
+        response = proxy_service.api(path, request, UnsecureFlaskClient)
 
         return Response(**response)
     else:
@@ -88,3 +282,30 @@ def handle_forbidden_error(error):
     response.status_code = 403
 
     return response
+
+
+@BP.errorhandler(UpstreamError)
+def handle_upstream_error(error):
+    response = jsonify({'error': error.message})
+    response.status_code = error.status
+    if error.retry_after:
+        response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
+
+    return response
+
+
+@BP.errorhandler(RateLimitError)
+def handle_rate_limit_error(error):
+    response = jsonify({'error': error.message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
+
+    return response
+
+
+@BP.errorhandler(PatientRequestError)
+def handle_patient_request_error(error):
+    response = jsonify({'error': error.message})
+    response.status_code = 400
+
+    return response
@@ -1,7 +1,6 @@
 ''' CLI commands.
 '''
 from flask import Blueprint
-import yaml
 
 from auth_proxy.application import app
 from auth_proxy.extensions import db
@@ -21,6 +20,8 @@ def initdb():
 def load_fixtures():
     ''' Load fixtures.
     '''
+    import yaml
+
     with open('auth_proxy/fixtures.yml') as handle:
         records = yaml.load_all(handle.read())
         for record in records:
@@ -0,0 +1,112 @@
+# pylint: disable=missing-docstring
+""" Debug views, registered lazily on the oauth blueprint.
+"""
+from datetime import datetime
+import json
+import time
+
+from flask import (
+    jsonify,
+    request,
+    Response
+)
+
+from auth_proxy.models.oauth import Token
+from auth_proxy.services import oauth_service
+from auth_proxy.services import OAuthServiceError
+
+
+def debug_create_token(*args, **kwargs):
+
+    token_json = request.get_json()
+
+    default_access_lifetime = 60*60  # 1 hour
+    default_approval_expiry = time.time() + 365*24*60*60  # 1 year from now
+
+    token = oauth_service.create_debug_token(
+        client_id=token_json.get('client_id'),
+        access_lifetime=token_json.get('access_lifetime', default_access_lifetime),
+        approval_expires=token_json.get('approval_expires', default_approval_expiry),
+        scopes=token_json.get('scope'),
+        user=token_json.get('username'),
+        patient_id=token_json.get('patient_id')
+    )
+
+    return jsonify({'access_token': token.access_token, 'refresh_token': token.refresh_token})
+
+
+# The most tokens one batch request may create.
+MAX_BATCH = 100000
+
+
+def debug_create_tokens(*args, **kwargs):
+
+    batch_json = request.get_json(silent=True)
+    if not isinstance(batch_json, dict):
+        batch_json = {}
+
+    # Top-level fields are defaults for every token in the batch.
+    defaults = {
+        'client_id': batch_json.get('client_id'),
+        'access_lifetime': batch_json.get('access_lifetime', 60*60),  # 1 hour
+        'approval_expires': batch_json.get('approval_expires',
+                                           time.time() + 365*24*60*60),  # 1 year from now
+        'scope': batch_json.get('scope'),
+        'username': batch_json.get('username'),
+        'patient_id': batch_json.get('patient_id'),
+    }
+
+    if 'tokens' in batch_json:
+        if not isinstance(batch_json['tokens'], list) or \
+                not all(isinstance(spec, dict) for spec in batch_json['tokens']):
+            raise OAuthServiceError('malformed_tokens', '"tokens" should be a list of objects.')
+        specs = [dict(defaults, **spec) for spec in batch_json['tokens']]
+    else:
+        try:
+            specs = [defaults] * int(batch_json.get('count', 0))
+        except (TypeError, ValueError):
+            raise OAuthServiceError('malformed_count', '"count" should be an integer.')
+
+    if not specs:
+        raise OAuthServiceError('no_tokens', '"tokens" or "count" is required.')
+    if len(specs) > MAX_BATCH:
+        raise OAuthServiceError('too_many_tokens',
+                                'At most {} tokens can be created at once.'.format(MAX_BATCH))
+
+    tokens = oauth_service.create_debug_tokens([{
+        'client_id': spec['client_id'],
+        'access_lifetime': spec['access_lifetime'],
+        'approval_expires': spec['approval_expires'],
+        'scopes': spec['scope'],
+        'user': spec['username'],
+        'patient_id': spec['patient_id'],
+    } for spec in specs])
+
+    def generate():
+        for access_token, refresh_token in tokens:
+            yield json.dumps({'access_token': access_token,
+                              'refresh_token': refresh_token}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def debug_token_introspection(*args, **kwargs):
+
+    token = request.args.get('token')
+    if not token:
+        raise OAuthServiceError('no_token', '"token" is required.')
+
+    passed_token = Token.query.filter_by(access_token=token).first()
+    is_access_token = True
+    if not passed_token:
+        passed_token = Token.query.filter_by(refresh_token=token).first()
+        is_access_token = False
+    if not passed_token:
+        raise OAuthServiceError('no_token', 'No matching token found.')
+
+    data = passed_token.interest
+
+    expiry = data['access_expires' if is_access_token else 'approval_expires']
+    data['active'] = (datetime.now() <= expiry)
+
+    return jsonify(data)
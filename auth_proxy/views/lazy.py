@@ -0,0 +1,23 @@
+""" Lazily imported views.
+
+Rarely used views are registered with a LazyView, so their module (and
+whatever it imports) is only loaded when the view is first requested.
+"""
+from werkzeug.utils import cached_property, import_string
+
+
+class LazyView(object):
+    """ A view function that is imported on first use.
+    """
+    def __init__(self, import_name):
+        self.__module__, self.__name__ = import_name.rsplit('.', 1)
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        """ The real view function.
+        """
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
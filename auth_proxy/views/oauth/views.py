@@ -1,12 +1,10 @@
 # pylint: disable=missing-docstring
 """ Views module
 """
-from datetime import datetime
-import time
-
 import arrow
 from flask import (
     Blueprint,
+    current_app,
     jsonify,
     render_template,
     request
@@ -14,10 +12,10 @@ from flask import (
 from flask_login import current_user, login_required
 from furl import furl
 
-from auth_proxy.extensions import csrf, oauthlib
+from auth_proxy.extensions import capture, csrf, oauthlib
 from auth_proxy.services import oauth_service
-from auth_proxy.models.oauth import Token
 from auth_proxy.services import OAuthServiceError
+from auth_proxy.views.lazy import LazyView
 
 
 BP = Blueprint('oauth',
@@ -46,12 +44,22 @@ def oauth_register():
     return response
 
 
+# The debug endpoints are rarely used, so they are only imported on demand.
+BP.add_url_rule('/debug/token', methods=['POST'],
+                view_func=LazyView('auth_proxy.views.debug.views.debug_create_token'))
+BP.add_url_rule('/debug/tokens', methods=['POST'],
+                view_func=LazyView('auth_proxy.views.debug.views.debug_create_tokens'))
+BP.add_url_rule('/debug/introspect', methods=['GET'],
+                view_func=LazyView('auth_proxy.views.debug.views.debug_token_introspection'))
+
+
 @BP.route('/errors')
 def oauth_errors():
     return jsonify(request.args)
 
 
 @BP.route('/token', methods=['GET', 'POST'])
+@capture.record
 @oauthlib.token_handler
 def cb_oauth_token(*args, **kwargs):
     credentials = oauth_service.smart_token_credentials(
@@ -63,47 +71,55 @@ def cb_oauth_token(*args, **kwargs):
     return credentials
 
 
-@BP.route('/debug/token', methods=['POST'])
-def debug_create_token(*args, **kwargs):
-
-    token_json = request.get_json()
-
-    default_access_lifetime = 60*60  # 1 hour
-    default_approval_expiry = time.time() + 365*24*60*60  # 1 year from now
-
-    token = oauth_service.create_debug_token(
-        client_id=token_json.get('client_id'),
-        access_lifetime=token_json.get('access_lifetime', default_access_lifetime),
-        approval_expires=token_json.get('approval_expires', default_approval_expiry),
-        scopes=token_json.get('scope'),
-        user=token_json.get('username'),
-        patient_id=token_json.get('patient_id')
-    )
+@BP.route('/introspect', methods=['POST'])
+def oauth_introspect():
+    """ Batch token introspection for resource servers. See RFC7662.
 
-    return jsonify({'access_token': token.access_token, 'refresh_token': token.refresh_token})
+    Accepts one or more "token" form parameters, or a JSON payload with a
+    "tokens" list. A single form token gets a plain RFC7662 response; a
+    batch gets {"results": [...]} in request order.
+    """
+    auth = request.authorization
+    if auth:
+        client_id, client_secret = auth.username, auth.password
+    else:
+        client_id = request.form.get('client_id')
+        client_secret = request.form.get('client_secret')
 
+    oauth_service.authenticate_client(client_id, client_secret,
+                                      current_app.config['INTROSPECTION_CLIENTS'])
 
-@BP.route('/debug/introspect', methods=['GET'])
-def debug_token_introspection(*args, **kwargs):
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        tokens = payload.get('tokens') if isinstance(payload, dict) else None
+    else:
+        tokens = request.form.getlist('token')
 
-    token = request.args.get('token')
-    if not token:
+    if not tokens or not isinstance(tokens, list):
         raise OAuthServiceError('no_token', '"token" is required.')
+    if not all(token and isinstance(token, str) for token in tokens):
+        raise OAuthServiceError('invalid_request', 'Tokens must be non-empty strings.')
 
-    passed_token = Token.query.filter_by(access_token=token).first()
-    is_access_token = True
-    if not passed_token:
-        passed_token = Token.query.filter_by(refresh_token=token).first()
-        is_access_token = False
-    if not passed_token:
-        raise OAuthServiceError('no_token', 'No matching token found.')
+    max_tokens = current_app.config['INTROSPECTION_MAX_TOKENS']
+    if len(tokens) > max_tokens:
+        raise OAuthServiceError(
+            'too_many_tokens',
+            'At most {} tokens may be introspected at once.'.format(max_tokens)
+        )
 
-    data = passed_token.interest
+    results, max_age = oauth_service.introspect(tokens)
 
-    expiry = data['access_expires' if is_access_token else 'approval_expires']
-    data['active'] = (datetime.now() <= expiry)
+    if len(results) == 1 and not request.is_json:
+        response = jsonify(results[0])
+    else:
+        response = jsonify(results=results)
+
+    # Revocations only become visible once a cached response expires, so
+    # never let a response outlive the configured ceiling.
+    ceiling = current_app.config['INTROSPECTION_MAX_AGE']
+    response.cache_control.max_age = min(ceiling, max_age) if max_age is not None else ceiling
 
-    return jsonify(data)
+    return response
 
 
 @BP.route('/authorize', methods=['GET', 'POST'])
@@ -0,0 +1,191 @@
+""" Background batch writing.
+
+A BatchWriter takes records from the request path and hands them to a sink
+in batches, from a background thread. Request threads never wait on the
+sink. When the queue is full, new records are dropped and counted rather
+than slowing requests down.
+
+Threads don't survive a fork, so each worker process starts its own writer
+thread on first use. Writers are flushed when the process exits (see
+flush_all, which app.py also hooks into uwsgi's atexit).
+"""
+import atexit
+from collections import Counter
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from auth_proxy import fork
+
+LOG = logging.getLogger(__name__)
+
+_WRITERS = []
+
+
+class BatchWriter(object):
+    """ Queues records and writes them to `sink` in batches.
+
+    `sink` is called with a list of records. A batch is written once it
+    holds `batch_size` records or its first record is `flush_interval`
+    seconds old.
+    """
+    def __init__(self, sink, queue_size=10000, batch_size=500, flush_interval=1.0):
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.counters = Counter()
+        self._queue = None
+        self._thread = None
+        self._stop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        _WRITERS.append(self)
+        fork.after_fork(self._forget)
+
+    def put(self, record):
+        """ Queue a record. Returns False if it was dropped.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.counters['dropped'] += 1
+            return False
+        self.counters['queued'] += 1
+        return True
+
+    def flush(self, timeout=5):
+        """ Stop the writer thread and write everything still queued.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._stop.set()
+            self._thread.join(timeout)
+            self._pid = None
+
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write(batch)
+
+    def status(self):
+        """ Queue depth and counters.
+        """
+        status = dict.fromkeys(('queued', 'dropped', 'written', 'failed', 'batches'), 0)
+        status.update(self.counters)
+        status['depth'] = self._queue.qsize() if self._pid == os.getpid() else 0
+        return status
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='batch-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _forget(self):
+        # The parent's thread and queue don't exist in a forked child.
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _run(self):
+        stop = self._stop
+        while not stop.is_set():
+            batch = self._collect(stop)
+            if batch:
+                self._write(batch)
+
+    def _collect(self, stop):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.sink(batch)
+        except Exception:  # pylint: disable=broad-except
+            self.counters['failed'] += len(batch)
+            LOG.exception('Failed to write %d records', len(batch))
+        else:
+            self.counters['written'] += len(batch)
+            self.counters['batches'] += 1
+
+
+class RotatingFile(object):
+    """ A sink that appends records to an NDJSON file.
+
+    The file is rotated to path.1, path.2, ... once it grows past
+    `max_bytes`, keeping `backups` old files. Several processes may share
+    one file; a batch is appended (and the file rotated) under a lock.
+    """
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def __call__(self, batch):
+        data = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n'
+                       for record in batch).encode('utf-8')
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            with open(self.path, 'ab') as out:
+                out.write(data)
+                size = out.tell()
+            if size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            older = '{}.{:d}'.format(self.path, index)
+            if os.path.exists(older):
+                os.replace(older, '{}.{:d}'.format(self.path, index + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+def flush_all():
+    """ Flush every writer in this process.
+    """
+    for writer in _WRITERS:
+        writer.flush()
+
+
+atexit.register(flush_all)
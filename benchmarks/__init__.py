@@ -0,0 +1,4 @@
+""" Benchmarks and stress tests.
+
+Run them from the repository root, e.g. `python -m benchmarks.oauth_stress`.
+"""
@@ -0,0 +1,63 @@
+""" Latency cost of patient compartment verification.
+
+Streams search Bundles of synthetic Observations through the compartment
+filter in 64 KiB chunks the way the proxy does, and reads single resources
+with a large narrative through it, and compares both with a json.loads of
+the whole body.
+
+    python -m benchmarks.compartment --entries 10 100 1000
+"""
+import argparse
+import json
+
+from auth_proxy.proxy.compartment import CompartmentFilter
+from auth_proxy.proxy.requests import CHUNK_SIZE
+
+from .projection import best_of, bundle, observation
+
+PATIENT_ID = 'smart-1288992'
+
+
+def verify(body, path):
+    """ Run a body through the filter, the way ProxyService.api does.
+    """
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    response = {
+        'response': iter(chunks),
+        'status': 200,
+        'headers': {'Content-Type': 'application/json+fhir'},
+    }
+    response = CompartmentFilter().verify(path, response, PATIENT_ID)
+    body = response['response']
+    return body if isinstance(body, bytes) else b''.join(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('Search Bundles')
+    for entries in args.entries:
+        body = bundle(entries)
+        parsed = best_of(args.repeat, lambda: json.loads(body.decode('utf-8')))
+        checked = best_of(args.repeat, lambda: verify(body, 'Observation'))
+        print('  {:>5} entries, {:>8.1f} KB: {:>8.2f}ms (json.loads {:.2f}ms)'.format(
+            entries, len(body) / 1024, checked * 1000, parsed * 1000))
+
+    print('Reads')
+    for size in (1, 100, 1000):
+        resource = observation(0)
+        # Narrative first, so the scan has to get past it to the subject.
+        resource['text'] = {'div': 'x' * size * 1024}
+        resource = dict([('text', resource.pop('text'))] + list(resource.items()))
+        body = json.dumps(resource).encode('utf-8')
+        parsed = best_of(args.repeat, lambda: json.loads(body.decode('utf-8')))
+        checked = best_of(args.repeat, lambda: verify(body, 'Observation/obs-0'))
+        print('  {:>5} KB: {:>8.2f}ms (json.loads {:.2f}ms)'.format(
+            size, checked * 1000, parsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
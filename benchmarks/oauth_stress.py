@@ -0,0 +1,359 @@
+""" Multi-process stress test of the token lifecycle.
+
+Worker processes build their own app against a shared database and run a
+random mix of operations through the Flask test client:
+
+- authorize: the full authorization code flow (authorize prompt, approval,
+  code exchange), which replaces the app's tokens;
+- refresh: a refresh of the app's latest token;
+- revoke: revoking the app's latest token from /apps;
+- api: a FHIR search with the app's latest token (against a stub server).
+
+Every two workers share an app (--apps), and its latest token, so
+refreshes of one token race each other, revocations and new
+authorizations, as in a refresh storm after an outage. Requests that lose
+a race are expected to be rejected (invalid_grant, or 401 for a token that
+was just replaced); anything else that fails is an error.
+
+Besides throughput, latency, rejections and errors per operation, the
+report checks invariants: no refresh token was successfully used twice,
+and no app was left with more than one token.
+
+Rounds run against SQLite with and without SQLITE_CONCURRENCY, or against
+a database server given with --database-uri, for each --processes count.
+
+    python -m benchmarks.oauth_stress --processes 1 2 4 8 --iterations 200
+    python -m benchmarks.oauth_stress --database-uri postgresql://localhost/stress
+"""
+import argparse
+from collections import Counter
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+PASSWORD = 'demo-password'
+REDIRECT_URI = 'http://localhost/authorized'
+SCOPES = 'launch/patient patient/*.read offline_access'
+OPERATIONS = ('authorize', 'refresh', 'revoke', 'api')
+
+CSRF_RE = re.compile(r'name="csrf_token" value="([^"]+)"')
+
+
+def create_app(database_uri, concurrency, api_server=None):
+    """ Build an app for the given database in this process.
+    """
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+    from auth_proxy.application import app, create_app as _create_app
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLITE_CONCURRENCY'] = concurrency
+    app.config['API_SERVER'] = api_server
+
+    return _create_app()
+
+
+def setup_database(database_uri, apps):
+    """ Create the schema, and one user and client per app.
+    """
+    from auth_proxy.extensions import db
+    from auth_proxy.models.oauth import Client
+    from auth_proxy.models.user import Patient, User
+
+    flask_app = create_app(database_uri, False)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        for index in range(apps):
+            user = User(username='stress-{}'.format(index), password=PASSWORD)
+            user.patients.append(Patient(patient_id='patient-{}'.format(index), is_user=True))
+            db.session.add(user)
+            db.session.add(Client(client_id='stress-{}'.format(index),
+                                  client_secret='secret',
+                                  name='Stress {}'.format(index),
+                                  _redirect_uris=REDIRECT_URI,
+                                  _default_scopes=SCOPES,
+                                  _security_labels='patient'))
+        db.session.commit()
+        db.session.remove()
+        db.get_engine(flask_app).dispose()
+
+
+def check_database(database_uri):
+    """ Apps left with more than one token.
+    """
+    from auth_proxy.extensions import db
+    from auth_proxy.models.oauth import Token
+    from sqlalchemy import func
+
+    flask_app = create_app(database_uri, False)
+    with flask_app.app_context():
+        counts = db.session.query(Token.client_id, func.count(Token.id)).\
+            group_by(Token.client_id).\
+            having(func.count(Token.id) > 1).\
+            all()
+        db.session.remove()
+        db.get_engine(flask_app).dispose()
+
+    return ['{} has {} tokens'.format(client_id, count) for (client_id, count) in counts]
+
+
+class FlowClient(object):
+    """ Drives the OAuth flows through a Flask test client. Every step
+    returns the HTTP status and the JSON body, if any.
+    """
+    def __init__(self, flask_app, index):
+        self.app = flask_app
+        self.client = flask_app.test_client()
+        self.client_id = 'stress-{}'.format(index)
+        self.username = 'stress-{}'.format(index)
+        self.patient_id = 'patient-{}'.format(index)
+
+    def login(self):
+        """ Log in as the app's user.
+        """
+        response = self.client.post('/login', data={
+            'username': self.username,
+            'password': PASSWORD,
+        })
+        assert response.status_code == 302, response.status_code
+
+    def authorize(self):
+        """ Approve the client and exchange the code.
+        """
+        args = {
+            'client_id': self.client_id,
+            'redirect_uri': REDIRECT_URI,
+            'scope': SCOPES,
+            'state': 'stress',
+            'response_type': 'code',
+        }
+        response = self.client.get('/oauth/authorize', query_string=args)
+        if response.status_code != 200:
+            return response.status_code, None
+        csrf_token = CSRF_RE.search(response.get_data(as_text=True)).group(1)
+
+        form = dict(args, csrf_token=csrf_token, expires='2099-01-01',
+                    security_labels='patient', patient_id=self.patient_id)
+        response = self.client.post('/oauth/authorize', data=form)
+        if response.status_code != 302:
+            return response.status_code, None
+        code = parse_qs(urlparse(response.headers['Location']).query)['code'][0]
+
+        return self._token(grant_type='authorization_code', code=code,
+                           redirect_uri=REDIRECT_URI)
+
+    def refresh(self, token):
+        """ Refresh a token.
+        """
+        return self._token(grant_type='refresh_token',
+                           refresh_token=token['refresh_token'])
+
+    def revoke(self, token):
+        """ Revoke a token from the user's /apps page.
+        """
+        from auth_proxy.models.oauth import Token
+
+        with self.app.app_context():
+            row = Token.query.filter_by(access_token=token['access_token']).first()
+            token_id = row.id if row is not None else 0
+        response = self.client.post('/revoke/{}'.format(token_id))
+        return response.status_code, None
+
+    def api(self, token):
+        """ Search with a token.
+        """
+        response = self.client.get('/api/fhir/Observation',
+                                   query_string={'patient': self.patient_id},
+                                   headers={'Authorization': 'Bearer ' + token['access_token']})
+        response.get_data()
+        return response.status_code, None
+
+    def _token(self, **form):
+        form.update(client_id=self.client_id, client_secret='secret')
+        response = self.client.post('/oauth/token', data=form)
+        try:
+            body = json.loads(response.get_data(as_text=True))
+        except ValueError:
+            body = None
+        return response.status_code, body
+
+
+def outcome(status, body):
+    """ 'ok', 'rejected' for a lost race, or 'error'.
+    """
+    if status < 400:
+        return 'ok'
+    if status in (400, 401) and (body is None or body.get('error') == 'invalid_grant'):
+        return 'rejected'
+    return 'error'
+
+
+def worker_main(database_uri, concurrency, api_server, worker, apps, iterations, weights,
+                tokens, barrier, results):
+    """ One worker process.
+    """
+    index = worker % apps
+    flask_app = create_app(database_uri, concurrency, api_server)
+    # Errors are counted; their tracebacks would drown the report.
+    flask_app.logger.disabled = True
+    flow = FlowClient(flask_app, index)
+    flow.login()
+    rng = random.Random(worker)
+
+    samples, outcomes, errors, spent = {}, Counter(), [], []
+    barrier.wait()
+
+    for _ in range(iterations):
+        token = tokens.get(index)
+        operation = 'authorize' if token is None else \
+            rng.choices(OPERATIONS, weights=weights)[0]
+
+        start = time.perf_counter()
+        try:
+            status, body = getattr(flow, operation)(*([token] if operation != 'authorize'
+                                                      else []))
+        except Exception as err:  # pylint: disable=broad-except
+            status, body = 599, {'error': '{}: {}'.format(type(err).__name__, err)}
+        elapsed = time.perf_counter() - start
+
+        result = outcome(status, body)
+        outcomes[(operation, result)] += 1
+        if result == 'ok':
+            samples.setdefault(operation, []).append(elapsed)
+        elif result == 'error':
+            errors.append('{} {}: {}'.format(operation, status, str(body)[:200]))
+
+        if operation in ('authorize', 'refresh') and result == 'ok':
+            tokens[index] = body
+        elif operation == 'revoke' and result == 'ok':
+            tokens.pop(index, None)
+        if operation == 'refresh' and result == 'ok':
+            spent.append(token['refresh_token'])
+
+    results.put((samples, outcomes, errors, spent))
+
+
+def run(database_uri, concurrency, api_server, processes, apps, iterations, weights):
+    """ Run one stress round. Returns a summary dict.
+    """
+    setup_database(database_uri, apps)
+
+    ctx = multiprocessing.get_context('spawn')
+    manager = ctx.Manager()
+    tokens = manager.dict()
+    barrier = ctx.Barrier(processes + 1)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=worker_main,
+                           args=(database_uri, concurrency, api_server, worker, apps,
+                                 iterations, weights, tokens, barrier, results))
+               for worker in range(processes)]
+
+    for process in workers:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+
+    samples, outcomes, errors, spent = {}, Counter(), [], Counter()
+    for _ in workers:
+        worker_samples, worker_outcomes, worker_errors, worker_spent = results.get()
+        for name, values in worker_samples.items():
+            samples.setdefault(name, []).extend(values)
+        outcomes.update(worker_outcomes)
+        errors.extend(worker_errors)
+        spent.update(worker_spent)
+    elapsed = time.perf_counter() - start
+
+    for process in workers:
+        process.join()
+    manager.shutdown()
+
+    violations = ['refresh token used {} times'.format(count)
+                  for count in spent.values() if count > 1]
+    violations.extend(check_database(database_uri))
+
+    summary = {'elapsed': elapsed, 'errors': errors, 'violations': violations}
+    for name in OPERATIONS:
+        values = sorted(samples.get(name, []))
+        summary[name] = {
+            'ok': outcomes[(name, 'ok')],
+            'rejected': outcomes[(name, 'rejected')],
+            'errors': outcomes[(name, 'error')],
+            'per_second': len(values) / elapsed,
+            'p50': values[len(values) // 2] if values else 0,
+            'p95': values[int(len(values) * 0.95)] if values else 0,
+        }
+    return summary
+
+
+def report(label, summary):
+    """ Print one stress round.
+    """
+    print('{} ({:.1f}s, {} errors, {} invariant violations)'.format(
+        label, summary['elapsed'], len(summary['errors']), len(summary['violations'])))
+    for name in OPERATIONS:
+        stats = summary[name]
+        total = stats['ok'] + stats['rejected'] + stats['errors']
+        if not total:
+            continue
+        print('  {:<10} {:>6} ok {:>5} rejected {:>5} errors ({:>5.1%})  {:>8.1f}/s  '
+              'p50 {:>7.1f}ms  p95 {:>7.1f}ms'.format(
+                  name, stats['ok'], stats['rejected'], stats['errors'],
+                  stats['errors'] / total, stats['per_second'], stats['p50'] * 1000,
+                  stats['p95'] * 1000))
+    for error in sorted(set(summary['errors']))[:5]:
+        print('  error: ' + error)
+    for violation in summary['violations'][:5]:
+        print('  violation: ' + violation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[4])
+    parser.add_argument('--apps', type=int, default=None,
+                        help='apps shared by the workers (default: one per two workers)')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='operations per worker')
+    parser.add_argument('--mix', default='authorize=1,refresh=6,revoke=1,api=8',
+                        help='relative weights of the operations')
+    parser.add_argument('--mode', choices=['both', 'on', 'off'], default='both',
+                        help='SQLITE_CONCURRENCY for the SQLite rounds')
+    parser.add_argument('--database-uri', default=None,
+                        help='run against this database instead of SQLite')
+    args = parser.parse_args()
+
+    mix = dict(item.split('=') for item in args.mix.split(','))
+    weights = [float(mix.get(name, 0)) for name in OPERATIONS]
+
+    from testing import StubUpstream
+
+    stub = StubUpstream().start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if args.database_uri:
+            rounds = [(args.database_uri, True, urlparse(args.database_uri).scheme)]
+        else:
+            modes = {'both': [False, True], 'on': [True], 'off': [False]}[args.mode]
+            rounds = [('sqlite:///{}/stress-{}.sqlite'.format(tmpdir, int(concurrency)),
+                       concurrency, 'SQLITE_CONCURRENCY={}'.format(concurrency))
+                      for concurrency in modes]
+
+        for database_uri, concurrency, label in rounds:
+            for processes in args.processes:
+                apps = args.apps or max(1, processes // 2)
+                summary = run(database_uri, concurrency, stub.url, processes, apps,
+                              args.iterations, weights)
+                report('{}, {} processes, {} apps'.format(label, processes, apps), summary)
+    finally:
+        stub.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+""" Throughput of CORS preflights with and without the fast path.
+
+Calls the app's WSGI callable directly, in one thread, with the preflight
+a browser sends before an authorized FHIR search, first through Flask and
+flask_cors (CORS_PREFLIGHT=False) and then answered by the preflight
+middleware. No server or network is involved, so the numbers are the
+per-request cost of each path in this process.
+
+    python -m benchmarks.preflight --requests 20000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from werkzeug.test import EnvironBuilder
+
+HEADERS = {
+    'Origin': 'https://app.example.org',
+    'Access-Control-Request-Method': 'GET',
+    'Access-Control-Request-Headers': 'authorization, accept',
+}
+
+
+def run(wsgi_app, environ, requests):
+    """ Requests per second of `requests` preflights, and the last status.
+    """
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):  # pylint: disable=unused-argument
+        statuses.append(status)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        body = wsgi_app(dict(environ), start_response)
+        for _ in body:
+            pass
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    elapsed = time.perf_counter() - start
+
+    return requests / elapsed, statuses[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    from auth_proxy.application import app, create_app
+    from auth_proxy.extensions import preflight
+
+    directory = tempfile.mkdtemp()
+    try:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            directory, 'db.sqlite')
+        create_app()
+
+        environ = EnvironBuilder(path='/api/fhir/Observation', method='OPTIONS',
+                                 headers=HEADERS).get_environ()
+
+        results = []
+        for name, enabled in (('flask', False), ('fast path', True)):
+            app.config['CORS_PREFLIGHT'] = enabled
+            preflight.init_app(app)
+            run(app.wsgi_app, environ, min(1000, args.requests))  # warm up
+            results.append((name,) + run(app.wsgi_app, environ, args.requests))
+
+        print('{} preflights of /api/fhir/Observation'.format(args.requests))
+        for name, rate, status in results:
+            print('  {:<10} {:>10.0f} req/s  {:>8.1f} us/req  {}'.format(
+                name, rate, 1e6 / rate, status))
+        print('  speedup    {:>10.1f}x'.format(results[1][1] / results[0][1]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
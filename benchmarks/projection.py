@@ -0,0 +1,98 @@
+""" Payload size and latency cost of local _elements/_summary projection.
+
+Builds search Bundles of synthetic Observations, streams them through the
+BundleTransformer in 64 KiB chunks the way the proxy does, and reports the
+size before and after, the transform time, and what a plain json.loads and
+json.dumps round trip of the same Bundle costs for comparison.
+
+    python -m benchmarks.projection --entries 10 100 1000
+"""
+import argparse
+import json
+import time
+
+from auth_proxy.proxy.jsonstream import BundleTransformer
+from auth_proxy.proxy.projection import Projection
+from auth_proxy.proxy.requests import CHUNK_SIZE
+
+PROJECTIONS = [
+    ('_elements=code,valueQuantity', Projection(elements=['code', 'valueQuantity'])),
+    ('_summary=true', Projection(summary='true')),
+    ('_summary=data', Projection(summary='data')),
+]
+
+
+def observation(index):
+    """ A lab Observation with narrative, like most servers return.
+    """
+    return {
+        'resourceType': 'Observation',
+        'id': 'obs-{}'.format(index),
+        'meta': {'lastUpdated': '2017-01-01T00:00:00Z', 'security': [{'code': 'laboratory'}]},
+        'text': {'status': 'generated',
+                 'div': ('<div xmlns="http://www.w3.org/1999/xhtml">' +
+                         'Hemoglobin ' * 40 + '</div>')},
+        'status': 'final',
+        'category': [{'coding': [{'system': 'http://hl7.org/fhir/observation-category',
+                                  'code': 'laboratory'}]}],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '718-7',
+                             'display': 'Hemoglobin [Mass/volume] in Blood'}]},
+        'subject': {'reference': 'Patient/smart-1288992'},
+        'encounter': {'reference': 'Encounter/enc-{}'.format(index)},
+        'effectiveDateTime': '2017-01-01T10:00:00Z',
+        'issued': '2017-01-01T12:00:00Z',
+        'valueQuantity': {'value': 13.5, 'unit': 'g/dL', 'system': 'http://unitsofmeasure.org'},
+        'interpretation': {'coding': [{'code': 'N'}]},
+        'referenceRange': [{'low': {'value': 12}, 'high': {'value': 17}}],
+    }
+
+
+def bundle(entries):
+    """ A searchset Bundle, serialized.
+    """
+    return json.dumps({
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'total': entries,
+        'entry': [{'fullUrl': 'Observation/obs-{}'.format(index),
+                   'resource': observation(index)} for index in range(entries)],
+    }).encode('utf-8')
+
+
+def best_of(repeat, func):
+    """ The fastest of `repeat` runs of func, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for entries in args.entries:
+        body = bundle(entries)
+        chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+
+        roundtrip = best_of(args.repeat, lambda: json.dumps(json.loads(body.decode('utf-8'))))
+        print('{} entries, {:.1f} KB (json round trip {:.2f}ms)'.format(
+            entries, len(body) / 1024, roundtrip * 1000))
+
+        for label, projection in PROJECTIONS:
+            transformer = BundleTransformer(projection.entry)
+            projected = b''.join(transformer(chunks))
+            elapsed = best_of(args.repeat, lambda: b''.join(transformer(chunks)))
+            print('  {:<30} {:>8.1f} KB ({:>3.0f}% smaller) {:>8.2f}ms'.format(
+                label, len(projected) / 1024, 100 - 100 * len(projected) / len(body),
+                elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+""" Replay a traffic capture against a local build.
+
+Reads capture files (written with CAPTURE=True, see auth_proxy/capture.py)
+and replays them through the Flask test client from a pool of threads, at
+the captured pace (or --speed times faster):
+
+- Every captured client and token gets a synthetic stand-in: one client
+  per captured client, and one patient and token per captured token,
+  minted in one batch with create_debug_tokens().
+- The upstream is a StubUpstream that answers each request after its
+  captured upstream latency, with a body of its captured size: a Bundle of
+  Observations for searches, a padded resource for reads, bytes for Binary.
+- Token requests are replayed as refresh grants of a token of their own,
+  since the browser part of an authorization can't be replayed.
+
+The report compares, per route, the replayed latency with the captured one.
+
+    python -m benchmarks.replay capture.ndjson capture.ndjson.1 --speed 2 --threads 8
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+TOKEN_ROUTE = 'oauth.cb_oauth_token'
+SCOPES = 'launch/patient patient/*.read offline_access'
+ELEMENTS = ['code', 'status', 'subject', 'effectiveDateTime', 'valueQuantity',
+            'category', 'issued', 'performer']
+
+
+def load(paths, limit=None):
+    """ The captured records of every file, oldest first.
+    """
+    records = []
+    for path in paths:
+        with open(path) as source:
+            records.extend(json.loads(line) for line in source if line.strip())
+    records.sort(key=lambda record: record['t'])
+    return records[:limit] if limit else records
+
+
+def observation(patient_id, index, pad=0):
+    """ A small Observation of patient_id, padded by `pad` characters.
+    """
+    return {
+        'resourceType': 'Observation',
+        'id': 'obs-{}'.format(index),
+        'text': {'status': 'generated', 'div': '<div>' + 'x' * pad + '</div>'},
+        'status': 'final',
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '718-7'}]},
+        'subject': {'reference': 'Patient/' + patient_id},
+        'valueQuantity': {'value': 13.5, 'unit': 'g/dL'},
+    }
+
+
+def upstream_body(record, patient_id):
+    """ An upstream response body about the captured size of record's.
+    """
+    size = record.get('response_bytes') or 0
+    resource_type = record.get('resource_type')
+
+    if resource_type == 'Binary':
+        return b'\0' * size
+    if record.get('interaction') == 'search':
+        entry_size = len(json.dumps({'resource': observation(patient_id, 0)}))
+        entries = max(1, size // entry_size) if size else 0
+        pad = max(0, size - entries * entry_size) // max(entries, 1)
+        return {
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'total': entries,
+            'entry': [{'resource': observation(patient_id, index, pad)}
+                      for index in range(entries)],
+        }
+    if resource_type == 'Patient':
+        return {'resourceType': 'Patient', 'id': patient_id, 'text': {'div': 'x' * size}}
+
+    resource = observation(patient_id, 0, size)
+    resource['resourceType'] = resource_type or 'Observation'
+    return resource
+
+
+class Replay(object):
+    """ Replays records against an app built in this process.
+    """
+    def __init__(self, records, directory):
+        from testing import StubUpstream
+
+        self.records = records
+        self.directory = directory
+        self.tokens = {}        # captured token -> [access, refresh, client_id, patient_id]
+        self.clients = {}       # captured client -> client_id
+        self.refresh_clients = {}
+        self.refresh_tokens = {}  # captured client -> the token its token requests refresh
+        self.refresh_locks = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+        self.stub = StubUpstream()
+        self.stub.handler = self._upstream
+        self.app = None
+
+    def setup(self):
+        """ Build the app and mint the synthetic clients and tokens.
+        """
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+        from auth_proxy.application import app, create_app
+        from auth_proxy.extensions import db
+        from auth_proxy.models.oauth import Client
+        from auth_proxy.models.user import Patient, User
+        from auth_proxy.services import oauth_service
+
+        self.stub.start()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}/replay.sqlite'.format(
+            self.directory)
+        app.config['API_SERVER'] = self.stub.url
+        app.config['CAPTURE'] = False
+        self.app = create_app()
+
+        clients = sorted({record.get('client') or '' for record in self.records})
+        tokens = sorted({record['token'] for record in self.records if record.get('token')})
+        token_clients = {record['token']: record.get('client') or ''
+                         for record in self.records if record.get('token')}
+        refreshing = sorted({record.get('client') or '' for record in self.records
+                             if record['route'] == TOKEN_ROUTE})
+
+        # Refreshing a token deletes the client's other tokens, so token
+        # requests go to a client of their own, with a single token.
+        for index, client in enumerate(clients):
+            self.clients[client] = 'replay-client-{}'.format(index)
+        for index, client in enumerate(refreshing):
+            self.refresh_clients[client] = 'replay-refresh-{}'.format(index)
+        owners = [self.clients[token_clients[token]] for token in tokens] + \
+            [self.refresh_clients[client] for client in refreshing]
+
+        with self.app.app_context():
+            db.create_all()
+            user = User(username='replay', password='replay')
+            client_ids = set(self.clients.values()) | set(self.refresh_clients.values())
+            for client_id in sorted(client_ids):
+                db.session.add(Client(client_id=client_id, client_secret='secret',
+                                      name=client_id, _default_scopes=SCOPES,
+                                      _redirect_uris='http://localhost/replay'))
+            for index, _ in enumerate(owners):
+                user.patients.append(Patient(patient_id='replay-patient-{}'.format(index)))
+            db.session.add(user)
+            db.session.commit()
+
+            specs = [{
+                'client_id': client_id,
+                'access_lifetime': 24 * 60 * 60,
+                'approval_expires': time.time() + 24 * 60 * 60,
+                'scopes': SCOPES,
+                'user': 'replay',
+                'patient_id': 'replay-patient-{}'.format(index),
+            } for (index, client_id) in enumerate(owners)]
+            minted = oauth_service.create_debug_tokens(specs) if specs else []
+
+        for key, spec, (access, refresh) in zip(tokens + refreshing, specs, minted):
+            token = [access, refresh, spec['client_id'], spec['patient_id']]
+            if len(self.tokens) < len(tokens):
+                self.tokens[key] = token
+            else:
+                self.refresh_tokens[key] = token
+                self.refresh_locks[key] = threading.Lock()
+
+    def run(self, speed, threads):
+        """ Replay every record at the captured pace divided by speed.
+        """
+        executor = ThreadPoolExecutor(max_workers=threads)
+        first = self.records[0]['t']
+        start = time.perf_counter()
+
+        for index, record in enumerate(self.records):
+            delay = (record['t'] - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self._send, index, record)
+
+        executor.shutdown(wait=True)
+        return time.perf_counter() - start
+
+    def stop(self):
+        """ Stop the stub upstream.
+        """
+        self.stub.stop()
+
+    def _client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def _send(self, index, record):
+        route = '{} {}'.format(record['route'], record.get('interaction') or '').strip()
+        start = time.perf_counter()
+        try:
+            if record['route'] == TOKEN_ROUTE:
+                status = self._refresh(record)
+            else:
+                status = self._api(index, record)
+        except Exception as err:  # pylint: disable=broad-except
+            status = type(err).__name__
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.samples[route].append((elapsed, record.get('duration_ms', 0) / 1000))
+            self.statuses[route][status] += 1
+
+    def _api(self, index, record):
+        token = self.tokens[record['token']]
+        resource_type = record.get('resource_type') or 'metadata'
+        path = resource_type
+        if record.get('interaction') == 'read':
+            path += '/' + (token[3] if resource_type == 'Patient' else 'replay-{}'.format(index))
+
+        args = {}
+        for name in record.get('args', []):
+            if name == '_count':
+                args[name] = record.get('count') or 10
+            elif name == '_summary':
+                args[name] = record.get('summary') or 'true'
+            elif name == '_elements':
+                args[name] = ','.join(ELEMENTS[:record.get('elements') or 1])
+            elif name in ('patient', 'beneficiary'):
+                args[name] = token[3]
+            else:
+                args[name] = 'replay'
+
+        headers = {
+            'Authorization': 'Bearer ' + token[0],
+            # FlaskClient forwards Origin, which tells the stub which record this is.
+            'Origin': 'replay-{}'.format(index),
+        }
+        if record.get('accept'):
+            headers['Accept'] = record['accept']
+        if record.get('range'):
+            headers['Range'] = 'bytes=0-1023'
+
+        response = self._client().open('/api/fhir/' + path, method=record.get('method', 'GET'),
+                                       query_string=args, headers=headers)
+        response.get_data()
+        return response.status_code
+
+    def _refresh(self, record):
+        client = record.get('client') or ''
+        token = self.refresh_tokens[client]
+
+        # An app refreshes its token once at a time; the next refresh needs
+        # the refresh token this one returns.
+        with self.refresh_locks[client]:
+            response = self._client().post('/oauth/token', data={
+                'grant_type': 'refresh_token',
+                'refresh_token': token[1],
+                'client_id': token[2],
+                'client_secret': 'secret',
+            })
+            if response.status_code == 200:
+                data = json.loads(response.get_data(as_text=True))
+                token[0], token[1] = data['access_token'], data['refresh_token']
+        return response.status_code
+
+    def _upstream(self, handler):
+        origin = handler.headers.get('Origin', '')
+        if not origin.startswith('replay-'):
+            return None
+        index = int(origin[len('replay-'):])
+        record = self.records[index]
+        token = self.tokens[record['token']]
+
+        time.sleep((record.get('upstream_ms') or 0) / 1000)
+
+        status = record.get('status', 200)
+        if status >= 500 or status in (401, 403, 429):
+            status = 200
+        content_type = 'application/octet-stream' if record.get('resource_type') == 'Binary' \
+            else 'application/json+fhir'
+        return (status, {'Content-Type': content_type}, upstream_body(record, token[3]))
+
+
+def percentile(values, fraction):
+    """ The value at `fraction` of the sorted values.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(replay, elapsed, captured):
+    """ Print the replayed and captured latencies per route.
+    """
+    print('{} requests in {:.1f}s ({:.1f}/s), captured over {:.1f}s'.format(
+        len(replay.records), elapsed, len(replay.records) / elapsed, captured))
+    print('  {:<32} {:>6}  {:>17}  {:>17}  statuses'.format(
+        'route', 'count', 'p50 replay/capt', 'p95 replay/capt'))
+    for route in sorted(replay.samples):
+        samples = replay.samples[route]
+        replayed = [sample[0] * 1000 for sample in samples]
+        original = [sample[1] * 1000 for sample in samples]
+        statuses = ' '.join('{}:{}'.format(status, count)
+                            for (status, count) in sorted(replay.statuses[route].items(),
+                                                          key=str))
+        print('  {:<32} {:>6}  {:>7.1f}/{:<7.1f}ms  {:>7.1f}/{:<7.1f}ms  {}'.format(
+            route, len(samples), percentile(replayed, 0.5), percentile(original, 0.5),
+            percentile(replayed, 0.95), percentile(original, 0.95), statuses))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay this many times faster than captured')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+
+    records = load(args.captures, args.limit)
+    if not records:
+        parser.error('no records to replay')
+
+    directory = tempfile.mkdtemp()
+    replay = Replay(records, directory)
+    try:
+        replay.setup()
+        elapsed = replay.run(args.speed, args.threads)
+        report(replay, elapsed, records[-1]['t'] - records[0]['t'])
+    finally:
+        replay.stop()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+""" Latency of replacing and revoking the tokens of a client.
+
+Gives one client many tokens in a temporary SQLite database and times:
+
+- replacing them with a new authorization, the way create_authorization
+  did before (load every token, delete them one by one) and the way it
+  does now (one DELETE);
+- revoking them, one revoke_token() call per token (what revoking an app
+  took before) and one revoke_tokens() call by client_id.
+
+    python -m benchmarks.revocation --tokens 100 1000 10000 100000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+PATIENT_ID = 'smart-1288992'
+USERNAME = 'daniel-adams'
+
+# Revoking token by token is only timed up to this many tokens.
+ONE_BY_ONE_LIMIT = 10000
+
+
+def create_app(database_uri):
+    """ Build an app for the database, with one client, user and patient.
+    """
+    from auth_proxy.application import app, create_app as _create_app
+    from auth_proxy.extensions import db
+    from auth_proxy.models.oauth import Client
+    from auth_proxy.models.user import Patient, User
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    flask_app = _create_app()
+
+    with flask_app.app_context():
+        db.create_all()
+        db.session.add(Client(client_id='client', client_secret='secret', name='client'))
+        user = User(username=USERNAME, password='demo-password')
+        user.patients.append(Patient(patient_id=PATIENT_ID))
+        db.session.add(user)
+        db.session.commit()
+
+    return flask_app
+
+
+def mint(count):
+    """ Give the client `count` tokens.
+    """
+    from auth_proxy.services import oauth_service
+
+    oauth_service.create_debug_tokens([{
+        'client_id': 'client',
+        'access_lifetime': 3600,
+        'approval_expires': time.time() + 3600,
+        'scopes': 'patient/*.read',
+        'user': USERNAME,
+        'patient_id': PATIENT_ID,
+    }] * count)
+
+
+def replace_one_by_one(user):
+    """ create_authorization as it was: load the tokens, delete each.
+    """
+    from auth_proxy.extensions import db
+    from auth_proxy.models.oauth import Token
+
+    for token in db.session.query(Token).filter_by(client_id='client').all():
+        db.session.delete(token)
+    db.session.add(Token(client_id='client', user_id=user.id, patient_id=PATIENT_ID))
+    db.session.commit()
+
+
+def revoke_one_by_one():
+    """ What revoking an app took: one revoke_token() per token.
+    """
+    from auth_proxy.extensions import db
+    from auth_proxy.models.oauth import Token
+    from auth_proxy.services import oauth_service
+
+    ids = [row.id for row in db.session.query(Token.id).filter_by(client_id='client')]
+    for token_id in ids:
+        oauth_service.revoke_token(token_id)
+
+
+def timed(func, *args):
+    """ Seconds func(*args) takes.
+    """
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tokens', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    args = parser.parse_args()
+
+    from auth_proxy.extensions import db
+    from auth_proxy.models.user import User
+    from auth_proxy.services import oauth_service
+
+    print('{:>8}  {:>14}  {:>14}  {:>14}  {:>14}'.format(
+        'tokens', 'replace: each', 'replace: set', 'revoke: each', 'revoke: set'))
+    for count in args.tokens:
+        directory = tempfile.mkdtemp()
+        try:
+            flask_app = create_app('sqlite:///' + os.path.join(directory, 'db.sqlite'))
+            with flask_app.app_context():
+                user = db.session.query(User).filter_by(username=USERNAME).first()
+                expires = time.time() + 3600
+
+                mint(count)
+                replace_each = timed(replace_one_by_one, user)
+                mint(count)
+                replace_set = timed(oauth_service.create_authorization, 'client', expires,
+                                    'patient', user, PATIENT_ID)
+
+                revoke_each = None
+                if count <= ONE_BY_ONE_LIMIT:
+                    mint(count)
+                    revoke_each = timed(revoke_one_by_one)
+                mint(count)
+                revoke_set = timed(oauth_service.revoke_tokens, 'client')
+
+                db.session.remove()
+        finally:
+            shutil.rmtree(directory)
+
+        print('{:>8}  {:>12.1f}ms  {:>12.1f}ms  {:>14}  {:>12.1f}ms'.format(
+            count, replace_each * 1000, replace_set * 1000,
+            '{:.1f}ms'.format(revoke_each * 1000) if revoke_each is not None else '-',
+            revoke_set * 1000))
+
+
+if __name__ == '__main__':
+    main()
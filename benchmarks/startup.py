@@ -0,0 +1,168 @@
+""" Startup budget: import time and per-worker memory.
+
+Reports how long it takes to import and build the application, which
+modules dominate that time, and the memory of forked workers when the app
+is preloaded in the master (the production startup mode) versus built in
+each worker after the fork.
+
+    python -m benchmarks.startup --workers 4
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_profile():
+    """ Import app.py under -X importtime. Returns (total, top modules).
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True,
+        universal_newlines=True,
+    ).stderr
+
+    total = 0
+    packages = {}
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 1:
+            total += cumulative
+        # Only count each top level package once, at its outermost import.
+        package = name.split('.')[0]
+        packages[package] = max(packages.get(package, 0), cumulative)
+
+    top = sorted(packages.items(), key=lambda item: -item[1])[:10]
+    return total / 1e6, [(name, micros / 1e6) for name, micros in top]
+
+
+def memory():
+    """ This process' memory in kB, from /proc/self/smaps_rollup.
+    """
+    usage = {}
+    with open('/proc/self/smaps_rollup') as handle:
+        for line in handle:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                usage[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss': usage.get('Rss', 0),
+        'pss': usage.get('Pss', 0),
+        'private': usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0),
+    }
+
+
+def build_app():
+    """ Import and build the app. Returns it with the time taken.
+    """
+    start = time.perf_counter()
+    import app as module
+    return module.app, time.perf_counter() - start
+
+
+def exercise(flask_app):
+    """ Serve a few requests, so the worker touches the code it needs.
+    """
+    client = flask_app.test_client()
+    for _ in range(20):
+        client.get('/login')
+        client.post('/oauth/introspect', data={'token': 'x'})
+        client.get('/api/fhir/Patient')
+
+
+def child(mode, workers, database):
+    """ Fork the workers and print their memory as JSON.
+    """
+    os.environ['STARTUP_MODE'] = 'production'
+
+    if mode == 'preload':
+        flask_app, build_time = build_app()
+        from auth_proxy.extensions import db
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = database
+        with flask_app.app_context():
+            db.create_all()
+        from auth_proxy import fork
+        fork.freeze()
+
+    pipes = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            os.close(read_fd)
+            if mode == 'lazy':
+                flask_app, build_time = build_app()
+                flask_app.config['SQLALCHEMY_DATABASE_URI'] = database
+            exercise(flask_app)
+            report = dict(memory(), build_time=build_time)
+            with os.fdopen(write_fd, 'w') as handle:
+                json.dump(report, handle)
+            # Keep every worker alive until all are measured, so shared
+            # pages are counted as shared.
+            time.sleep(2)
+            os._exit(0)  # pylint: disable=protected-access
+        os.close(write_fd)
+        pipes.append(read_fd)
+
+    reports = []
+    for read_fd in pipes:
+        with os.fdopen(read_fd) as handle:
+            reports.append(json.load(handle))
+    for _ in pipes:
+        os.wait()
+
+    print(json.dumps(reports))
+
+
+def measure(mode, workers, database):
+    """ Run child() in a fresh interpreter.
+    """
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup', '--child', mode,
+         '--workers', str(workers), '--database', database],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--child', choices=['preload', 'lazy'])
+    parser.add_argument('--database')
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.workers, args.database)
+        return
+
+    total, top = import_profile()
+    print('import app: {:.3f}s'.format(total))
+    for name, seconds in top:
+        print('  {:<24} {:.3f}s'.format(name, seconds))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = 'sqlite:///{}/startup.sqlite'.format(tmpdir)
+        for mode in ('lazy', 'preload'):
+            reports = measure(mode, args.workers, database)
+            print('{} ({} workers):'.format(mode, args.workers))
+            print('  build in worker  {:.3f}s'.format(
+                sum(report['build_time'] for report in reports) / len(reports)
+                if mode == 'lazy' else 0.0))
+            for key in ('rss', 'pss', 'private'):
+                values = [report[key] for report in reports]
+                print('  {:<16} {:>8.1f} MB per worker'.format(
+                    key, sum(values) / len(values) / 1024))
+
+
+if __name__ == '__main__':
+    main()
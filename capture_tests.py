@@ -0,0 +1,79 @@
+from auth_proxy.extensions import capture
+from testing import AppTestCase, StubUpstream
+import unittest
+import json
+import os
+
+PATIENT_ID = "smart-1288992"
+
+
+class CaptureTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream(body={
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'entry': [{'resource': {'resourceType': 'Observation', 'id': 'obs-1',
+                                    'subject': {'reference': 'Patient/' + PATIENT_ID}}}],
+        }).start()
+        self.path = os.path.join(self.directory, 'capture.ndjson')
+        self.start_app(API_SERVER=self.stub.url, CAPTURE=True, CAPTURE_PATH=self.path,
+                       ADMIN_TOKEN="admin-secret")
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def records(self):
+        capture.flush()
+        with open(self.path) as source:
+            return [json.loads(line) for line in source]
+
+    def test_api_request(self):
+        response = self.app.get('/api/fhir/Observation?patient={}&_count=5&category=vital-signs'
+                                .format(PATIENT_ID), headers=self.headers)
+        assert response.status_code == 200
+        response.get_data()
+        response.close()
+
+        record, = self.records()
+        assert record['route'] == 'api.api_fhir_proxy'
+        assert record['resource_type'] == 'Observation'
+        assert record['interaction'] == 'search'
+        assert record['args'] == ['_count', 'category', 'patient']
+        assert record['count'] == 5
+        assert record['status'] == 200
+        assert record['response_bytes'] > 0
+        assert record['upstream_ms'] > 0
+        assert record['duration_ms'] >= record['upstream_ms']
+        assert record['token'] and record['client']
+
+        with open(self.path) as source:
+            text = source.read()
+        for secret in (PATIENT_ID, self.access_token, self.CLIENT_ID, 'vital-signs'):
+            assert secret not in text
+
+    def test_token_request(self):
+        self.app.post('/oauth/token', data={'grant_type': 'refresh_token',
+                                            'refresh_token': 'nope',
+                                            'client_id': self.CLIENT_ID,
+                                            'client_secret': self.CLIENT_SECRET})
+
+        record, = self.records()
+        assert record['route'] == 'oauth.cb_oauth_token'
+        assert record['grant_type'] == 'refresh_token'
+        assert record['client'] and record['client'] != self.CLIENT_ID
+        assert 'token' not in record
+
+    def test_status(self):
+        assert self.app.get('/api/status/capture', headers=self.headers).status_code == 403
+
+        response = self.app.get('/api/status/capture',
+                                headers={'Authorization': 'Bearer admin-secret'})
+        status = json.loads(response.get_data(as_text=True))
+        assert status['enabled']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+from auth_proxy.application import app
+from auth_proxy.proxy.compartment import belongs, references_patient
+from auth_proxy.proxy.jsonstream import top_level
+from testing import AppTestCase, StubUpstream
+from urllib import parse
+import unittest
+import json
+
+PATIENT_ID = "smart-1288992"
+
+
+def observation(index, patient_id=PATIENT_ID):
+    return {
+        'resourceType': 'Observation',
+        'id': 'obs-{}'.format(index),
+        'text': {'div': '<div>"subject": {"reference": "Patient/other"}</div>'},
+        'subject': {'reference': 'Patient/' + patient_id},
+        'valueQuantity': {'value': index},
+    }
+
+
+class CompartmentTestCase(unittest.TestCase):
+
+    def test_references_patient(self):
+        assert references_patient('Patient/' + PATIENT_ID, PATIENT_ID)
+        assert references_patient('https://fhir.example.com/Patient/' + PATIENT_ID, PATIENT_ID)
+        assert references_patient('Patient/' + PATIENT_ID + '/_history/2', PATIENT_ID)
+        assert not references_patient('Patient/' + PATIENT_ID + '0', PATIENT_ID)
+        assert not references_patient('Group/1', PATIENT_ID)
+
+    def test_belongs(self):
+        assert belongs(observation(1), PATIENT_ID)
+        assert not belongs(observation(1, 'other'), PATIENT_ID)
+        assert belongs({'resourceType': 'Patient', 'id': PATIENT_ID}, PATIENT_ID)
+        assert not belongs({'resourceType': 'Patient', 'id': 'other'}, PATIENT_ID)
+        assert belongs({'resourceType': 'Practitioner', 'id': 'dr'}, PATIENT_ID)
+        assert not belongs({'resourceType': 'Coverage',
+                            'beneficiary': [{'reference': 'Patient/other'}]}, PATIENT_ID)
+
+    def test_top_level(self):
+        text = json.dumps(observation(1, 'other'), indent=2)
+
+        values = top_level(text, ('resourceType', 'subject', 'patient'))
+
+        assert values == {'resourceType': 'Observation',
+                          'subject': {'reference': 'Patient/other'}}
+
+
+class CompartmentProxyTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resources = {
+            'Observation/mine': observation(1),
+            'Observation/theirs': observation(2, 'other'),
+            'Patient/' + PATIENT_ID: {'resourceType': 'Patient', 'id': PATIENT_ID},
+            'Patient/other': {'resourceType': 'Patient', 'id': 'other'},
+        }
+        self.stub = StubUpstream(body={
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'entry': [{'resource': observation(index, 'other' if index % 3 else PATIENT_ID)}
+                      for index in range(6)],
+        }).start()
+
+        def handler(request):
+            path, _, query = request.path.lstrip('/').partition('?')
+            if path in self.resources:
+                resource = self.resources[path]
+                elements = parse.parse_qs(query).get('_elements')
+                if elements:
+                    # Projects like an upstream that supports _elements.
+                    resource = {key: value for (key, value) in resource.items()
+                                if key in ('resourceType', 'id') or key in elements[0]}
+                return (200, {'Content-Type': 'application/json+fhir'}, resource)
+        self.stub.handler = handler
+
+        self.start_app(API_SERVER=self.stub.url, ADMIN_TOKEN="admin-secret")
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def get(self, path):
+        return self.app.get('/api/fhir/' + path, headers=self.headers)
+
+    def test_reads(self):
+        assert self.get('Observation/mine').status_code == 200
+        assert self.get('Patient/' + PATIENT_ID).status_code == 200
+
+        response = self.get('Observation/theirs')
+        assert response.status_code == 403
+        assert 'Observation/theirs' in json.loads(response.get_data(as_text=True))['error']
+
+        assert self.get('Patient/other').status_code == 403
+
+    def test_search_drops_other_patients(self):
+        response = self.get('Observation?patient=' + PATIENT_ID)
+
+        assert response.status_code == 200
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [entry['resource']['id'] for entry in bundle['entry']] == ['obs-0', 'obs-3']
+
+        response = self.app.get('/api/status/upstream',
+                                headers={'Authorization': 'Bearer admin-secret'})
+        status = json.loads(response.get_data(as_text=True))
+        assert status['compartment']['dropped'] >= 4
+
+    def test_projected_reads(self):
+        for mode in ('local', 'upstream'):
+            app.config["UPSTREAM_PROJECTION"] = mode
+
+            response = self.get('Observation/mine?_elements=valueQuantity')
+            assert response.status_code == 200, mode
+            assert 'subject' not in json.loads(response.get_data(as_text=True))
+
+            response = self.get('Observation/theirs?_elements=valueQuantity')
+            assert response.status_code == 403, mode
+
+    def test_bundles_of_reads(self):
+        # The stub answers these with the mixed search Bundle.
+        for path in ('Patient/other/_history', 'Patient/other/Observation',
+                     'Observation/theirs/_history'):
+            response = self.get(path)
+
+            assert response.status_code == 200
+            bundle = json.loads(response.get_data(as_text=True))
+            assert [entry['resource']['id'] for entry in bundle['entry']] == \
+                ['obs-0', 'obs-3'], path
+
+    def test_other_formats(self):
+        as_json = self.stub.handler
+
+        def handler(request):
+            # Answers in the format it is asked for.
+            if '_format=xml' in request.path or 'xml' in request.headers.get('Accept', ''):
+                return (200, {'Content-Type': 'application/xml+fhir'}, b'<Observation/>')
+            return as_json(request)
+        self.stub.handler = handler
+
+        assert self.get('Observation/theirs?_format=xml').status_code == 403
+        assert '_format' not in self.stub.requests[-1]
+
+        response = self.app.get('/api/fhir/Observation?patient=' + PATIENT_ID,
+                                headers=dict(self.headers, Accept='application/xml+fhir'))
+        assert response.status_code == 200
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [entry['resource']['id'] for entry in bundle['entry']] == ['obs-0', 'obs-3']
+
+        # An upstream that answers XML whatever it is asked for.
+        self.stub.handler = lambda request: (
+            200, {'Content-Type': 'application/xml+fhir'}, b'<Observation/>')
+
+        assert self.get('Observation/mine?_format=xml').status_code == 403
+        assert self.get('Observation?patient=' + PATIENT_ID).status_code == 403
+
+    def test_disabled(self):
+        app.config["COMPARTMENT_CHECK"] = False
+
+        assert self.get('Observation/theirs').status_code == 200
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,5 @@
 from auth_proxy.application import app, create_app
-from auth_proxy.models.oauth import Client
+from auth_proxy.models.oauth import Client, Token
 from auth_proxy.models.user import Patient, User
 from auth_proxy.extensions import db
 import unittest
@@ -71,5 +71,92 @@ class AuthproxyTestCase(unittest.TestCase):
         returned_access_token = json.loads(token_introspection_response.get_data(as_text=True))["access_token"]
         assert access_token == returned_access_token
 
+    def test_debug_token_batch(self):
+
+        batch_input = {"client_id": self.CLIENT_ID,
+                       "scope": "patient/*.read",
+                       "username": self.USERNAME,
+                       "patient_id": self.PATIENT_ID,
+                       "count": 50}
+
+        response = self.app.post('/oauth/debug/tokens',
+                                 data=json.dumps(batch_input),
+                                 content_type='application/json')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+
+        tokens = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert len(tokens) == 50
+        assert len({token["access_token"] for token in tokens}) == 50
+
+        # Every token works.
+        for token in tokens[::10]:
+            response = self.app.get('/oauth/debug/introspect?token=%s' % token["access_token"])
+            data = json.loads(response.get_data(as_text=True))
+            assert data["active"]
+            assert data["scope"] == "patient/*.read"
+            assert data["username"] == self.USERNAME
+
+        response = self.app.get('/oauth/debug/introspect?token=%s' % tokens[0]["refresh_token"])
+        assert response.status_code == 200
+
+    def test_debug_token_batch_specs(self):
+
+        batch_input = {"client_id": self.CLIENT_ID,
+                       "username": self.USERNAME,
+                       "patient_id": self.PATIENT_ID,
+                       "tokens": [{"scope": "patient/Patient.read"},
+                                  {"scope": "patient/Observation.read", "access_lifetime": 60}]}
+
+        response = self.app.post('/oauth/debug/tokens',
+                                 data=json.dumps(batch_input),
+                                 content_type='application/json')
+        tokens = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        scopes = []
+        for token in tokens:
+            response = self.app.get('/oauth/debug/introspect?token=%s' % token["access_token"])
+            scopes.append(json.loads(response.get_data(as_text=True))["scope"])
+        assert scopes == ["patient/Patient.read", "patient/Observation.read"]
+
+    def test_debug_token_batch_invalid(self):
+
+        # One bad spec fails the whole batch, and nothing is written.
+        batch_input = {"client_id": self.CLIENT_ID,
+                       "username": self.USERNAME,
+                       "tokens": [{"patient_id": self.PATIENT_ID},
+                                  {"patient_id": "someone-else"}]}
+
+        response = self.app.post('/oauth/debug/tokens',
+                                 data=json.dumps(batch_input),
+                                 content_type='application/json')
+        assert response.status_code == 400
+        assert json.loads(response.get_data(as_text=True))["error"] == "no_patient_for_user"
+
+        with self.auth_app.app_context():
+            assert Token.query.count() == 0
+
+    def test_debug_token_batch_malformed(self):
+
+        batch_inputs = [
+            ({"tokens": ["not-an-object"]}, "malformed_tokens"),
+            ({"tokens": {"patient_id": self.PATIENT_ID}}, "malformed_tokens"),
+            ({"tokens": [{"access_lifetime": [3600]}]}, "malformed_lifetime"),
+            ({"tokens": [{"approval_expires": {"at": 0}}]}, "malformed_expiration"),
+            ({"tokens": [{"patient_id": [self.PATIENT_ID]}]}, "malformed_patient_id"),
+            ({"tokens": [{"scope": ["launch/patient"]}]}, "malformed_scope"),
+            ({"count": 1, "client_id": [self.CLIENT_ID]}, "malformed_client_id"),
+        ]
+
+        for batch_input, error in batch_inputs:
+            batch_input = dict({"client_id": self.CLIENT_ID,
+                                "username": self.USERNAME,
+                                "patient_id": self.PATIENT_ID}, **batch_input)
+            response = self.app.post('/oauth/debug/tokens',
+                                     data=json.dumps(batch_input),
+                                     content_type='application/json')
+            assert response.status_code == 400
+            assert json.loads(response.get_data(as_text=True))["error"] == error
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+from auth_proxy.application import app
+from auth_proxy.models.oauth import Token
+from auth_proxy.extensions import usage
+from testing import AppTestCase, FrontProxy, StubUpstream
+from urllib import parse
+from werkzeug.serving import make_server
+import requests
+import threading
+import unittest
+import json
+
+PATIENT_ID = "smart-1288992"
+
+
+def observation(patient_id):
+    return {'resourceType': 'Observation', 'id': 'obs',
+            'subject': {'reference': 'Patient/' + patient_id}}
+
+
+class DelegateTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        resources = {
+            'Observation/mine': observation(PATIENT_ID),
+            'Observation/theirs': observation('other'),
+        }
+        self.stub = StubUpstream(body={
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'entry': [{'resource': observation(PATIENT_ID)}],
+        }).start()
+
+        def handler(request):
+            path = request.path.lstrip('/').split('?')[0]
+            if path in resources:
+                return (200, {'Content-Type': 'application/json+fhir'}, resources[path])
+            if path.startswith('Binary/'):
+                return (200, {'Content-Type': 'application/pdf'}, b'%PDF' + b'x' * 1000)
+        self.stub.handler = handler
+
+        self.start_app(API_SERVER=self.stub.url, DELEGATE=True)
+
+        self.server = make_server('127.0.0.1', 0, self.auth_app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.front = FrontProxy('http://127.0.0.1:{}'.format(self.server.server_port)).start()
+
+    def tearDown(self):
+        self.front.stop()
+        self.server.shutdown()
+        self.stub.stop()
+        super().tearDown()
+
+    def get(self, path, headers=None):
+        return requests.get(self.front.url + '/api/fhir/' + path,
+                            headers=self.headers if headers is None else headers)
+
+    def test_search_is_fetched_from_upstream(self):
+        app.config["COMPARTMENT_CHECK"] = False
+
+        response = self.get('Observation?patient=' + PATIENT_ID)
+
+        assert response.status_code == 200
+        assert response.json()['entry'][0]['resource']['id'] == 'obs'
+        assert self.front.fetched[-1].startswith(self.stub.url + '/Observation?')
+        args = parse.parse_qs(parse.urlparse(self.stub.requests[-1]).query)
+        assert args['_security'] == ['public', 'Patient/' + PATIENT_ID]
+
+    def test_binary_is_fetched_from_upstream(self):
+        response = self.get('Binary/doc', headers=dict(self.headers, Range='bytes=0-3'))
+
+        assert response.status_code == 200
+        assert response.content.startswith(b'%PDF')
+        assert self.front.fetched[-1] == self.stub.url + '/Binary/doc?'
+
+    def test_checked_reads_go_through_the_proxy(self):
+        response = self.get('Observation/mine')
+
+        assert response.status_code == 200
+        assert '/api/fhir/Observation/mine' in self.front.fetched[-1]
+        assert self.get('Observation/theirs').status_code == 403
+
+    def test_checked_searches_go_through_the_proxy(self):
+        self.stub.body['entry'].append({'resource': observation('other')})
+
+        response = self.get('Observation?patient=' + PATIENT_ID)
+
+        assert response.status_code == 200
+        assert len(response.json()['entry']) == 1
+        assert '/api/fhir/Observation?' in self.front.fetched[-1]
+
+    def test_passed_back_requests_are_counted_once(self):
+        app.config["USAGE_TRACKING"] = True
+        app.config["USAGE_FLUSH_INTERVAL"] = 3600
+        usage.init_app(app)
+
+        self.get('Observation/mine')
+        self.get('Observation/theirs')
+        usage.flush()
+
+        with self.auth_app.app_context():
+            assert Token.query.first().request_count == 2
+
+    def test_refused(self):
+        assert self.get('Observation', headers={}).status_code == 401
+        assert self.get('Observation?code=718-7').status_code == 403
+        assert self.get('Organization').status_code == 403
+        assert self.front.fetched == []
+
+    def test_accel_redirect(self):
+        app.config["DELEGATE_ACCEL_PREFIX"] = '/_fhir/'
+        app.config["COMPARTMENT_CHECK"] = False
+
+        response = self.app.get('/api/verify/Observation', headers=self.headers)
+        assert response.status_code == 200
+        assert response.headers['X-Accel-Redirect'].startswith('/_fhir/Observation?_security=')
+        assert response.get_data() == b''
+
+        response = self.app.get('/api/verify/Observation?_include=Observation:subject',
+                                headers=self.headers)
+        assert 'X-Accel-Redirect' not in response.headers
+        assert json.loads(response.get_data(as_text=True))['resourceType'] == 'Bundle'
+
+        app.config["COMPARTMENT_CHECK"] = True
+        response = self.app.get('/api/verify/Observation/mine', headers=self.headers)
+        assert 'X-Accel-Redirect' not in response.headers
+        assert json.loads(response.get_data(as_text=True))['id'] == 'obs'
+
+    def test_disabled(self):
+        app.config["DELEGATE"] = False
+
+        assert self.app.get('/api/verify/Observation', headers=self.headers).status_code == 404
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from auth_proxy.application import app
+from auth_proxy.grants import SharedStore, StoredGrant
+from auth_proxy.models.oauth import Grant
+from testing import AuthorizationTestCase
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import unittest
+import json
+
+
+def take(path, code, results):
+    results.put(SharedStore(path).take(code) is not None)
+
+
+class GrantStoreTestCase(AuthorizationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.grants = os.path.join(self.directory, 'grants')
+        self.start_app(GRANT_STORE_PATH=self.grants)
+
+    def check_single_use(self):
+        code = self.authorize()
+
+        response = self.exchange(code)
+        assert response.status_code == 200
+        token = json.loads(response.get_data(as_text=True))
+        assert token['patient'] == self.PATIENT_ID
+
+        replay = self.exchange(code)
+        assert replay.status_code != 200
+        assert json.loads(replay.get_data(as_text=True))['error'] == 'invalid_grant'
+
+    def test_database_store(self):
+        app.config["GRANT_STORE"] = "database"
+        self.check_single_use()
+
+        with self.auth_app.app_context():
+            assert Grant.query.count() == 0
+
+    def test_memory_store(self):
+        app.config["GRANT_STORE"] = "memory"
+        self.check_single_use()
+
+        with self.auth_app.app_context():
+            assert Grant.query.count() == 0
+
+    def test_shared_store(self):
+        app.config["GRANT_STORE"] = "shared"
+        self.check_single_use()
+
+        assert os.listdir(self.grants) == []
+
+    def test_shared_store_across_processes(self):
+        store = SharedStore(self.grants)
+        store.save(StoredGrant(self.CLIENT_ID, 'racy-code', 1, self.REDIRECT_URI, [],
+                               datetime.utcnow() + timedelta(seconds=100)))
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        workers = [context.Process(target=take, args=(self.grants, 'racy-code', results))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert sorted(results.get() for _ in workers) == [False, False, False, True]
+
+    def test_shared_store_directory(self):
+        open_directory = os.path.join(self.directory, 'open')
+        os.mkdir(open_directory)
+        os.chmod(open_directory, 0o777)
+        link = os.path.join(self.directory, 'link')
+        os.symlink(self.directory, link)
+
+        for path in (open_directory, link):
+            with self.assertRaises(PermissionError):
+                SharedStore(path)
+
+        # A planted symlink is not followed.
+        store = SharedStore(os.path.join(self.directory, 'grants'))
+        os.symlink(os.path.join(self.directory, 'planted'), store._file('planted-code'))
+        with open(os.path.join(self.directory, 'planted'), 'w') as out:
+            json.dump({'code': 'planted-code'}, out)
+        assert store.take('planted-code') is None
+
+    def test_unknown_code(self):
+        app.config["GRANT_STORE"] = "shared"
+
+        response = self.exchange('not-a-code')
+        assert json.loads(response.get_data(as_text=True))['error'] == 'invalid_grant'
+
+
+if __name__ == '__main__':
+    unittest.main()
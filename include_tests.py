@@ -0,0 +1,152 @@
+from auth_proxy.application import app
+from auth_proxy.proxy.compartment import Inclusion
+from testing import AppTestCase, StubUpstream
+from urllib import parse
+import unittest
+import json
+
+PATIENT_ID = "smart-1288992"
+
+
+def labeled(resource, *codes):
+    resource['meta'] = {'security': [{'code': code} for code in codes]}
+    return resource
+
+
+def entry(resource, mode):
+    return {'resource': resource, 'search': {'mode': mode}}
+
+
+class InclusionTestCase(unittest.TestCase):
+
+    def test_allows(self):
+        inclusion = Inclusion(['Medication', 'Practitioner'],
+                              [{'public', 'patient'}, {'Patient/' + PATIENT_ID}])
+
+        assert inclusion.allows(labeled({'resourceType': 'Medication'},
+                                        'public', 'Patient/' + PATIENT_ID))
+        assert not inclusion.allows(labeled({'resourceType': 'Medication'}, 'public'))
+        assert not inclusion.allows(labeled({'resourceType': 'Medication'},
+                                            'sensitive', 'Patient/' + PATIENT_ID))
+        assert not inclusion.allows(labeled({'resourceType': 'Organization'},
+                                            'public', 'Patient/' + PATIENT_ID))
+
+
+class IncludeProxyTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mine = ('public', 'Patient/' + PATIENT_ID)
+        self.stub = StubUpstream(body={
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'entry': [
+                entry(labeled({'resourceType': 'MedicationRequest', 'id': 'mr-1',
+                               'subject': {'reference': 'Patient/' + PATIENT_ID},
+                               'medicationReference': {'reference': 'Medication/med-1'}},
+                              *mine), 'match'),
+                entry(labeled({'resourceType': 'Medication', 'id': 'med-1'}, *mine), 'include'),
+                entry(labeled({'resourceType': 'Medication', 'id': 'med-2'}, 'public'),
+                      'include'),
+                entry(labeled({'resourceType': 'Practitioner', 'id': 'dr-1'}, *mine),
+                      'include'),
+                entry(labeled({'resourceType': 'Patient', 'id': 'other'},
+                              'public', 'Patient/other'), 'include'),
+                entry(labeled({'resourceType': 'Organization', 'id': 'org-1'}, *mine),
+                      'include'),
+            ],
+        }).start()
+
+        self.start_app(API_SERVER=self.stub.url)
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def get(self, path, **args):
+        return self.app.get('/api/fhir/' + path, query_string=args, headers=self.headers)
+
+    def test_validation(self):
+        allowed = [
+            ('MedicationRequest', '_include', 'MedicationRequest:medication'),
+            ('MedicationRequest', '_include', 'MedicationRequest:requester:Practitioner'),
+            ('Patient', '_revinclude', 'Observation:subject'),
+            ('Patient', '_revinclude', 'Observation:subject:Patient'),
+        ]
+        forbidden = [
+            ('MedicationRequest', '_include', 'Observation:subject'),
+            ('MedicationRequest', '_include', 'MedicationRequest:*'),
+            ('MedicationRequest', '_include', 'MedicationRequest:subject:Group'),
+            ('MedicationRequest', '_include', 'MedicationRequest'),
+            ('MedicationRequest/mr-1', '_include', 'MedicationRequest:medication'),
+            ('MedicationRequest', '_include:iterate', 'MedicationRequest:medication'),
+            ('Patient', '_revinclude', 'Provenance:target'),
+            ('Patient', '_revinclude', 'Observation:subject:Group'),
+        ]
+        for path, key, value in allowed:
+            assert self.get(path, **{key: value}).status_code == 200, value
+        for path, key, value in forbidden:
+            assert self.get(path, **{key: value}).status_code == 403, value
+
+    def test_includes_are_forwarded(self):
+        self.get('MedicationRequest', _include='MedicationRequest:medication')
+
+        args = parse.parse_qs(parse.urlparse(self.stub.requests[-1]).query)
+        assert args['_include'] == ['MedicationRequest:medication']
+        assert args['_security'] == ['public', 'Patient/' + PATIENT_ID]
+
+    def test_included_resources_are_checked(self):
+        response = self.get('MedicationRequest', _include='MedicationRequest:medication')
+
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [item['resource']['id'] for item in bundle['entry']] == \
+            ['mr-1', 'med-1', 'dr-1']
+
+    def test_entries_without_search_mode(self):
+        for item in self.stub.body['entry']:
+            del item['search']
+
+        response = self.get('MedicationRequest', _include='MedicationRequest:medication')
+
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [item['resource']['id'] for item in bundle['entry']] == \
+            ['mr-1', 'med-1', 'dr-1']
+
+    def test_checked_without_compartment_check(self):
+        app.config["COMPARTMENT_CHECK"] = False
+
+        response = self.get('MedicationRequest', _include='MedicationRequest:medication')
+
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [item['resource']['id'] for item in bundle['entry']] == \
+            ['mr-1', 'med-1', 'dr-1']
+
+    def test_included_resources_are_checked_as_json(self):
+        app.config["COMPARTMENT_CHECK"] = False
+
+        def handler(request):
+            # Answers in the format it is asked for.
+            if '_format=xml' in request.path or 'xml' in request.headers.get('Accept', ''):
+                return (200, {'Content-Type': 'application/xml+fhir'}, b'<Bundle/>')
+        self.stub.handler = handler
+
+        response = self.get('MedicationRequest', _include='MedicationRequest:medication',
+                            _format='xml')
+
+        assert response.status_code == 200
+        bundle = json.loads(response.get_data(as_text=True))
+        assert [item['resource']['id'] for item in bundle['entry']] == \
+            ['mr-1', 'med-1', 'dr-1']
+        assert '_format' not in self.stub.requests[-1]
+
+        # An upstream that answers XML whatever it is asked for.
+        self.stub.handler = lambda request: (
+            200, {'Content-Type': 'application/xml+fhir'}, b'<Bundle/>')
+
+        response = self.get('MedicationRequest', _include='MedicationRequest:medication',
+                            _format='xml')
+        assert response.status_code == 403
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+from auth_proxy.models.oauth import Token
+from auth_proxy.models.user import User
+from auth_proxy.extensions import db
+from auth_proxy.services import oauth_service
+from testing import AppTestCase
+from datetime import datetime, timedelta
+import base64
+import unittest
+import json
+import time
+
+
+class IntrospectionTestCase(AppTestCase):
+
+    # Tokens are created by the tests.
+    SCOPE = None
+
+    def setUp(self):
+        super().setUp()
+        self.start_app()
+
+    def create_token(self, access_lifetime=360):
+        return super().create_token(access_lifetime=access_lifetime,
+                                    approval_expires=time.time() + 365*24*60*60,
+                                    scope="patient/*.read launch/patient offline_access")
+
+    def auth_headers(self, secret=AppTestCase.CLIENT_SECRET):
+        credentials = '{}:{}'.format(self.CLIENT_ID, secret).encode()
+        return {'Authorization': 'Basic ' + base64.b64encode(credentials).decode()}
+
+    def test_single_token(self):
+        token = self.create_token()
+
+        response = self.app.post('/oauth/introspect',
+                                 data={'token': token['access_token']},
+                                 headers=self.auth_headers())
+        data = json.loads(response.get_data(as_text=True))
+
+        assert data['active']
+        assert data['client_id'] == self.CLIENT_ID
+        assert data['username'] == self.USERNAME
+        assert data['patient'] == self.PATIENT_ID
+        assert 0 < response.cache_control.max_age <= 60
+
+    def test_batch(self):
+        first = self.create_token(access_lifetime=30)
+        second = self.create_token()
+
+        tokens = [first['access_token'], 'unknown', second['refresh_token']]
+        response = self.app.post('/oauth/introspect',
+                                 data=json.dumps({'tokens': tokens}),
+                                 content_type='application/json',
+                                 headers=self.auth_headers())
+        results = json.loads(response.get_data(as_text=True))['results']
+
+        assert [result['active'] for result in results] == [True, False, True]
+        assert results[0]['token_type'] == 'Bearer'
+        assert results[2]['token_type'] == 'refresh_token'
+        assert response.cache_control.max_age <= 30
+
+    def test_requires_client_authentication(self):
+        token = self.create_token()
+
+        response = self.app.post('/oauth/introspect',
+                                 data={'token': token['access_token']},
+                                 headers=self.auth_headers(secret='wrong'))
+
+        assert response.status_code == 400
+        assert json.loads(response.get_data(as_text=True))['error'] == 'invalid_client'
+
+        response = self.app.post('/oauth/introspect',
+                                 data={'token': token['access_token'],
+                                       'client_id': self.CLIENT_ID})
+
+        assert response.status_code == 400
+        assert json.loads(response.get_data(as_text=True))['error'] == 'invalid_client'
+
+    def test_invalid_tokens(self):
+        for payload in ({'tokens': [None]}, {'tokens': ['']}, {'tokens': [{'token': 'a'}]},
+                        {'tokens': [['a']]}, ['a'], {'tokens': 'a'}):
+            response = self.app.post('/oauth/introspect',
+                                     data=json.dumps(payload),
+                                     content_type='application/json',
+                                     headers=self.auth_headers())
+            assert response.status_code == 400, payload
+
+    def test_null_refresh_token(self):
+        with self.auth_app.app_context():
+            user = User.query.first()
+            db.session.add(Token(client_id=self.CLIENT_ID, user_id=user.id,
+                                 access_token='no-refresh', token_type='Bearer',
+                                 expires=datetime.utcnow() + timedelta(hours=1),
+                                 approval_expires=datetime.utcnow() + timedelta(days=1)))
+            db.session.commit()
+
+            results, _ = oauth_service.introspect([None, 'no-refresh'])
+
+        assert [result['active'] for result in results] == [False, True]
+
+
+if __name__ == '__main__':
+    unittest.main()
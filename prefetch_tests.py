@@ -0,0 +1,108 @@
+from auth_proxy.proxy.cache import MemoryCache
+from auth_proxy.services import oauth_service
+from testing import AuthorizationTestCase, StubUpstream
+import os
+import time
+import unittest
+import json
+
+
+class PrefetchTestCase(AuthorizationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        self.cache = os.path.join(self.directory, 'cache')
+        os.mkdir(self.cache, 0o700)
+        self.start_app(API_SERVER=self.stub.url,
+                       PREFETCH=True,
+                       PREFETCH_QUERIES=['Patient/{patient}', 'Observation?patient={patient}'],
+                       PREFETCH_CACHE_PATH=self.cache)
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+        oauth_service.prefetcher._recent = {}  # pylint: disable=protected-access
+
+    def wait_for_prefetch(self, count):
+        deadline = time.time() + 5
+        while oauth_service.prefetcher.counters['fetched'] < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_first_requests_hit(self):
+        fetched = oauth_service.prefetcher.counters['fetched']
+        token = self.launch()
+        self.wait_for_prefetch(fetched + 2)
+
+        assert len(self.stub.requests) == 2
+        headers = {'Authorization': 'Bearer ' + token['access_token'],
+                   'Accept': 'application/json+fhir'}
+
+        for path in ('Patient/' + self.PATIENT_ID, 'Observation?patient=' + self.PATIENT_ID):
+            response = self.app.get('/api/fhir/' + path, headers=headers)
+            assert response.status_code == 200
+            assert json.loads(response.get_data(as_text=True))['resourceType'] == 'Bundle'
+
+        # Both were answered from the cache.
+        assert len(self.stub.requests) == 2
+
+        # A search the prefetcher didn't run goes upstream.
+        self.app.get('/api/fhir/Condition?patient=' + self.PATIENT_ID, headers=headers)
+        assert len(self.stub.requests) == 3
+
+    def test_cache_respects_security_labels(self):
+        fetched = oauth_service.prefetcher.counters['fetched']
+        self.launch()
+        self.wait_for_prefetch(fetched + 2)
+
+        assert len(os.listdir(self.cache)) == 2
+
+        # Every cached search URL carries the token's labels.
+        searches = [path for path in self.stub.requests if path.startswith('/Observation')]
+        assert '_security=public%2Cpatient' in searches[0]
+        assert '_security=Patient%2F' + self.PATIENT_ID in searches[0]
+
+    def test_refresh_prefetches_after_authentication(self):
+        token = self.launch()
+        oauth_service.prefetcher._recent = {}  # pylint: disable=protected-access
+        started = oauth_service.prefetcher.counters['tokens']
+
+        data = {'grant_type': 'refresh_token',
+                'refresh_token': token['refresh_token'],
+                'client_id': self.CLIENT_ID,
+                'client_secret': 'wrong'}
+        assert self.app.post('/oauth/token', data=data).status_code == 401
+        assert oauth_service.prefetcher.counters['tokens'] == started
+
+        data['client_secret'] = self.CLIENT_SECRET
+        assert self.app.post('/oauth/token', data=data).status_code == 200
+        assert oauth_service.prefetcher.counters['tokens'] == started + 1
+
+    def test_cache_directory(self):
+        os.chmod(self.cache, 0o777)
+        token = self.launch()
+        headers = {'Authorization': 'Bearer ' + token['access_token']}
+
+        with self.assertRaises(PermissionError):
+            self.app.get('/api/fhir/Observation', headers=headers)
+
+
+class MemoryCacheTestCase(unittest.TestCase):
+
+    def test_hits_are_copies(self):
+        cache = MemoryCache(ttl=30)
+        cache.put('GET Patient', {'status': 200, 'response': b'{}',
+                                  'headers': {'Content-Type': 'application/json+fhir'}})
+
+        hit = cache.get('GET Patient')
+        hit['status'] = 304
+        hit['headers']['X-Cache'] = 'hit'
+
+        assert cache.get('GET Patient') == {
+            'status': 200, 'response': b'{}',
+            'headers': {'Content-Type': 'application/json+fhir'},
+        }
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+from auth_proxy.application import app, create_app
+from auth_proxy.extensions import preflight
+import unittest
+
+
+class PreflightTestCase(unittest.TestCase):
+
+    HEADERS = {
+        'Origin': 'https://app.example.org',
+        'Access-Control-Request-Method': 'GET',
+        'Access-Control-Request-Headers': 'Authorization, Accept',
+    }
+
+    def setUp(self):
+        self.saved_config = dict(app.config)
+        app.config['CORS_MAX_AGE'] = 600
+        self.auth_app = create_app()
+        self.auth_app.testing = True
+        self.app = self.auth_app.test_client()
+        self.requests = 0
+
+        @self.auth_app.before_request
+        def count():
+            self.requests += 1
+
+    def tearDown(self):
+        self.auth_app.before_request_funcs[None].pop()
+        app.config.update(self.saved_config)
+        for key in set(app.config) - set(self.saved_config):
+            del app.config[key]
+        preflight.init_app(app)
+
+    def preflight(self, path='/api/fhir/Observation', headers=None):
+        return self.app.open(path, method='OPTIONS', headers=headers or self.HEADERS)
+
+    def test_fast_path(self):
+        response = self.preflight()
+        assert response.status_code == 200
+        assert response.headers['Access-Control-Allow-Origin'] == 'https://app.example.org'
+        assert response.headers['Access-Control-Allow-Headers'] == 'accept, authorization'
+        assert 'GET' in response.headers['Access-Control-Allow-Methods']
+        assert response.headers['Access-Control-Max-Age'] == '600'
+        assert response.headers['Vary'] == 'Origin'
+        assert self.requests == 0
+
+    def test_same_headers_as_flask(self):
+        fast = self.preflight()
+        app.config['CORS_PREFLIGHT'] = False
+        preflight.init_app(app)
+        slow = self.preflight()
+
+        assert self.requests == 1
+        for header in ('Access-Control-Allow-Origin', 'Access-Control-Allow-Methods',
+                       'Access-Control-Max-Age', 'Vary'):
+            assert fast.headers[header] == slow.headers[header]
+        assert fast.headers['Access-Control-Allow-Headers'].lower() == \
+            slow.headers['Access-Control-Allow-Headers'].lower()
+
+    def test_passes_other_requests(self):
+        # Not a preflight.
+        self.app.open('/api/fhir/Observation', method='OPTIONS',
+                      headers={'Origin': 'https://app.example.org'})
+        # Not the API.
+        self.preflight(path='/oauth/token')
+        assert self.requests == 2
+
+    def test_invalid_requested_headers(self):
+        headers = dict(self.HEADERS, **{'Access-Control-Request-Headers': 'a"b'})
+        response = self.preflight(headers=headers)
+        assert 'Access-Control-Allow-Headers' not in response.headers
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+from auth_proxy.application import app
+from auth_proxy.extensions import profiler
+from testing import AppTestCase, StubUpstream
+import unittest
+import json
+
+
+class ProfilingTestCase(AppTestCase):
+
+    ADMIN_TOKEN = "admin-secret"
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream(delay=0.05).start()
+        self.start_app(API_SERVER=self.stub.url, ADMIN_TOKEN=self.ADMIN_TOKEN)
+        self.admin = {'Authorization': 'Bearer ' + self.ADMIN_TOKEN}
+
+    def tearDown(self):
+        profiler.stop()
+        self.stub.stop()
+        super().tearDown()
+
+    def start(self, kind, **params):
+        return self.app.post('/admin/profile/' + kind, headers=self.admin,
+                             data=json.dumps(params), content_type='application/json')
+
+    def test_admin_token_required(self):
+        response = self.app.get('/admin/profile')
+        self.assertEqual(response.status_code, 401)
+
+        response = self.app.get('/admin/profile', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+
+        app.config["ADMIN_TOKEN"] = None
+        response = self.app.get('/admin/profile', headers=self.admin)
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_sessions(self):
+        response = self.start('cpu', endpoint='api.no_such_view', requests=2)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.start('cpu', endpoint='api.api_fhir_proxy', requests=0)
+        self.assertEqual(response.status_code, 400)
+
+        for frames in (0, 70000):
+            response = self.start('allocations', requests=2, frames=frames)
+            self.assertEqual(response.status_code, 400)
+
+        response = self.start('cpu', endpoint='api.api_fhir_proxy', requests=2)
+        self.assertEqual(response.status_code, 202)
+        response = self.start('allocations', requests=2)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('already running', json.loads(response.get_data(as_text=True))['error'])
+
+    def test_cpu_profile(self):
+        response = self.start('cpu', endpoint='api.api_fhir_proxy', requests=3, interval=0.001)
+        self.assertEqual(response.status_code, 202)
+
+        # Other endpoints are not profiled.
+        self.app.get('/api/me', headers=self.headers)
+        for _ in range(3):
+            response = self.app.get('/api/fhir/Patient/' + self.PATIENT_ID,
+                                    headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/admin/profile/cpu', headers=self.admin)
+        status = json.loads(response.get_data(as_text=True))
+        self.assertFalse(status['active'])
+        self.assertEqual(status['profiled'], 3)
+
+        response = self.app.get('/admin/profile/cpu?format=folded', headers=self.admin)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('api_fhir_proxy' in line for line in lines))
+        self.assertFalse(any('api_me' in line for line in lines))
+
+    def test_allocation_profile(self):
+        response = self.start('allocations', requests=4)
+        self.assertEqual(response.status_code, 202)
+
+        for _ in range(2):
+            self.app.get('/api/fhir/Patient/' + self.PATIENT_ID, headers=self.headers)
+            self.app.get('/api/me', headers=self.headers)
+        # Past the session: not counted.
+        self.app.get('/api/me', headers=self.headers)
+
+        response = self.app.get('/admin/profile/allocations?limit=5', headers=self.admin)
+        report = json.loads(response.get_data(as_text=True))
+        self.assertFalse(report['session']['active'])
+        self.assertEqual(set(report['endpoints']), {'api.api_fhir_proxy', 'api.api_me'})
+        for stats in report['endpoints'].values():
+            self.assertEqual(stats['requests'], 2)
+            self.assertLessEqual(len(stats['top']), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+from auth_proxy.application import app
+from auth_proxy.proxy.jsonstream import BundleTransformer
+from auth_proxy.proxy.projection import Projection
+from testing import AppTestCase, StubUpstream
+from urllib.parse import parse_qs, urlparse
+import unittest
+import json
+import time
+
+
+def observation(index):
+    return {
+        'resourceType': 'Observation',
+        'id': 'obs-{}'.format(index),
+        'meta': {'lastUpdated': '2017-01-01T00:00:00Z'},
+        'text': {'status': 'generated', 'div': '<div>' + 'Blood pressure "high" ' * 20 + '</div>'},
+        'status': 'final',
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '55284-4'}]},
+        'subject': {'reference': 'Patient/smart-1288992'},
+        'effectiveDateTime': '2017-01-01',
+        'component': [{'code': {'text': 'systolic'}, 'valueQuantity': {'value': 120 + index}},
+                      {'code': {'text': 'diastolic'}, 'valueQuantity': {'value': 80}}],
+    }
+
+
+def bundle(count):
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'total': count,
+        'link': [{'relation': 'self', 'url': 'http://example.com/Observation?x=[1]'}],
+        'entry': [{'fullUrl': 'http://example.com/Observation/obs-{}'.format(index),
+                   'resource': observation(index)} for index in range(count)],
+    }
+
+
+class BundleTransformerTestCase(unittest.TestCase):
+
+    def test_matches_full_parse(self):
+        body = json.dumps(bundle(5), indent=2).encode('utf-8')
+        projection = Projection(elements=['code'])
+        transformer = BundleTransformer(projection.entry)
+
+        # Split at every byte to exercise the chunk boundaries.
+        streamed = b''.join(transformer(body[i:i + 1] for i in range(len(body))))
+
+        expected = bundle(5)
+        for entry in expected['entry']:
+            entry['resource'] = projection.resource(entry['resource'])
+        assert json.loads(streamed.decode('utf-8')) == expected
+
+    def test_summary_count_drops_entries(self):
+        body = json.dumps(bundle(3)).encode('utf-8')
+        transformer = BundleTransformer(Projection(summary='count').entry)
+
+        result = json.loads(b''.join(transformer([body])).decode('utf-8'))
+
+        assert result['entry'] == []
+        assert result['total'] == 3
+
+    def test_payload_shrinks(self):
+        body = json.dumps(bundle(50)).encode('utf-8')
+
+        for projection in (Projection(elements=['code']), Projection(summary='true')):
+            transformer = BundleTransformer(projection.entry)
+            projected = b''.join(transformer([body[i:i + 4096]
+                                              for i in range(0, len(body), 4096)]))
+            assert len(projected) < len(body) / 2
+
+    def test_latency_cost(self):
+        body = json.dumps(bundle(200)).encode('utf-8')
+        chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)]
+        transformer = BundleTransformer(Projection(elements=['code']).entry)
+
+        def best(func):
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - start)
+            return min(timings)
+
+        streamed = best(lambda: b''.join(transformer(chunks)))
+        parsed = best(lambda: json.dumps(json.loads(body.decode('utf-8'))))
+
+        # Costs about what parsing the whole Bundle would, without holding it.
+        assert streamed < 5 * parsed + 0.01
+
+    def test_summary_elements(self):
+        resource = Projection(summary='true').resource(observation(1))
+
+        assert sorted(resource) == ['code', 'effectiveDateTime', 'id', 'meta',
+                                    'resourceType', 'status', 'subject']
+        assert resource['meta']['tag'][0]['code'] == 'SUBSETTED'
+
+
+class ProjectionTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream(body=bundle(3)).start()
+        self.search_params = []
+
+        def handler(request):
+            if request.path.startswith('/metadata'):
+                return (200, {'Content-Type': 'application/json+fhir'}, {
+                    'resourceType': 'CapabilityStatement',
+                    'rest': [{'searchParam': self.search_params}],
+                })
+        self.stub.handler = handler
+
+        self.start_app(API_SERVER=self.stub.url)
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def upstream_args(self):
+        searches = [path for path in self.stub.requests if path.startswith('/Observation')]
+        return parse_qs(urlparse(searches[-1]).query)
+
+    def test_projects_locally(self):
+        response = self.app.get('/api/fhir/Observation?_elements=code', headers=self.headers)
+
+        assert response.status_code == 200
+        assert '_elements' not in self.upstream_args()
+        result = json.loads(response.get_data(as_text=True))
+        assert sorted(result['entry'][0]['resource']) == ['code', 'id', 'meta', 'resourceType']
+        assert result['entry'][0]['resource']['meta']['tag'][0]['code'] == 'SUBSETTED'
+
+    def test_passes_through(self):
+        app.config["COMPARTMENT_CHECK"] = False
+        self.search_params.extend([{'name': '_elements', 'type': 'string'},
+                                   {'name': '_summary', 'type': 'token'}])
+
+        response = self.app.get('/api/fhir/Observation?_summary=true', headers=self.headers)
+
+        assert self.upstream_args()['_summary'] == ['true']
+        result = json.loads(response.get_data(as_text=True))
+        assert result == bundle(3)
+
+    def test_checked_before_projection(self):
+        # The compartment check reads references a projection may drop.
+        self.search_params.extend([{'name': '_elements', 'type': 'string'},
+                                   {'name': '_summary', 'type': 'token'}])
+
+        response = self.app.get('/api/fhir/Observation?_summary=text', headers=self.headers)
+
+        assert response.status_code == 200
+        assert '_summary' not in self.upstream_args()
+
+
+if __name__ == '__main__':
+    unittest.main()
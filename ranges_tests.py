@@ -0,0 +1,171 @@
+from auth_proxy.proxy import Server
+from auth_proxy.proxy.ranges import RangeProxy, parse_range, resolve
+from testing import AppTestCase, StubUpstream
+import unittest
+
+CONTENT = bytes(range(256)) * 1024  # 256 KB
+ETAG = '"v1"'
+
+
+class _Client(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def check_request(self):
+        pass
+
+    def request(self):
+        return {'method': 'GET', 'url': 'Binary/1?', 'headers': self.headers}
+
+
+class _Server(Server):
+    # Streams CONTENT in odd-sized chunks, without a Content-Length.
+
+    def __init__(self):
+        self.closed = False
+
+    def respond(self, request):
+        def chunks():
+            try:
+                for start in range(0, len(CONTENT), 10000):
+                    yield CONTENT[start:start + 10000]
+            finally:
+                self.closed = True
+
+        return {'response': chunks(), 'status': 200,
+                'headers': {'Content-Type': 'application/octet-stream', 'ETag': ETAG}}
+
+
+class RangeTestCase(unittest.TestCase):
+
+    def test_parse_range(self):
+        assert parse_range('bytes=0-99') == (0, 99)
+        assert parse_range('bytes=100-') == (100, None)
+        assert parse_range('bytes=-500') == (None, 500)
+        assert parse_range('bytes=5-1') is None
+        assert parse_range('bytes=0-1,5-9') is None
+        assert parse_range('items=0-1') is None
+        assert parse_range(None) is None
+
+    def test_resolve(self):
+        assert resolve((0, 99), 1000) == (0, 99)
+        assert resolve((900, 2000), 1000) == (900, 999)
+        assert resolve((100, None), 1000) == (100, 999)
+        assert resolve((None, 10), 1000) == (990, 999)
+        assert resolve((None, 5000), 1000) == (0, 999)
+        assert resolve((1000, None), 1000) is None
+        assert resolve((None, 0), 1000) is None
+
+    def serve(self, headers):
+        server = _Server()
+        response = RangeProxy(_Client(headers), server).proxy()
+        body = response['response']
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+        return response, body, server
+
+    def test_spooled_range(self):
+        response, body, server = self.serve({'Range': 'bytes=12345-70000'})
+
+        assert response['status'] == 206
+        assert body == CONTENT[12345:70001]
+        assert response['headers']['Content-Range'] == \
+            'bytes 12345-70000/{}'.format(len(CONTENT))
+        assert response['headers']['Content-Length'] == str(len(body))
+        assert server.closed
+
+    def test_if_range(self):
+        response, body, _ = self.serve({'Range': 'bytes=-100', 'If-Range': ETAG})
+        assert response['status'] == 206
+        assert body == CONTENT[-100:]
+
+        # Changed since: the whole body.
+        response, body, _ = self.serve({'Range': 'bytes=-100', 'If-Range': '"v0"'})
+        assert response['status'] == 200
+        assert body == CONTENT
+
+    def test_unsatisfiable(self):
+        response, body, server = self.serve({'Range': 'bytes=999999-'})
+
+        assert response['status'] == 416
+        assert response['headers']['Content-Range'] == 'bytes */{}'.format(len(CONTENT))
+        assert body == b''
+        assert server.closed
+
+
+class RangeProxyTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        self.upstream_ranges = False
+        self.range_headers = []
+
+        def handler(request):
+            if not request.path.startswith('/Binary/'):
+                return None
+            self.range_headers.append(request.headers.get('Range'))
+            headers = {'Content-Type': 'application/pdf', 'ETag': ETAG}
+            byte_range = parse_range(request.headers.get('Range'))
+            if self.upstream_ranges and byte_range is not None:
+                start, end = resolve(byte_range, len(CONTENT))
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(CONTENT))
+                headers['Accept-Ranges'] = 'bytes'
+                return (206, headers, CONTENT[start:end + 1])
+            return (200, headers, CONTENT)
+        self.stub.handler = handler
+
+        self.start_app(API_SERVER=self.stub.url)
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def get(self, path, **headers):
+        headers.update(self.headers)
+        return self.app.get('/api/fhir/' + path, headers=headers)
+
+    def test_full_download(self):
+        response = self.get('Binary/scan-1')
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.headers['ETag'] == ETAG
+        assert response.headers['Content-Length'] == str(len(CONTENT))
+        assert response.get_data() == CONTENT
+
+    def test_upstream_ranges(self):
+        self.upstream_ranges = True
+
+        response = self.get('Binary/scan-1', Range='bytes=1000-1999')
+
+        assert self.range_headers == ['bytes=1000-1999']
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 1000-1999/{}'.format(len(CONTENT))
+        assert response.get_data() == CONTENT[1000:2000]
+
+    def test_local_ranges(self):
+        # The upstream ignores Range; the proxy cuts the range out.
+        response = self.get('Binary/scan-1', Range='bytes=200000-')
+
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == \
+            'bytes 200000-{}/{}'.format(len(CONTENT) - 1, len(CONTENT))
+        assert response.headers['Content-Length'] == str(len(CONTENT) - 200000)
+        assert response.get_data() == CONTENT[200000:]
+
+        response = self.get('Binary/scan-1', Range='bytes={}-'.format(len(CONTENT)))
+        assert response.status_code == 416
+
+    def test_searches_ignore_range(self):
+        response = self.get('Binary?patient=' + self.PATIENT_ID, Range='bytes=0-10')
+
+        assert response.status_code == 200
+        assert self.range_headers == []
+        assert 'Accept-Ranges' not in response.headers
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+from auth_proxy.application import app
+from auth_proxy.extensions import ratelimiter
+from auth_proxy.shm import SharedTable
+from testing import AppTestCase, StubUpstream
+import multiprocessing
+import os
+import unittest
+
+
+def count(path, times):
+    table = SharedTable(path, fields=1, slots=16)
+    for _ in range(times):
+        with table.locked('counter') as values:
+            values[0] += 1
+
+
+class RateLimitTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        self.path = os.path.join(self.directory, "ratelimit")
+        self.start_app(API_SERVER=self.stub.url,
+                       RATE_LIMIT_PATH=self.path,
+                       RATE_LIMITS={
+                           "client": {"rate": 1, "burst": 2},
+                           "patient": {"concurrency": 1},
+                       })
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def get(self, buffered=True):
+        # Buffered responses are closed, as a WSGI server closes them.
+        return self.app.get('/api/fhir/Patient', headers=self.headers, buffered=buffered)
+
+    def test_client_rate(self):
+        statuses = [self.get().status_code for _ in range(3)]
+
+        assert statuses == [200, 200, 429]
+
+        response = self.get()
+        assert int(response.headers['Retry-After']) == 1
+
+    def test_client_override(self):
+        app.config["RATE_LIMITS"]["clients"] = {self.CLIENT_ID: {"rate": 100, "burst": 100}}
+
+        statuses = [self.get().status_code for _ in range(3)]
+
+        assert statuses == [200, 200, 200]
+
+    def test_patient_concurrency(self):
+        # Another worker holds the patient's only slot.
+        ratelimiter.acquire('patient', self.PATIENT_ID, {'concurrency': 1})
+
+        response = self.get()
+        assert response.status_code == 429
+        assert self.stub.requests == []
+
+        ratelimiter.release('patient', self.PATIENT_ID)
+
+        # The refused request took nothing from the client's bucket.
+        statuses = [self.get().status_code for _ in range(2)]
+        assert statuses == [200, 200]
+
+    def test_streamed_response_holds_slot(self):
+        app.config["RATE_LIMITS"]["clients"] = {self.CLIENT_ID: {"rate": 100, "burst": 100}}
+
+        streamed = self.get(buffered=False)
+        assert streamed.status_code == 200
+
+        response = self.get()
+        assert response.status_code == 429
+
+        streamed.close()
+        response = self.get()
+        assert response.status_code == 200
+
+    def test_shared_across_processes(self):
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=count, args=(self.path, 500)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        table = SharedTable(self.path, fields=1, slots=16)
+        with table.locked('counter') as values:
+            assert values[0] == 2000
+
+    def test_planted_table(self):
+        target = os.path.join(self.directory, "target")
+        open(target, 'w').close()
+        planted = os.path.join(self.directory, "planted")
+        os.symlink(target, planted)
+        with self.assertRaises(OSError):
+            with SharedTable(planted, fields=1, slots=16).locked('counter'):
+                pass
+        assert os.path.getsize(target) == 0
+
+        shared = os.path.join(self.directory, "shared")
+        os.mkdir(shared, 0o777)
+        os.chmod(shared, 0o777)
+        with self.assertRaises(PermissionError):
+            with SharedTable(os.path.join(shared, "table"), fields=1, slots=16).locked('counter'):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+from auth_proxy.application import app, create_app
+from auth_proxy.models.oauth import Client
+from auth_proxy.extensions import db
+from auth_proxy.services import oauth_service
+from sqlalchemy import create_engine
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+
+    CLIENT_ID = "test1234"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        primary_uri = 'sqlite:///' + os.path.join(self.tmpdir, 'primary.sqlite')
+        replica_uri = 'sqlite:///' + os.path.join(self.tmpdir, 'replica.sqlite')
+
+        # The same client exists on both databases under a different name, so
+        # we can tell which one answered a query.
+        for uri, name in ((primary_uri, 'primary'), (replica_uri, 'replica')):
+            engine = create_engine(uri)
+            db.metadata.create_all(engine)
+            engine.execute(Client.__table__.insert(), client_id=self.CLIENT_ID,
+                           client_secret='secret', name=name)
+            engine.dispose()
+
+        app.config["SQLALCHEMY_DATABASE_URI"] = primary_uri
+        app.config["SQLALCHEMY_REPLICA_URIS"] = [replica_uri]
+        self.auth_app = create_app()
+
+    def tearDown(self):
+        app.config["SQLALCHEMY_REPLICA_URIS"] = []
+        with self.auth_app.app_context():
+            db.session.remove()
+            db.get_engine(self.auth_app).dispose()
+        create_app()
+        shutil.rmtree(self.tmpdir)
+
+    def test_reads_use_replica(self):
+        with self.auth_app.test_request_context():
+            assert oauth_service.cb_clientgetter(self.CLIENT_ID).name == 'replica'
+
+    def test_reads_follow_writes_within_request(self):
+        with self.auth_app.test_request_context():
+            assert oauth_service.cb_clientgetter(self.CLIENT_ID).name == 'replica'
+
+            db.session.add(Client(client_id='other', client_secret='secret', name='other'))
+            db.session.commit()
+
+            assert oauth_service.cb_clientgetter(self.CLIENT_ID).name == 'primary'
+
+        with self.auth_app.test_request_context():
+            assert oauth_service.cb_clientgetter(self.CLIENT_ID).name == 'replica'
+
+    def test_writes_use_primary(self):
+        with self.auth_app.test_request_context():
+            oauth_service.register(['https://example.com/callback'], 'launch/patient')
+
+        with self.auth_app.app_context():
+            assert db.session.query(Client).count() == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from auth_proxy.services import proxy_service
+from testing import AppTestCase, StubUpstream
+import requests
+import unittest
+import json
+import time
+
+
+class ResilienceTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        proxy_service.resilience.reset()
+        self.start_app(API_SERVER=self.stub.url,
+                       UPSTREAM_READ_TIMEOUT=0.2,
+                       UPSTREAM_RETRIES=1,
+                       UPSTREAM_RETRY_BACKOFF=0,
+                       UPSTREAM_BREAKER_THRESHOLD=3,
+                       UPSTREAM_BREAKER_RESET=30,
+                       ADMIN_TOKEN="admin-secret")
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+        proxy_service.resilience.reset()
+
+    def test_passes_through(self):
+        response = self.app.get('/api/fhir/Patient', headers=self.headers)
+
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True))['resourceType'] == 'Bundle'
+
+    def test_retried_response_is_closed(self):
+        def handler(request):
+            if len(self.stub.requests) == 1:
+                return (503, {'Content-Type': 'application/json+fhir'}, {})
+        self.stub.handler = handler
+
+        closed = []
+        close = requests.Response.close
+
+        def record(response):
+            closed.append(response.status_code)
+            close(response)
+        requests.Response.close = record
+        try:
+            response = self.app.get('/api/fhir/Patient', headers=self.headers)
+        finally:
+            requests.Response.close = close
+
+        assert response.status_code == 200
+        assert closed[:1] == [503]
+
+    def test_slow_upstream_times_out(self):
+        self.stub.delay = 1
+
+        start = time.time()
+        response = self.app.get('/api/fhir/Patient', headers=self.headers)
+
+        assert response.status_code == 504
+        assert time.time() - start < 1
+        # The GET was retried once.
+        assert len(self.stub.requests) == 2
+
+    def test_breaker_opens(self):
+        self.stub.status = 503
+
+        for _ in range(3):
+            self.app.get('/api/fhir/Patient', headers=self.headers)
+        seen = len(self.stub.requests)
+
+        response = self.app.get('/api/fhir/Patient', headers=self.headers)
+
+        assert response.status_code == 503
+        assert 0 < int(response.headers['Retry-After']) <= 30
+        assert len(self.stub.requests) == seen
+
+        # The status names the upstream servers; only admins may see it.
+        assert self.app.get('/api/status/upstream', headers=self.headers).status_code == 403
+
+        admin = {'Authorization': 'Bearer admin-secret'}
+        response = self.app.get('/api/status/upstream', headers=admin)
+        status = json.loads(response.get_data(as_text=True))
+        breaker = status['breakers'][self.stub.url.split('//')[1]]
+        assert breaker['state'] == 'open'
+        assert breaker['counters']['rejected'] >= 1
+
+
+if __name__ == '__main__':
+    unittest.main()
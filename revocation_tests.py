@@ -0,0 +1,104 @@
+from auth_proxy.models.oauth import Client, Token
+from auth_proxy.models.user import Patient, User
+from auth_proxy.extensions import db
+from auth_proxy.services import oauth_service
+from testing import AppTestCase
+import time
+import unittest
+import json
+
+
+class RevocationTestCase(AppTestCase):
+
+    CLIENTS = ["client-a", "client-b"]
+
+    PATIENTS = ["smart-1288992", "smart-1551992"]
+
+    ADMIN_TOKEN = "admin-secret"
+
+    # The tokens are made by seed().
+    SCOPE = None
+
+    def setUp(self):
+        super().setUp()
+        self.start_app(ADMIN_TOKEN=self.ADMIN_TOKEN)
+
+    def seed(self):
+        for client_id in self.CLIENTS:
+            db.session.add(Client(client_id=client_id,
+                                  client_secret=self.CLIENT_SECRET,
+                                  name=client_id))
+        new_user = User(username=self.USERNAME, password=self.PASSWORD)
+        for patient_id in self.PATIENTS:
+            new_user.patients.append(Patient(patient_id=patient_id))
+        db.session.add(new_user)
+        db.session.add(User(username="other", password=self.PASSWORD))
+        db.session.commit()
+
+        # 25 tokens for each client and patient.
+        oauth_service.create_debug_tokens([{
+            'client_id': client_id,
+            'access_lifetime': 3600,
+            'approval_expires': time.time() + 3600,
+            'scopes': 'patient/*.read',
+            'user': self.USERNAME,
+            'patient_id': patient_id,
+        } for client_id in self.CLIENTS for patient_id in self.PATIENTS for _ in range(25)])
+
+    def revoke(self, headers=None, **criteria):
+        if headers is None:
+            headers = {'Authorization': 'Bearer ' + self.ADMIN_TOKEN}
+        return self.app.post('/admin/tokens/revoke', headers=headers,
+                             data=json.dumps(criteria), content_type='application/json')
+
+    def count(self, **criteria):
+        with self.auth_app.app_context():
+            return Token.query.filter_by(**criteria).count()
+
+    def test_revoke_by_client(self):
+        response = self.revoke(client_id="client-a")
+
+        assert json.loads(response.get_data(as_text=True)) == {'revoked': 50}
+        assert self.count(client_id="client-a") == 0
+        assert self.count(client_id="client-b") == 50
+
+    def test_revoke_by_patient_and_client(self):
+        response = self.revoke(client_id="client-b", patient_id=self.PATIENTS[0])
+
+        assert json.loads(response.get_data(as_text=True)) == {'revoked': 25}
+        assert self.count(patient_id=self.PATIENTS[0]) == 25
+
+    def test_revoke_by_user(self):
+        assert json.loads(self.revoke(username="other").get_data(as_text=True)) == \
+            {'revoked': 0}
+        assert json.loads(self.revoke(username=self.USERNAME).get_data(as_text=True)) == \
+            {'revoked': 100}
+
+    def test_revoke_in_chunks(self):
+        oauth_service.REVOKE_CHUNK = 7
+        try:
+            response = self.revoke(patient_id=self.PATIENTS[1])
+        finally:
+            del oauth_service.REVOKE_CHUNK
+
+        assert json.loads(response.get_data(as_text=True)) == {'revoked': 50}
+        assert self.count() == 50
+
+    def test_errors(self):
+        assert self.revoke().status_code == 400
+        assert self.revoke(username="nobody").status_code == 400
+        assert self.revoke(headers={}, client_id="client-a").status_code == 401
+        assert self.count() == 100
+
+    def test_create_authorization_replaces_tokens(self):
+        with self.auth_app.app_context():
+            user = User.query.filter_by(username=self.USERNAME).first()
+            oauth_service.create_authorization("client-a", time.time() + 3600, 'patient',
+                                               user, self.PATIENTS[0])
+
+        assert self.count(client_id="client-a") == 1
+        assert self.count(client_id="client-b") == 50
+
+
+if __name__ == '__main__':
+    unittest.main()
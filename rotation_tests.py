@@ -0,0 +1,88 @@
+from auth_proxy.models.oauth import Client, Token
+from auth_proxy.models.user import User
+from auth_proxy.extensions import db
+from auth_proxy.services import oauth_service
+from auth_proxy.services.oauth import OAuthServiceError
+from testing import AuthorizationTestCase
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+import json
+
+
+class _Request(object):
+    # The parts of an oauthlib request that cb_tokensetter reads.
+    def __init__(self, client, user, refresh_token):
+        self.client = client
+        self.user = user
+        self.grant_type = 'refresh_token'
+        self.refresh_token = refresh_token
+
+
+class RotationTestCase(AuthorizationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.start_app(SQLITE_CONCURRENCY=True)
+
+    def refresh(self, refresh_token, client=None):
+        return (client or self.app).post('/oauth/token', data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': self.CLIENT_ID,
+            'client_secret': self.CLIENT_SECRET,
+        })
+
+    def tokens(self):
+        with self.auth_app.app_context():
+            return Token.query.filter_by(client_id=self.CLIENT_ID).count()
+
+    def test_refresh(self):
+        token = self.launch()
+        response = self.refresh(token['refresh_token'])
+        assert response.status_code == 200
+        assert self.tokens() == 1
+
+        replay = self.refresh(token['refresh_token'])
+        assert json.loads(replay.get_data(as_text=True))['error'] == 'invalid_grant'
+
+    def test_rotated_meanwhile(self):
+        token = self.launch()
+        with self.auth_app.app_context():
+            client = Client.query.get(self.CLIENT_ID)
+            user = User.query.filter_by(username=self.USERNAME).first()
+            Token.query.delete()
+            db.session.commit()
+
+            # The token was valid when the grant was checked.
+            with self.assertRaises(OAuthServiceError) as context:
+                oauth_service.cb_tokensetter({'access_token': 'a', 'refresh_token': 'r',
+                                              'expires_in': 3600, 'token_type': 'Bearer',
+                                              'scope': self.SCOPES},
+                                             _Request(client, user, token['refresh_token']))
+            assert context.exception.error == 'invalid_grant'
+            assert Token.query.count() == 0
+
+    def test_concurrent_refreshes(self):
+        token = self.launch()
+        barrier = threading.Barrier(8)
+
+        def refresh(_):
+            client = self.auth_app.test_client()
+            barrier.wait()
+            return self.refresh(token['refresh_token'], client)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(refresh, range(8)))
+
+        # One refresh wins; the others are told the grant is used up,
+        # whether they lost before or during the rotation.
+        results = sorted(json.loads(response.get_data(as_text=True)).get('error', '')
+                         for response in responses)
+        assert results == [''] + ['invalid_grant'] * 7, results
+        assert all(response.status_code < 500 for response in responses)
+        assert self.tokens() == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
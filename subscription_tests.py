@@ -0,0 +1,284 @@
+from auth_proxy.application import app
+from auth_proxy.models.oauth import Token
+from auth_proxy.models.subscription import Subscription
+from auth_proxy.extensions import db
+from auth_proxy.services import subscription_service
+from testing import AppTestCase, StubUpstream
+from datetime import datetime, timedelta
+from urllib import parse
+import hashlib
+import hmac
+import os
+import socket
+import unittest
+import json
+
+
+class SubscriptionTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        self.stub.handler = self.upstream
+
+        # Polls are run by the tests, not by a watcher thread.
+        subscription_service._forget()
+        subscription_service._pid = os.getpid()
+
+        self.start_app(API_SERVER=self.stub.url,
+                       SUBSCRIPTIONS=True,
+                       SUBSCRIPTION_POLL_INTERVAL=0,
+                       SUBSCRIPTION_STREAM_TIMEOUT=0,
+                       SUBSCRIPTION_LOCK_PATH=os.path.join(self.directory, "lock"),
+                       SUBSCRIPTION_LOCAL_ENDPOINTS=True,
+                       ADMIN_TOKEN="admin-secret")
+
+        with self.auth_app.app_context():
+            token = Token.query.filter_by(access_token=self.access_token).first()
+            token._security_labels = 'laboratory'
+            db.session.commit()
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+        subscription_service._forget()
+
+    def upstream(self, handler):
+        if not handler.path.startswith('/Observation'):
+            return None
+
+        updated = datetime.utcnow().isoformat() + 'Z'
+
+        def observation(id, labels, patient_id):
+            return {'resource': {
+                'resourceType': 'Observation',
+                'id': id,
+                'meta': {'versionId': '1', 'lastUpdated': updated,
+                         'security': [{'code': code} for code in labels]},
+                'subject': {'reference': 'Patient/' + patient_id},
+            }}
+
+        return (200, {'Content-Type': 'application/json+fhir'}, {
+            'resourceType': 'Bundle',
+            'entry': [
+                observation('obs-1', ['laboratory', 'Patient/' + self.PATIENT_ID],
+                            self.PATIENT_ID),
+                observation('obs-2', ['mental-health', 'Patient/' + self.PATIENT_ID],
+                            self.PATIENT_ID),
+                observation('obs-3', ['public', 'Patient/other'], 'other'),
+            ],
+        })
+
+    def subscribe(self, **data):
+        return self.app.post('/api/subscriptions', headers=self.headers,
+                             data=json.dumps(data), content_type='application/json')
+
+    def poll(self, times=1):
+        with self.auth_app.app_context():
+            for _ in range(times):
+                subscription_service.poll()
+
+    def searches(self):
+        return [path for path in self.stub.requests if path.startswith('/Observation')]
+
+    def test_webhook_notification(self):
+        response = self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                                  endpoint=self.stub.url + '/hook')
+        assert response.status_code == 201
+        secret = json.loads(response.get_data(as_text=True))['secret']
+
+        # The first poll only sets where the next one starts.
+        self.poll()
+        assert self.searches() == []
+        self.poll()
+
+        search = self.searches()[0]
+        assert '_lastUpdated=gt' in search
+        assert 'patient=' + self.PATIENT_ID in search
+        assert '_security=public%2Claboratory' in search
+
+        assert len(self.stub.posts) == 1
+        path, headers, body = self.stub.posts[0]
+        assert path == '/hook'
+        signature = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        assert headers['X-Signature'] == 'sha256=' + signature
+
+        # Only the resource this token may read.
+        payload = json.loads(body.decode('utf-8'))
+        assert payload['resourceType'] == 'Observation'
+        assert payload['ids'] == ['obs-1']
+
+        # Nothing changed since.
+        self.poll()
+        assert len(self.stub.posts) == 1
+
+    def test_webhook_pinned_to_checked_address(self):
+        port = parse.urlparse(self.stub.url).port
+        getaddrinfo = socket.getaddrinfo
+        lookups = []
+
+        def resolve(host, *args, **kwargs):
+            # hooks.example.com is the stub for the two checks only, as if
+            # rebound to somewhere else right after.
+            if host == 'hooks.example.com':
+                lookups.append(host)
+                if len(lookups) > 2:
+                    raise socket.gaierror('rebound')
+                host = '127.0.0.1'
+            return getaddrinfo(host, *args, **kwargs)
+
+        socket.getaddrinfo = resolve
+        try:
+            response = self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                                      endpoint='http://hooks.example.com:{}/hook'.format(port))
+            assert response.status_code == 201
+            self.poll(2)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+
+        assert len(lookups) == 2
+        assert len(self.stub.posts) == 1
+        path, headers, _ = self.stub.posts[0]
+        assert path == '/hook'
+        assert headers['Host'] == 'hooks.example.com:{}'.format(port)
+
+    def test_one_search_per_patient_and_type(self):
+        self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                       endpoint=self.stub.url + '/hook')
+        self.subscribe(resource_types=['Observation', 'Condition'], channel='sse')
+
+        self.poll(2)
+
+        assert len(self.searches()) == 1
+        assert len(self.stub.posts) == 1
+
+        assert self.app.get('/api/status/subscriptions',
+                            headers=self.headers).status_code == 403
+        response = self.app.get('/api/status/subscriptions',
+                                headers={'Authorization': 'Bearer admin-secret'})
+        status = json.loads(response.get_data(as_text=True))
+        assert status['watched'] == 2
+
+    def test_sse_events(self):
+        response = self.subscribe(resource_types=['Observation'], channel='sse')
+        interest = json.loads(response.get_data(as_text=True))
+        assert 'secret' not in interest
+
+        self.poll(2)
+
+        response = self.app.get('/api/subscriptions/{}/events'.format(interest['id']),
+                                headers=self.headers)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+        assert 'event: notification' in body
+        assert '"obs-1"' in body and '"obs-2"' not in body
+
+        # Resuming after the last event.
+        event_id = [line for line in body.split('\n') if line.startswith('id: ')][-1][4:]
+        headers = dict(self.headers, **{'Last-Event-ID': event_id})
+        response = self.app.get('/api/subscriptions/{}/events'.format(interest['id']),
+                                headers=headers)
+        assert 'event: notification' not in response.get_data(as_text=True)
+
+    def test_sse_stream_slots(self):
+        app.config["SUBSCRIPTION_MAX_STREAMS"] = 1
+        response = self.subscribe(resource_types=['Observation'], channel='sse')
+        path = '/api/subscriptions/{}/events'.format(json.loads(response.get_data())['id'])
+
+        stream = self.app.get(path, headers=self.headers, buffered=False)
+        assert stream.status_code == 200
+
+        response = self.app.get(path, headers=self.headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+
+        stream.close()
+        assert self.app.get(path, headers=self.headers).status_code == 200
+
+    def test_ends_without_token(self):
+        self.subscribe(resource_types=['Observation'], channel='sse')
+        with self.auth_app.app_context():
+            Token.query.delete()
+            db.session.commit()
+
+        self.poll()
+
+        with self.auth_app.app_context():
+            assert Subscription.query.count() == 0
+        assert self.searches() == []
+
+    def test_manage(self):
+        response = self.subscribe(resource_types=['Condition'], channel='sse')
+        subscription_id = json.loads(response.get_data(as_text=True))['id']
+
+        response = self.app.get('/api/subscriptions', headers=self.headers)
+        subscriptions = json.loads(response.get_data(as_text=True))['subscriptions']
+        assert [subscription['id'] for subscription in subscriptions] == [subscription_id]
+
+        response = self.app.delete('/api/subscriptions/{}'.format(subscription_id),
+                                   headers=self.headers)
+        assert response.status_code == 204
+        response = self.app.get('/api/subscriptions/{}'.format(subscription_id),
+                                headers=self.headers)
+        assert response.status_code == 404
+
+    def test_invalid(self):
+        assert self.subscribe(resource_types=['Binary'], channel='sse').status_code == 400
+        assert self.subscribe(resource_types=['Observation'],
+                              channel='email').status_code == 400
+        assert self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                              endpoint='file:///etc/passwd').status_code == 400
+
+        app.config["SUBSCRIPTION_LOCAL_ENDPOINTS"] = False
+        for endpoint in (self.stub.url + '/hook', 'https://127.0.0.1/hook',
+                         'https://localhost/hook', 'https://10.0.0.1/hook',
+                         'https://169.254.169.254/latest', 'https://[::1]/hook', 42):
+            assert self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                                  endpoint=endpoint).status_code == 400, endpoint
+
+    def test_pages(self):
+        app.config["SUBSCRIPTION_PAGE_SIZE"] = 2
+        start = datetime.utcnow() - timedelta(minutes=10)
+        updates = [(start + timedelta(minutes=minutes)).isoformat() + 'Z'
+                   for minutes in range(1, 6)]
+
+        def upstream(handler):
+            if not handler.path.startswith('/Observation'):
+                return None
+            args = dict(parse.parse_qsl(parse.urlparse(handler.path).query))
+            assert args['_sort'] == '_lastUpdated'
+            since = args['_lastUpdated'][2:]
+            found = [update for update in updates if update[:19] > since[:19]]
+            return (200, {'Content-Type': 'application/json+fhir'}, {
+                'resourceType': 'Bundle',
+                'entry': [{'resource': {
+                    'resourceType': 'Observation',
+                    'id': 'obs-{}'.format(updates.index(update)),
+                    'meta': {'versionId': '1', 'lastUpdated': update,
+                             'security': [{'code': 'laboratory'},
+                                          {'code': 'Patient/' + self.PATIENT_ID}]},
+                    'subject': {'reference': 'Patient/' + self.PATIENT_ID},
+                }} for update in found[:int(args['_count'])]],
+            })
+        self.stub.handler = upstream
+
+        self.subscribe(resource_types=['Observation'], channel='rest-hook',
+                       endpoint=self.stub.url + '/hook')
+        self.poll()
+        subscription_service._watermarks[(self.PATIENT_ID, 'Observation')] = start
+
+        self.poll(6)
+
+        ids = [id for (_, _, body) in self.stub.posts
+               for id in json.loads(body.decode('utf-8'))['ids']]
+        assert ids == ['obs-0', 'obs-1', 'obs-2', 'obs-3', 'obs-4']
+
+    def test_disabled(self):
+        app.config["SUBSCRIPTIONS"] = False
+        response = self.app.get('/api/subscriptions', headers=self.headers)
+        assert response.status_code == 404
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+from auth_proxy.application import app
+from auth_proxy.models.user import Patient, User
+from testing import AppTestCase, StubUpstream
+from urllib import parse
+import unittest
+import json
+
+
+class SyncTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resources = []
+        self.stub = StubUpstream().start()
+        self.stub.handler = self.upstream
+        self.start_app(API_SERVER=self.stub.url, SYNC_SKEW=30)
+
+    def tearDown(self):
+        self.stub.stop()
+        super().tearDown()
+
+    def seed(self):
+        super().seed()
+        User.query.filter_by(username=self.USERNAME).first().\
+            patients.append(Patient(patient_id="other"))
+
+    def token(self, patient_id):
+        access_token = self.create_token(patient_id=patient_id)["access_token"]
+        return {'Authorization': 'Bearer ' + access_token}
+
+    def upstream(self, handler):
+        if not handler.path.startswith('/Observation'):
+            return None
+        return (200, {'Content-Type': 'application/json+fhir'}, {
+            'resourceType': 'Bundle',
+            'entry': [{'resource': resource} for resource in self.resources],
+        })
+
+    def observation(self, id, updated, version='1', patient_id=AppTestCase.PATIENT_ID):
+        return {
+            'resourceType': 'Observation',
+            'id': id,
+            'meta': {'versionId': version, 'lastUpdated': updated},
+            'subject': {'reference': 'Patient/' + patient_id},
+        }
+
+    def sync(self, headers=None, **args):
+        response = self.app.get('/api/sync/Observation', headers=headers or self.headers,
+                                query_string=args)
+        if response.status_code != 200:
+            return response, None, None
+        bundle = json.loads(response.get_data(as_text=True))
+        ids = [entry['resource']['id'] for entry in bundle['entry']]
+        return response, bundle, ids
+
+    def last_search(self):
+        query = parse.urlparse(self.stub.requests[-1]).query
+        return dict(parse.parse_qsl(query))
+
+    def test_delta(self):
+        self.resources = [self.observation('obs-1', '2020-01-01T10:00:00Z'),
+                          self.observation('obs-2', '2020-01-01T12:00:00Z')]
+        response, bundle, ids = self.sync()
+        assert ids == ['obs-1', 'obs-2']
+        assert '_lastUpdated' not in self.last_search()
+        assert self.last_search()['_sort'] == '_lastUpdated'
+        cursor = response.headers['X-Sync-Cursor']
+
+        # obs-2 is found again in the overlap, and obs-3 was committed late.
+        self.resources = [self.observation('obs-3', '2020-01-01T11:59:50Z'),
+                          self.observation('obs-2', '2020-01-01T12:00:00Z'),
+                          self.observation('obs-1', '2020-01-01T12:00:05Z', version='2')]
+        response, bundle, ids = self.sync(cursor=cursor)
+        assert self.last_search()['_lastUpdated'] == 'ge2020-01-01T11:59:30Z'
+        assert ids == ['obs-3', 'obs-1']
+        assert 'link' not in bundle
+
+    def test_resume_from_stored_cursor(self):
+        self.resources = [self.observation('obs-1', '2020-01-01T10:00:00Z')]
+        self.sync()
+
+        # The app lost its cursor.
+        response, bundle, ids = self.sync()
+        assert ids == []
+        assert self.last_search()['_lastUpdated'] == 'ge2020-01-01T09:59:30Z'
+
+        response, bundle, ids = self.sync(reset='true')
+        assert ids == ['obs-1']
+
+    def test_compartment(self):
+        self.resources = [self.observation('obs-1', '2020-01-01T10:00:00Z'),
+                          self.observation('obs-2', '2020-01-01T10:00:00Z',
+                                           patient_id='other')]
+        response, bundle, ids = self.sync()
+        assert ids == ['obs-1']
+        search = self.last_search()
+        assert search['patient'] == self.PATIENT_ID
+        assert search['_security'] == 'Patient/' + self.PATIENT_ID
+
+    def test_pages(self):
+        app.config["SYNC_PAGE_SIZE"] = 2
+        self.resources = [self.observation('obs-1', '2020-01-01T10:00:00Z'),
+                          self.observation('obs-2', '2020-01-01T11:00:00Z')]
+        response, bundle, ids = self.sync()
+        next_url = bundle['link'][0]['url']
+        assert 'cursor=' in next_url
+
+    def test_invalid_cursor(self):
+        self.resources = [self.observation('obs-1', '2020-01-01T10:00:00Z')]
+        response, bundle, ids = self.sync()
+        cursor = response.headers['X-Sync-Cursor']
+
+        response, bundle, ids = self.sync(cursor=cursor[:-2])
+        assert response.status_code == 400
+
+        # Cursors don't carry over to other patients.
+        response, bundle, ids = self.sync(headers=self.token("other"), cursor=cursor)
+        assert response.status_code == 400
+
+    def test_forbidden_resource(self):
+        response = self.app.get('/api/sync/Binary', headers=self.headers)
+        assert response.status_code == 403
+
+
+if __name__ == '__main__':
+    unittest.main()
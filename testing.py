@@ -0,0 +1,343 @@
+""" Testing helpers.
+
+StubUpstream is a tiny local FHIR server stand-in that can be made slow or
+failing, for tests and benchmarks that need a real HTTP upstream.
+FrontProxy stands in for nginx in front of the app in delegated mode.
+AppTestCase runs each test against a fresh app and database, and
+AuthorizationTestCase gets its tokens through the authorization flow.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import re
+import shutil
+from socketserver import ThreadingMixIn
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from auth_proxy.application import app, create_app
+from auth_proxy.extensions import db
+from auth_proxy.models.oauth import Client
+from auth_proxy.models.user import Patient, User
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubUpstream(object):
+    """ A local HTTP server that answers every GET with `body`.
+
+    Set `delay` (seconds) to make it slow and `status` to make it fail.
+    `handler`, if set, is called with the request handler and may return
+    a (status, headers, body) tuple to override the response. Every
+    request path is recorded in `requests`. POSTs (webhook calls) are
+    recorded in `posts` as (path, headers, body) and answered with 204.
+    """
+    def __init__(self, body=None, status=200, delay=0):
+        self.body = body if body is not None else {'resourceType': 'Bundle', 'entry': []}
+        self.status = status
+        self.delay = delay
+        self.handler = None
+        self.requests = []
+        self.posts = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Answers on behalf of the stub.
+            """
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """ Serve any GET request.
+                """
+                stub.requests.append(self.path)
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                response = stub.handler(self) if stub.handler else None
+                if response is None:
+                    response = (stub.status, {'Content-Type': 'application/json+fhir'},
+                                stub.body)
+                status, headers, body = response
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+
+                self.send_response(status)
+                for key, val in headers.items():
+                    self.send_header(key, val)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """ Record a POST.
+                """
+                length = int(self.headers.get('Content-Length') or 0)
+                stub.posts.append((self.path, dict(self.headers.items()),
+                                   self.rfile.read(length)))
+
+                self.send_response(stub.status if stub.status >= 300 else 204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        """ The base URL of the stub.
+        """
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """ Start serving in a background thread.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FrontProxy(object):
+    """ A local HTTP server that does what nginx does with auth_request in
+    front of the app (see README): GET /api/fhir/<path> is authorized with
+    the app's /api/verify/<path>, then fetched from its X-Upstream-Url and
+    relayed back.
+
+    Every upstream URL it fetched is recorded in `fetched`.
+    """
+    forwarded_headers = ['Accept', 'Range', 'If-Range']
+    returned_headers = ['Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+                        'ETag', 'Last-Modified', 'WWW-Authenticate', 'Retry-After']
+
+    def __init__(self, app_url):
+        self.app_url = app_url
+        self.fetched = []
+        self.session = requests.Session()
+
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Answers on behalf of the front proxy.
+            """
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """ Authorize, then stream from wherever the app says.
+                """
+                prefix = '/api/fhir/'
+                if not self.path.startswith(prefix):
+                    return self._relay(proxy.session.get(proxy.app_url + self.path,
+                                                         stream=True))
+
+                verdict = proxy.session.get(
+                    proxy.app_url + '/api/verify/' + self.path[len(prefix):],
+                    headers={'Authorization': self.headers.get('Authorization', '')})
+                if verdict.status_code != 200:
+                    return self._relay(verdict)
+
+                url = verdict.headers['X-Upstream-Url']
+                headers = {key: self.headers[key] for key in proxy.forwarded_headers
+                           if key in self.headers}
+                if verdict.headers.get('X-Upstream-Authorization'):
+                    headers['Authorization'] = verdict.headers['X-Upstream-Authorization']
+                proxy.fetched.append(url)
+                self._relay(proxy.session.get(url, headers=headers, stream=True))
+
+            def _relay(self, response):
+                body = response.raw.read(decode_content=False)
+                self.send_response(response.status_code)
+                for key in proxy.returned_headers:
+                    if key in response.headers and key != 'Content-Length':
+                        self.send_header(key, response.headers[key])
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        """ The base URL of the front proxy.
+        """
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """ Start serving in a background thread.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AppTestCase(unittest.TestCase):
+    """ A test of the app with its own configuration and database.
+
+    start_app() creates the app and a database in `directory` with the
+    records of seed(): a client, and a user with one patient. Unless SCOPE
+    is None, it then gets a debug token for the patient, sent with
+    `headers`. tearDown() drops the database and restores the configuration,
+    forgetting keys the test added.
+    """
+    CLIENT_ID = "test1234"
+    CLIENT_SECRET = "secret1234"
+
+    USERNAME = "daniel-adams"
+    PASSWORD = "demo-password"
+
+    PATIENT_ID = "smart-1288992"
+
+    SCOPE = "patient/*.read"
+
+    def setUp(self):
+        self.saved_config = dict(app.config)
+        self.directory = tempfile.mkdtemp()
+        self.auth_app = None
+
+    def tearDown(self):
+        if self.auth_app is not None:
+            with self.auth_app.app_context():
+                db.session.remove()
+                db.drop_all()
+        for key in set(app.config) - set(self.saved_config):
+            del app.config[key]
+        app.config.update(self.saved_config)
+        create_app()
+        shutil.rmtree(self.directory)
+
+    def start_app(self, **config):
+        """ Create the app with config on top of the test database.
+        """
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            self.directory, "db.sqlite")
+        app.config.update(config)
+        self.auth_app = create_app()
+
+        with self.auth_app.app_context():
+            db.create_all()
+            self.seed()
+            db.session.commit()
+
+        self.auth_app.testing = True
+        self.app = self.auth_app.test_client()
+
+        if self.SCOPE is not None:
+            self.access_token = self.create_token()["access_token"]
+            self.headers = {'Authorization': 'Bearer ' + self.access_token}
+
+    def seed(self):
+        """ Add the test records, in an app context.
+        """
+        db.session.add(Client(client_id=self.CLIENT_ID,
+                              client_secret=self.CLIENT_SECRET,
+                              name=self.CLIENT_ID))
+        new_user = User(username=self.USERNAME, password=self.PASSWORD)
+        new_user.patients.append(Patient(patient_id=self.PATIENT_ID))
+        db.session.add(new_user)
+
+    def create_token(self, **token_input):
+        """ Get a debug token; token_input overrides the test's client,
+        user, patient and scope.
+        """
+        token_input = dict({"client_id": self.CLIENT_ID,
+                            "scope": self.SCOPE,
+                            "username": self.USERNAME,
+                            "patient_id": self.PATIENT_ID}, **token_input)
+        response = self.app.post('/oauth/debug/token',
+                                 data=json.dumps(token_input),
+                                 content_type='application/json')
+        return json.loads(response.get_data(as_text=True))
+
+
+class AuthorizationTestCase(AppTestCase):
+    """ An AppTestCase whose client is registered for REDIRECT_URI and
+    SCOPES. start_app() logs the user in; authorize() approves the client
+    for the patient and launch() gets the tokens for it.
+    """
+    REDIRECT_URI = "http://localhost/authorized"
+    SCOPES = "launch/patient patient/*.read offline_access"
+
+    SCOPE = None
+
+    def setUp(self):
+        super().setUp()
+        self.saved_insecure = os.environ.get('OAUTHLIB_INSECURE_TRANSPORT')
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+    def tearDown(self):
+        super().tearDown()
+        if self.saved_insecure is None:
+            del os.environ['OAUTHLIB_INSECURE_TRANSPORT']
+
+    def start_app(self, **config):
+        super().start_app(**config)
+        self.app.post('/login', data={'username': self.USERNAME, 'password': self.PASSWORD})
+
+    def seed(self):
+        db.session.add(Client(client_id=self.CLIENT_ID,
+                              client_secret=self.CLIENT_SECRET,
+                              name=self.CLIENT_ID,
+                              _redirect_uris=self.REDIRECT_URI,
+                              _default_scopes=self.SCOPES,
+                              _security_labels='patient'))
+        new_user = User(username=self.USERNAME, password=self.PASSWORD)
+        new_user.patients.append(Patient(patient_id=self.PATIENT_ID))
+        db.session.add(new_user)
+
+    def authorize(self):
+        """ The authorization code.
+        """
+        args = {'client_id': self.CLIENT_ID,
+                'redirect_uri': self.REDIRECT_URI,
+                'scope': self.SCOPES,
+                'state': 'test',
+                'response_type': 'code'}
+        response = self.app.get('/oauth/authorize', query_string=args)
+        csrf_token = re.search(r'name="csrf_token" value="([^"]+)"',
+                               response.get_data(as_text=True)).group(1)
+
+        form = dict(args, csrf_token=csrf_token, expires='2099-01-01',
+                    security_labels='patient', patient_id=self.PATIENT_ID)
+        response = self.app.post('/oauth/authorize', data=form)
+        return parse_qs(urlparse(response.headers['Location']).query)['code'][0]
+
+    def exchange(self, code):
+        """ The token response for code.
+        """
+        return self.app.post('/oauth/token', data={'grant_type': 'authorization_code',
+                                                   'code': code,
+                                                   'redirect_uri': self.REDIRECT_URI,
+                                                   'client_id': self.CLIENT_ID,
+                                                   'client_secret': self.CLIENT_SECRET})
+
+    def launch(self):
+        """ The tokens of a new authorization.
+        """
+        return json.loads(self.exchange(self.authorize()).get_data(as_text=True))
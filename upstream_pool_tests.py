@@ -0,0 +1,89 @@
+from auth_proxy.application import app
+from auth_proxy.services import proxy_service
+from testing import AppTestCase, StubUpstream
+import requests
+import unittest
+import json
+import time
+
+
+class UpstreamPoolTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.primary = StubUpstream(body={'resourceType': 'Bundle', 'id': 'primary'}).start()
+        self.replica = StubUpstream(body={'resourceType': 'Bundle', 'id': 'replica'}).start()
+        proxy_service.resilience.reset()
+        self.start_app(API_SERVER=self.primary.url,
+                       API_SERVER_REPLICAS=[self.replica.url],
+                       UPSTREAM_HEALTH_INTERVAL=0,
+                       UPSTREAM_RETRIES=0)
+
+    def tearDown(self):
+        self.primary.stop()
+        self.replica.stop()
+        super().tearDown()
+        proxy_service.resilience.reset()
+
+    def get(self):
+        response = self.app.get('/api/fhir/Patient', headers=self.headers)
+        return json.loads(response.get_data(as_text=True))['id']
+
+    def test_avoids_unhealthy_replica(self):
+        self.primary.status = 503
+        app.config["UPSTREAM_BREAKER_THRESHOLD"] = 1
+
+        # Once the primary's breaker opens, reads go to the replica.
+        answers = [self.get() for _ in range(4)]
+
+        assert answers[-3:] == ['replica'] * 3
+
+    def test_hedged_read(self):
+        app.config["UPSTREAM_HEDGE_AFTER"] = 0.05
+
+        # Whichever replica is asked first is slow; the hedge is fast.
+        arrivals = []
+
+        def handler(request):
+            arrivals.append(request.path)
+            if len(arrivals) == 1:
+                time.sleep(0.5)
+        self.primary.handler = self.replica.handler = handler
+
+        start = time.time()
+        self.get()
+
+        assert time.time() - start < 0.5
+        with self.auth_app.app_context():
+            status = proxy_service.status()['pool']
+        assert status['counters']['hedges'] == 1
+        assert status['counters']['hedge_wins'] == 1
+
+    def test_lost_hedge_is_closed(self):
+        app.config["UPSTREAM_HEDGE_AFTER"] = 0.05
+        slow = []
+
+        def handler(request):
+            if not slow:
+                slow.append(request.server.server_address[1])
+                time.sleep(0.3)
+        self.primary.handler = self.replica.handler = handler
+
+        closed = []
+        close = requests.Response.close
+
+        def record(response):
+            closed.append(response.url)
+            close(response)
+        requests.Response.close = record
+        try:
+            self.get()
+            time.sleep(0.5)
+        finally:
+            requests.Response.close = close
+
+        assert any(':{}/'.format(slow[0]) in url for url in closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
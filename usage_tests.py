@@ -0,0 +1,89 @@
+from auth_proxy.models.oauth import Token
+from auth_proxy.extensions import usage
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from testing import AppTestCase, StubUpstream
+import unittest
+
+
+class UsageTestCase(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubUpstream().start()
+        self.start_app(API_SERVER=self.stub.url,
+                       USAGE_TRACKING=True,
+                       USAGE_FLUSH_INTERVAL=3600,
+                       SQLITE_CONCURRENCY=True)
+
+    def tearDown(self):
+        usage.flush()
+        self.stub.stop()
+        super().tearDown()
+
+    def token(self):
+        with self.auth_app.app_context():
+            return Token.query.filter_by(access_token=self.access_token).first()
+
+    def test_counted_in_memory(self):
+        for _ in range(3):
+            self.app.get('/api/fhir/Observation', headers=self.headers)
+
+        token = self.token()
+        assert token.request_count is None
+        assert token.last_used is None
+
+    def test_flush(self):
+        for _ in range(3):
+            self.app.get('/api/fhir/Observation', headers=self.headers)
+        usage.flush()
+        self.app.get('/api/fhir/Observation', headers=self.headers)
+        usage.flush()
+
+        token = self.token()
+        assert token.request_count == 4
+        assert token.last_used is not None
+
+    def test_flush_is_serialized(self):
+        self.app.get('/api/fhir/Observation', headers=self.headers)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            usage.flush()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+        # The write lock is taken up front, like the other writes'.
+        assert statements[0] == 'BEGIN IMMEDIATE'
+        assert self.token().request_count == 1
+
+    def test_keeps_latest_last_used(self):
+        self.app.get('/api/fhir/Observation', headers=self.headers)
+        usage.flush()
+        latest = self.token().last_used
+
+        # A worker with an older count flushing later doesn't move it back.
+        usage._pending[self.access_token] = [2, latest.replace(year=2000)]
+        usage.flush()
+
+        token = self.token()
+        assert token.request_count == 3
+        assert token.last_used == latest
+
+    def test_apps(self):
+        self.app.get('/api/fhir/Observation', headers=self.headers)
+        usage.flush()
+        self.app.post('/login', data={'username': self.USERNAME, 'password': self.PASSWORD})
+
+        page = self.app.get('/apps').get_data(as_text=True)
+
+        assert self.token().last_used.strftime('%Y-%m-%d %H:%M UTC') in page
+        assert '<td>1</td>' in page
+
+
+if __name__ == '__main__':
+    unittest.main()